@@ -0,0 +1,324 @@
+# API server Kubernetes finto per i benchmark
+# Implementa in memoria gli endpoint usati da CustomObjectsApi per le CRD namespaced (LIST/WATCH, GET,
+# POST, PATCH merge/apply anche sulla sottorisorsa status), registra ogni chiamata e puo' iniettare
+# latenza e risposte 409/404. Gira in un thread del processo di benchmark: i servizi reali vi si
+# collegano via HTTP con un kubeconfig generato.
+import bisect
+import copy
+import json
+import random
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+# Chiamata registrata: (istante monotonic, client, verbo, risorsa, stato HTTP, latenza in secondi)
+Call = Tuple[float, str, str, str, int, float]
+# Osservatore delle scritture: (istante monotonic, plural, nome, oggetto dopo la scrittura)
+WriteObserver = Callable[[float, str, str, Dict[str, Any]], None]
+
+
+def merge_patch(target: Any, patch: Any) -> Any:
+    # JSON merge patch (RFC 7386)
+    if not isinstance(patch, dict):
+        return copy.deepcopy(patch)
+    result = dict(target) if isinstance(target, dict) else {}
+    for key, value in patch.items():
+        if value is None:
+            result.pop(key, None)
+        else:
+            result[key] = merge_patch(result.get(key), value)
+    return result
+
+
+class FakeStore:
+    """Oggetti delle CRD per (plural, nome), con resourceVersion globale e log degli eventi per le WATCH."""
+
+    def __init__(self, event_log_size: int = 200000):
+        self._cond = threading.Condition()
+        self._objects: Dict[str, Dict[str, Dict[str, Any]]] = {}
+        self._rv = 0
+        self._events: List[Tuple[int, str, str, Dict[str, Any]]] = []  # (rv, plural, tipo, oggetto)
+        self._event_log_size = event_log_size
+
+    def resource_version(self) -> int:
+        with self._cond:
+            return self._rv
+
+    def list(self, plural: str) -> Tuple[List[Dict[str, Any]], int]:
+        with self._cond:
+            items = [copy.deepcopy(o) for _, o in sorted(self._objects.get(plural, {}).items())]
+            return items, self._rv
+
+    def get(self, plural: str, name: str) -> Optional[Dict[str, Any]]:
+        with self._cond:
+            obj = self._objects.get(plural, {}).get(name)
+            return copy.deepcopy(obj) if obj is not None else None
+
+    def create(self, plural: str, body: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        # None se l'oggetto esiste gia'
+        name = (body.get("metadata") or {}).get("name", "")
+        with self._cond:
+            objs = self._objects.setdefault(plural, {})
+            if name in objs:
+                return None
+            obj = copy.deepcopy(body)
+            meta = obj.setdefault("metadata", {})
+            meta["uid"] = str(uuid.uuid4())
+            meta["creationTimestamp"] = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+            self._commit(plural, "ADDED", obj)
+            objs[name] = obj
+            return copy.deepcopy(obj)
+
+    def patch(self, plural: str, name: str, patch: Dict[str, Any], subresource: Optional[str]) -> Optional[Dict[str, Any]]:
+        # None se l'oggetto non esiste; sulla sottorisorsa status cambia solo .status
+        with self._cond:
+            obj = self._objects.get(plural, {}).get(name)
+            if obj is None:
+                return None
+            if subresource == "status":
+                new = dict(obj)
+                new["status"] = merge_patch(obj.get("status"), patch.get("status") or {})
+            else:
+                new = merge_patch(obj, {k: v for k, v in patch.items() if k != "status"})
+            new["metadata"] = dict(obj["metadata"])
+            if new == obj:
+                return copy.deepcopy(obj)
+            self._commit(plural, "MODIFIED", new)
+            self._objects[plural][name] = new
+            return copy.deepcopy(new)
+
+    def events_since(self, plural: str, rv: int, timeout: float) -> Optional[List[Tuple[int, str, Dict[str, Any]]]]:
+        # Eventi con resourceVersion > rv (attende fino a timeout); None se rv non e' piu' nel log (410 Gone)
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                if self._events and rv < self._events[0][0] - 1:
+                    return None
+                start = bisect.bisect_left(self._events, (rv + 1,))
+                out = [(erv, etype, copy.deepcopy(obj)) for erv, p, etype, obj in self._events[start:] if p == plural]
+                remaining = deadline - time.monotonic()
+                if out or remaining <= 0:
+                    return out
+                self._cond.wait(remaining)
+
+    def _commit(self, plural: str, etype: str, obj: Dict[str, Any]):
+        self._rv += 1
+        obj["metadata"]["resourceVersion"] = str(self._rv)
+        self._events.append((self._rv, plural, etype, copy.deepcopy(obj)))
+        if len(self._events) > self._event_log_size * 3 // 2:
+            del self._events[: len(self._events) - self._event_log_size]
+        self._cond.notify_all()
+
+
+class FakeKubeAPI:
+    """Server HTTP che espone un FakeStore; ogni istanza ha un nome client usato nella registrazione delle chiamate.
+
+    latency: secondi aggiunti ad ogni chiamata (esclusa l'attesa delle WATCH)
+    conflict_rate: probabilita' di rispondere 409 ad una POST di un oggetto inesistente
+    not_found_rate: probabilita' di rispondere 404 ad una PATCH della sottorisorsa status
+    """
+
+    def __init__(self, store: FakeStore, client: str, latency: float = 0.0, conflict_rate: float = 0.0,
+                 not_found_rate: float = 0.0, seed: Optional[int] = None):
+        self.store = store
+        self.client = client
+        self.latency = latency
+        self.conflict_rate = conflict_rate
+        self.not_found_rate = not_found_rate
+        self.observer: Optional[WriteObserver] = None
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._calls: List[Call] = []
+        api = self
+
+        class Handler(_Handler):
+            fake = api
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        self.port = self._server.server_address[1]
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    def start(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True, name=f"fakekube-{self.client}").start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def write_kubeconfig(self, path: str):
+        # Il client Python accetta anche JSON come kubeconfig (YAML e' un suo superset)
+        cfg = {
+            "apiVersion": "v1", "kind": "Config", "current-context": "bench",
+            "clusters": [{"name": "bench", "cluster": {"server": self.url}}],
+            "users": [{"name": "bench", "user": {"token": "bench"}}],
+            "contexts": [{"name": "bench", "context": {"cluster": "bench", "user": "bench"}}],
+        }
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(cfg, f)
+
+    # ---------- registrazione ----------
+    def record(self, verb: str, resource: str, status: int, elapsed: float):
+        with self._lock:
+            self._calls.append((time.monotonic(), self.client, verb, resource, status, elapsed))
+
+    def calls(self, since: float = 0.0) -> List[Call]:
+        with self._lock:
+            return [c for c in self._calls if c[0] >= since]
+
+    def summary(self, since: float = 0.0) -> Dict[str, Any]:
+        calls = self.calls(since)
+        by_key = Counter(f"{verb} {resource} {status}" for _, _, verb, resource, status, _ in calls)
+        return {"total": len(calls), "byVerbResourceStatus": dict(sorted(by_key.items()))}
+
+    def inject(self, kind: str) -> bool:
+        rate = self.conflict_rate if kind == "409" else self.not_found_rate
+        if rate <= 0:
+            return False
+        with self._lock:
+            return self._rng.random() < rate
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    fake: FakeKubeAPI
+
+    def log_message(self, *_args):
+        pass
+
+    # ---------- routing ----------
+    def _route(self) -> Optional[Tuple[str, Optional[str], Optional[str], Dict[str, List[str]]]]:
+        # /apis/{group}/{version}/namespaces/{ns}/{plural}[/{name}[/status]]
+        url = urlparse(self.path)
+        parts = [p for p in url.path.split("/") if p]
+        if len(parts) < 6 or parts[0] != "apis" or parts[3] != "namespaces":
+            return None
+        plural = parts[5]
+        name = parts[6] if len(parts) > 6 else None
+        sub = parts[7] if len(parts) > 7 else None
+        return plural, name, sub, parse_qs(url.query)
+
+    def _body(self) -> Dict[str, Any]:
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b"{}"
+        return json.loads(raw.decode("utf-8") or "{}")
+
+    def _send(self, status: int, obj: Dict[str, Any]):
+        raw = json.dumps(obj).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(raw)))
+        self.end_headers()
+        self.wfile.write(raw)
+
+    def _status(self, code: int, reason: str, message: str) -> Dict[str, Any]:
+        return {"kind": "Status", "apiVersion": "v1", "status": "Failure", "reason": reason,
+                "message": message, "code": code}
+
+    def _handle(self, verb: str, fn):
+        start = time.monotonic()
+        route = self._route()
+        if route is None:
+            self._send(404, self._status(404, "NotFound", self.path))
+            return
+        plural, name, sub, query = route
+        resource = plural + ("/" + sub if sub else "")
+        if self.fake.latency > 0:
+            time.sleep(self.fake.latency)
+        status = fn(plural, name, sub, query)
+        self.fake.record(verb, resource, status, time.monotonic() - start)
+
+    # ---------- verbi ----------
+    def do_GET(self):
+        route = self._route()
+        if route is not None and route[1] is None and route[3].get("watch", ["false"])[0].lower() == "true":
+            self._handle("watch", self._watch)
+        elif route is not None and route[1] is None:
+            self._handle("list", self._list)
+        else:
+            self._handle("get", self._get)
+
+    def do_POST(self):
+        self._handle("create", self._create)
+
+    def do_PATCH(self):
+        verb = "apply" if "apply-patch" in (self.headers.get("Content-Type") or "") else "patch"
+        self._handle(verb, self._patch)
+
+    def _list(self, plural, _name, _sub, _query) -> int:
+        items, rv = self.fake.store.list(plural)
+        self._send(200, {"apiVersion": "v1", "kind": "List", "metadata": {"resourceVersion": str(rv)}, "items": items})
+        return 200
+
+    def _get(self, plural, name, _sub, _query) -> int:
+        obj = self.fake.store.get(plural, name)
+        if obj is None:
+            self._send(404, self._status(404, "NotFound", f"{plural} {name} not found"))
+            return 404
+        self._send(200, obj)
+        return 200
+
+    def _create(self, plural, _name, _sub, _query) -> int:
+        body = self._body()
+        name = (body.get("metadata") or {}).get("name", "")
+        obj = None if self.fake.inject("409") else self.fake.store.create(plural, body)
+        if obj is None:
+            self._send(409, self._status(409, "AlreadyExists", f"{plural} {name} already exists"))
+            return 409
+        self._notify(plural, name, obj)
+        self._send(201, obj)
+        return 201
+
+    def _patch(self, plural, name, sub, _query) -> int:
+        body = self._body()
+        obj = None
+        if not (sub == "status" and self.fake.inject("404")):
+            obj = self.fake.store.patch(plural, name, body, sub)
+        if obj is None:
+            self._send(404, self._status(404, "NotFound", f"{plural} {name} not found"))
+            return 404
+        self._notify(plural, name, obj)
+        self._send(200, obj)
+        return 200
+
+    def _watch(self, plural, _name, _sub, query) -> int:
+        rv = int((query.get("resourceVersion") or ["0"])[0] or 0)
+        timeout = float((query.get("timeoutSeconds") or ["300"])[0])
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        deadline = time.monotonic() + timeout
+        try:
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                events = self.fake.store.events_since(plural, rv, min(remaining, 1.0))
+                if events is None:
+                    self._chunk({"type": "ERROR", "object": self._status(410, "Expired", "too old resource version")})
+                    break
+                for erv, etype, obj in events:
+                    self._chunk({"type": etype, "object": obj})
+                    rv = erv
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        return 200
+
+    def _chunk(self, event: Dict[str, Any]):
+        raw = json.dumps(event).encode("utf-8") + b"\n"
+        self.wfile.write(f"{len(raw):x}\r\n".encode("ascii") + raw + b"\r\n")
+        self.wfile.flush()
+
+    def _notify(self, plural: str, name: str, obj: Dict[str, Any]):
+        if self.fake.observer is not None:
+            self.fake.observer(time.monotonic(), plural, name, obj)
@@ -0,0 +1,202 @@
+# Benchmark del percorso di lettura di signage e mobile-api con un API server lento
+# I servizi vengono avviati come processi separati contro l'API Kubernetes finta (fakekube.py), con latenza
+# iniettata su ogni chiamata e WATCH brevi, cosi' durante la misura gli informer hanno sempre chiamate lente
+# in corso; un thread modifica gli stalli a ritmo costante (cache e risposte vengono invalidate di continuo).
+# Per ogni livello di concorrenza, N client con connessione keep-alive interrogano un endpoint a ciclo chiuso
+# mentre una sonda misura la latenza di /health dello stesso servizio.
+#
+#   python bench/readpath.py --api-latency-ms 2000 --concurrency 1,16,64,256 --duration 5
+import argparse
+import http.client
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fakekube import FakeKubeAPI, FakeStore  # noqa: E402
+from run import ROOT, SERVICES, Service, free_port, git_commit, parse_list, quantiles, service_env, wait_http  # noqa: E402
+
+
+def seed(store: FakeStore, lots: int, spaces: int) -> List[str]:
+    lot_ids = [f"R{i + 1}" for i in range(lots)]
+    for lot in lot_ids:
+        store.create("parkinglots", {"metadata": {"name": lot.lower()},
+                                     "spec": {"lotId": lot, "totalSpaces": spaces},
+                                     "status": {"occupied": 0, "free": spaces, "offline": 0}})
+        for j in range(spaces):
+            store.create("parkingspaces", {"metadata": {"name": f"{lot.lower()}-{lot.lower()}-{j + 1}"},
+                                           "spec": {"lotId": lot, "spaceId": f"{lot}-{j + 1}"},
+                                           "status": {"occupied": False, "sensorOnline": True}})
+    return lot_ids
+
+
+def churn(store: FakeStore, lot_ids: List[str], spaces: int, rate: float, stop: threading.Event) -> Dict[str, int]:
+    # Variazioni degli stalli (e dei conteggi del lot) scritte direttamente nello store: arrivano ai servizi via WATCH
+    rng = random.Random(1)
+    occupied = {lot: set() for lot in lot_ids}
+    done = {"changes": 0}
+
+    def run():
+        interval = 1.0 / rate
+        next_at = time.monotonic()
+        while not stop.is_set():
+            lot = rng.choice(lot_ids)
+            j = rng.randint(1, spaces)
+            occ = occupied[lot]
+            now_occupied = j not in occ
+            (occ.add if now_occupied else occ.discard)(j)
+            store.patch("parkingspaces", f"{lot.lower()}-{lot.lower()}-{j}", {"status": {"occupied": now_occupied}}, "status")
+            store.patch("parkinglots", lot.lower(), {"status": {"occupied": len(occ), "free": spaces - len(occ)}}, "status")
+            done["changes"] += 1
+            next_at += interval
+            stop.wait(max(0.0, next_at - time.monotonic()))
+
+    if rate > 0:
+        threading.Thread(target=run, daemon=True, name="churn").start()
+    return done
+
+
+def client_loop(port: int, path: str, deadline: float, latencies: List[float], errors: List[int]):
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    while time.monotonic() < deadline:
+        start = time.monotonic()
+        try:
+            conn.request("GET", path)
+            resp = conn.getresponse()
+            resp.read()
+            if resp.status != 200:
+                raise OSError(f"HTTP {resp.status}")
+            latencies.append((time.monotonic() - start) * 1000.0)
+        except (OSError, http.client.HTTPException):
+            errors[0] += 1
+            conn.close()
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    conn.close()
+
+
+def run_level(port: int, path: str, concurrency: int, duration: float, probe_interval: float) -> Dict[str, Any]:
+    deadline = time.monotonic() + duration
+    latencies: List[List[float]] = [[] for _ in range(concurrency)]
+    errors: List[List[int]] = [[0] for _ in range(concurrency)]
+    threads = [threading.Thread(target=client_loop, args=(port, path, deadline, latencies[i], errors[i]), daemon=True)
+               for i in range(concurrency)]
+    for t in threads:
+        t.start()
+    # Sonda: /health deve restare rapido anche con il servizio sotto carico e l'API server lento
+    probe: List[float] = []
+    probe_errors = 0
+    while time.monotonic() < deadline:
+        start = time.monotonic()
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+            conn.request("GET", "/health")
+            if conn.getresponse().status != 200:
+                raise OSError("health")
+            probe.append((time.monotonic() - start) * 1000.0)
+            conn.close()
+        except (OSError, http.client.HTTPException):
+            probe_errors += 1
+        time.sleep(probe_interval)
+    for t in threads:
+        t.join(timeout=60)
+    all_lat = [v for lat in latencies for v in lat]
+    return {
+        "concurrency": concurrency, "requests": len(all_lat), "requestsPerSecond": len(all_lat) / duration,
+        "latencyMs": quantiles(all_lat), "errors": sum(e[0] for e in errors),
+        "healthLatencyMs": dict(quantiles(probe), errors=probe_errors),
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark del percorso di lettura con API server lento")
+    ap.add_argument("--lots", type=int, default=20, help="lot nello store")
+    ap.add_argument("--spaces", type=int, default=100, help="stalli per lot")
+    ap.add_argument("--concurrency", default="1,16,64,256", help="client concorrenti da provare (separati da virgola)")
+    ap.add_argument("--duration", type=float, default=5.0, help="secondi di carico per livello e endpoint")
+    ap.add_argument("--api-latency-ms", type=float, default=2000.0, help="latenza iniettata in ogni chiamata all'API server")
+    ap.add_argument("--watch-timeout", type=int, default=5, help="WATCH_TIMEOUT dei servizi: WATCH riaperte (lente) di continuo")
+    ap.add_argument("--churn", type=float, default=50.0, help="variazioni di stalli al secondo durante la misura")
+    ap.add_argument("--probe-interval", type=float, default=0.1, help="secondi tra due sonde di /health")
+    ap.add_argument("--out", default="", help="file JSON dei risultati (default: bench/results/readpath-<commit>.json)")
+    args = ap.parse_args()
+
+    commit, dirty = git_commit()
+    out = args.out or os.path.join(ROOT, "bench", "results", f"readpath-{commit[:12]}{'-dirty' if dirty else ''}.json")
+    log_dir = tempfile.mkdtemp(prefix="smart-parking-readpath-")
+    print(f"[BENCH] log in {log_dir}")
+
+    store = FakeStore()
+    lot_ids = seed(store, args.lots, args.spaces)
+    api = FakeKubeAPI(store, "readers", args.api_latency_ms / 1000.0)
+    api.start()
+    kubeconfig = os.path.join(log_dir, "kubeconfig-readers.json")
+    api.write_kubeconfig(kubeconfig)
+
+    services: List[Service] = []
+    ports: Dict[str, int] = {}
+    stop = threading.Event()
+    results = []
+    try:
+        env = {"WATCH_TIMEOUT": str(args.watch_timeout),
+               "INFORMER_SYNC_TIMEOUT": str(max(10.0, 3 * args.api_latency_ms / 1000.0)),
+               "API_REQUEST_TIMEOUT": str(max(10.0, 2 * args.api_latency_ms / 1000.0))}
+        for name in ("signage", "mobile-api"):
+            ports[name] = free_port()
+            services.append(Service(name, [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1",
+                                           "--port", str(ports[name]), "--log-level", "warning"],
+                                    os.path.join(SERVICES, name), service_env(kubeconfig, env), log_dir))
+        for name, port in ports.items():
+            if not wait_http(port, "/health", 60):
+                raise RuntimeError(f"{name} non avviato, vedi {log_dir}/{name}.log")
+        changes = churn(store, lot_ids, args.spaces, args.churn, stop)
+
+        endpoints: List[Tuple[str, str]] = [
+            ("signage", "/dashboard-data"),
+            ("signage", "/lots"),
+            ("mobile-api", "/lots"),
+            ("mobile-api", f"/lots/{lot_ids[0]}"),
+            ("mobile-api", f"/lots/{lot_ids[0]}/spaces?occupied=false&limit=50"),
+            ("mobile-api", f"/lots?minFree={args.spaces // 2}"),
+        ]
+        start = time.monotonic()
+        for name, path in endpoints:
+            for c in parse_list(args.concurrency, int):
+                r = run_level(ports[name], path, c, args.duration, args.probe_interval)
+                r.update({"service": name, "path": path})
+                lat, health = r["latencyMs"], r["healthLatencyMs"]
+                print(f"[BENCH] {name} {path} c={c}: {r['requestsPerSecond']:.0f} req/s "
+                      f"p50/p99={lat['p50']:.1f}/{lat['p99']:.1f}ms errori={r['errors']} "
+                      f"/health p99={health['p99']:.1f}ms")
+                results.append(r)
+        upstream = api.summary(0)
+        elapsed = time.monotonic() - start
+    finally:
+        stop.set()
+        for svc in reversed(services):
+            svc.stop()
+        api.stop()
+
+    report = {
+        "commit": commit, "dirty": dirty, "createdAt": datetime.now(timezone.utc).isoformat(),
+        "host": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()},
+        "config": {k: v for k, v in vars(args).items() if k != "out"},
+        "changes": changes["changes"], "changesPerSecond": changes["changes"] / elapsed if elapsed else 0.0,
+        "upstreamCalls": upstream,
+        "results": results,
+    }
+    os.makedirs(os.path.dirname(out), exist_ok=True)
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"[BENCH] risultati scritti in {out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,450 @@
+# Benchmark end-to-end di Smart Parking (una sola macchina Linux)
+# sensor-simulator (loadgen) -> broker MQTT locale -> aggregator -> API Kubernetes finta -> signage / mobile-api
+#
+# Per ogni combinazione lot x stalli x rate vengono avviati aggregator, signage e mobile-api come processi
+# separati, collegati ad un'API server finta in-process (fakekube.py). Il risultato e' un file JSON con
+# messaggi/s, chiamate API per messaggio, latenza sensore->CRD e latenza degli endpoint di lettura.
+# Prima dei punti viene misurato in-process il costo dei formati del payload (byte per messaggio e
+# tempo di decodifica con le stesse funzioni usate dall'aggregatore).
+#
+#   python bench/run.py --lots 1,10 --spaces 100 --rates 200,1000 --duration 30
+#   python bench/run.py --payload json,binary --rates 1000
+#   python bench/run.py --compare bench/results/<commit-a>.json bench/results/<commit-b>.json
+import argparse
+import http.client
+import itertools
+import json
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+import paho.mqtt.client as mqtt
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVICES = os.path.join(ROOT, "services")
+sys.path.insert(0, os.path.join(SERVICES, "sensor-simulator"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fakekube import FakeKubeAPI, FakeStore  # noqa: E402
+from loadgen import LoadGenerator, make_pattern  # noqa: E402
+from payload import FORMATS, decode_json, decode_v1, encode_status, status_topic  # noqa: E402
+
+NAMESPACE = "bench"
+
+
+def quantiles(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {"count": 0, "p50": 0.0, "p99": 0.0, "max": 0.0, "avg": 0.0}
+    v = sorted(values)
+    pick = lambda q: v[min(len(v) - 1, int(q * len(v)))]  # noqa: E731
+    return {"count": len(v), "p50": pick(0.5), "p99": pick(0.99), "max": v[-1], "avg": sum(v) / len(v)}
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def git_commit() -> Tuple[str, bool]:
+    try:
+        rev = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=ROOT, text=True).strip()
+        dirty = bool(subprocess.check_output(["git", "status", "--porcelain", "--", "services"], cwd=ROOT, text=True).strip())
+        return rev, dirty
+    except Exception:
+        return "unknown", False
+
+
+# ---------- Processi ----------
+class Service:
+    """Processo di un servizio; l'output viene conservato per la diagnostica e per attendere l'avvio."""
+
+    def __init__(self, name: str, cmd: List[str], cwd: str, env: Dict[str, str], log_dir: str):
+        self.name = name
+        self.log_path = os.path.join(log_dir, f"{name}.log")
+        self._log = open(self.log_path, "w", encoding="utf-8")
+        self._lines: List[str] = []
+        self._ready = threading.Event()
+        self._marker: Optional[str] = None
+        self.proc = subprocess.Popen(cmd, cwd=cwd, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                     text=True, bufsize=1)
+        threading.Thread(target=self._pump, daemon=True, name=f"log-{name}").start()
+
+    def _pump(self):
+        for line in self.proc.stdout:
+            self._log.write(line)
+            self._log.flush()
+            if self._marker and self._marker in line:
+                self._ready.set()
+
+    def wait_for_line(self, marker: str, timeout: float) -> bool:
+        self._marker = marker
+        with open(self.log_path, encoding="utf-8") as f:
+            if marker in f.read():
+                return True
+        return self._ready.wait(timeout)
+
+    def stop(self):
+        if self.proc.poll() is None:
+            self.proc.terminate()
+            try:
+                self.proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+        self._log.close()
+
+
+def service_env(kubeconfig: str, extra: Dict[str, str]) -> Dict[str, str]:
+    env = {k: v for k, v in os.environ.items() if not k.startswith("KUBERNETES_")}
+    env.update({"KUBECONFIG": kubeconfig, "NAMESPACE": NAMESPACE, "PYTHONUNBUFFERED": "1"})
+    env.update(extra)
+    return env
+
+
+def wait_http(port: int, path: str, timeout: float) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=2)
+            conn.request("GET", path)
+            if conn.getresponse().status == 200:
+                return True
+        except OSError:
+            pass
+        time.sleep(0.2)
+    return False
+
+
+def start_broker(args, log_dir: str) -> Tuple[str, int, Optional[subprocess.Popen]]:
+    if args.broker:
+        host, _, port = args.broker.partition(":")
+        return host, int(port or 1883), None
+    binary = shutil.which(args.mosquitto) or args.mosquitto
+    port = free_port()
+    conf = os.path.join(log_dir, "mosquitto.conf")
+    with open(conf, "w", encoding="utf-8") as f:
+        f.write(f"listener {port} 127.0.0.1\nallow_anonymous true\npersistence false\nmax_inflight_messages 0\n"
+                f"max_queued_messages 0\n")
+    proc = subprocess.Popen([binary, "-c", conf], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return "127.0.0.1", port, proc
+        except OSError:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError(f"broker {binary} non raggiungibile sulla porta {port}")
+
+
+def clear_retained(host: str, port: int, topics: List[str]):
+    # Un payload vuoto retained cancella il messaggio conservato dal broker: il punto successivo parte pulito
+    c = mqtt.Client(client_id=f"bench-cleaner-{os.getpid()}")
+    c.max_inflight_messages_set(1000)
+    c.connect(host, port)
+    c.loop_start()
+    infos = [c.publish(t, b"", qos=1, retain=True) for t in topics]
+    for info in infos:
+        info.wait_for_publish(timeout=5)
+    c.loop_stop()
+    c.disconnect()
+
+
+# ---------- Misure ----------
+def codec_bench(iterations: int = 200000) -> Dict[str, Dict[str, float]]:
+    # Byte per messaggio e tempo medio di decodifica di un payload di stato per ogni formato
+    decoders = {"json": decode_json, "binary": decode_v1}
+    out = {}
+    for fmt in FORMATS:
+        payload = encode_status(fmt, True, True, int(time.time()), "B0L1", "B0L1-100", "bench0-1234-B0L1-100")
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        decode = decoders[fmt]
+        start = time.perf_counter()
+        for _ in range(iterations):
+            decode(payload)
+        out[fmt] = {"bytes": len(payload), "decodeUs": (time.perf_counter() - start) / iterations * 1e6}
+    return out
+
+
+class LatencyTracker:
+    """Latenza sensore->CRD: dal primo messaggio con un nuovo stato alla scrittura di quello stato nel ParkingSpace."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._last_sent: Dict[str, Tuple[bool, bool]] = {}
+        self._pending: Dict[str, Tuple[Tuple[bool, bool], float]] = {}
+        self.latencies_ms: List[float] = []
+        self.superseded = 0  # stati sostituiti da uno successivo prima di essere scritti
+
+    def on_sent(self, sensor, t: float):
+        name = f"{sensor.lot_id}-{sensor.space_id}".lower()
+        state = (bool(sensor.occupied), bool(sensor.online))
+        with self._lock:
+            if self._last_sent.get(name) == state:
+                return
+            self._last_sent[name] = state
+            if name in self._pending:
+                self.superseded += 1
+            self._pending[name] = (state, t)
+
+    def on_write(self, t: float, plural: str, name: str, obj: Dict[str, Any]):
+        if plural != "parkingspaces":
+            return
+        status = obj.get("status") or {}
+        if "occupied" not in status:
+            return
+        state = (bool(status.get("occupied")), bool(status.get("sensorOnline")))
+        with self._lock:
+            pending = self._pending.get(name)
+            if pending is not None and pending[0] == state:
+                del self._pending[name]
+                self.latencies_ms.append((t - pending[1]) * 1000.0)
+
+    def summary(self) -> Dict[str, Any]:
+        with self._lock:
+            out = quantiles(self.latencies_ms)
+            out["unmatched"] = len(self._pending)
+            out["superseded"] = self.superseded
+            return out
+
+
+class Reader:
+    """Interroga gli endpoint di lettura a ritmo costante e ne registra la latenza."""
+
+    def __init__(self, endpoints: List[Tuple[str, int, str]], rate: float):
+        self._endpoints = endpoints
+        self._interval = 1.0 / rate if rate > 0 else 0.0
+        self._stop = threading.Event()
+        self.latencies: Dict[str, List[float]] = {name: [] for name, _, _ in endpoints}
+        self.errors: Dict[str, int] = {name: 0 for name, _, _ in endpoints}
+        self._threads: List[threading.Thread] = []
+
+    def start(self):
+        if self._interval <= 0:
+            return
+        for ep in self._endpoints:
+            t = threading.Thread(target=self._run, args=ep, daemon=True, name=f"reader-{ep[0]}")
+            t.start()
+            self._threads.append(t)
+
+    def stop(self) -> Dict[str, Any]:
+        self._stop.set()
+        for t in self._threads:
+            t.join(timeout=5)
+        return {name: dict(quantiles(lat), errors=self.errors[name]) for name, lat in self.latencies.items()}
+
+    def _run(self, name: str, port: int, path: str):
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+        next_at = time.monotonic()
+        while not self._stop.is_set():
+            start = time.monotonic()
+            try:
+                conn.request("GET", path)
+                resp = conn.getresponse()
+                resp.read()
+                if resp.status != 200:
+                    raise OSError(f"HTTP {resp.status}")
+                self.latencies[name].append((time.monotonic() - start) * 1000.0)
+            except (OSError, http.client.HTTPException):
+                self.errors[name] += 1
+                conn.close()
+                conn = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+            next_at += self._interval
+            self._stop.wait(max(0.0, next_at - time.monotonic()))
+
+
+# ---------- Esecuzione di un punto ----------
+def run_point(args, broker: Tuple[str, int], lots: int, spaces: int, rate: float, payload_format: str, index: int,
+              log_dir: str) -> Dict[str, Any]:
+    point_dir = os.path.join(log_dir, f"point-{index}")
+    os.makedirs(point_dir, exist_ok=True)
+    store = FakeStore()
+    writer_api = FakeKubeAPI(store, "aggregator", args.api_latency_ms / 1000.0, args.conflict_rate,
+                             args.not_found_rate, seed=index)
+    reader_api = FakeKubeAPI(store, "readers")
+    tracker = LatencyTracker()
+    writer_api.observer = tracker.on_write
+    writer_api.start()
+    reader_api.start()
+    writer_kc = os.path.join(point_dir, "kubeconfig-aggregator.json")
+    reader_kc = os.path.join(point_dir, "kubeconfig-readers.json")
+    writer_api.write_kubeconfig(writer_kc)
+    reader_api.write_kubeconfig(reader_kc)
+
+    host, port = broker
+    services: List[Service] = []
+    lot_ids = [f"B{index}L{i + 1}" for i in range(lots)]
+    try:
+        agg_env = {"BROKER_HOST": host, "BROKER_PORT": str(port), "MQTT_TLS": "0", "STATS_INTERVAL": "0",
+                   "METRICS_PORT": "0"}
+        agg_env.update(dict(kv.split("=", 1) for kv in args.aggregator_env))
+        agg = Service("aggregator", [sys.executable, "main.py"], os.path.join(SERVICES, "aggregator"),
+                      service_env(writer_kc, agg_env), point_dir)
+        services.append(agg)
+        if not agg.wait_for_line("[MQTT] iscritto", 20):
+            raise RuntimeError(f"aggregator non avviato, vedi {agg.log_path}")
+
+        read_ports = {}
+        if args.read_rate > 0:
+            for name in ("signage", "mobile-api"):
+                p = free_port()
+                svc = Service(name, [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(p),
+                                     "--log-level", "warning"],
+                              os.path.join(SERVICES, name), service_env(reader_kc, {}), point_dir)
+                services.append(svc)
+                read_ports[name] = p
+            for name, p in read_ports.items():
+                if not wait_http(p, "/health", 30):
+                    raise RuntimeError(f"{name} non avviato, vedi {point_dir}/{name}.log")
+
+        reader = Reader([("signage /dashboard-data", read_ports.get("signage", 0), "/dashboard-data"),
+                         ("mobile-api /lots", read_ports.get("mobile-api", 0), "/lots")] if read_ports else [],
+                        args.read_rate)
+        gen = LoadGenerator(host, port, lot_ids, spaces, make_pattern(args.pattern, args.flap), rate=rate,
+                            connections=args.connections, qos=1, report_interval=0, seed=index,
+                            client_prefix=f"bench{index}", on_sent=tracker.on_sent, payload_format=payload_format)
+
+        start = time.monotonic()
+        reader.start()
+        load = gen.run(args.duration)
+        # Tempo per smaltire le code dell'aggregatore prima di chiudere la misura
+        time.sleep(args.drain)
+        reads = reader.stop()
+        elapsed = time.monotonic() - start
+
+        calls = writer_api.summary()
+        sent = load["sent"] or 1
+        return {
+            "lots": lots, "spacesPerLot": spaces, "sensors": lots * spaces, "targetRate": rate,
+            "payload": payload_format, "messages": load["sent"], "messagesPerSecond": load["publishRate"],
+            "payloadBytesPerMessage": load["payloadBytes"] / sent,
+            "publishAckLatencyMs": load["ackLatencyMs"],
+            "apiCalls": calls, "apiCallsPerMessage": calls["total"] / sent,
+            "sensorToCrdLatencyMs": tracker.summary(),
+            "reads": reads, "readerApiCalls": reader_api.summary(),
+            "elapsed": elapsed,
+        }
+    finally:
+        for svc in reversed(services):
+            svc.stop()
+        writer_api.stop()
+        reader_api.stop()
+        try:
+            clear_retained(host, port, [status_topic(lot, f"{lot}-{i + 1}", payload_format)
+                                        for lot in lot_ids for i in range(spaces)])
+        except Exception as e:
+            print(f"[BENCH] pulizia dei messaggi retained fallita: {e}")
+
+
+# ---------- Confronto ----------
+def compare(a_path: str, b_path: str):
+    with open(a_path, encoding="utf-8") as f:
+        a = json.load(f)
+    with open(b_path, encoding="utf-8") as f:
+        b = json.load(f)
+    key = lambda r: (r["lots"], r["spacesPerLot"], r["targetRate"], r.get("payload", "json"))  # noqa: E731
+    base = {key(r): r for r in a["results"]}
+    print(f"{a['commit'][:12]} -> {b['commit'][:12]}")
+    metrics = [("msg/s", lambda r: r["messagesPerSecond"]),
+               ("api/msg", lambda r: r["apiCallsPerMessage"]),
+               ("crd p50", lambda r: r["sensorToCrdLatencyMs"]["p50"]),
+               ("crd p99", lambda r: r["sensorToCrdLatencyMs"]["p99"])]
+    for r in b["results"]:
+        old = base.get(key(r))
+        if old is None:
+            continue
+        parts = []
+        for label, get in metrics:
+            va, vb = get(old), get(r)
+            delta = (vb - va) / va * 100.0 if va else 0.0
+            parts.append(f"{label} {va:.2f}->{vb:.2f} ({delta:+.1f}%)")
+        print(f"  lots={r['lots']} spazi={r['spacesPerLot']} rate={r['targetRate']:.0f} "
+              f"payload={r.get('payload', 'json')}: " + "  ".join(parts))
+
+
+def parse_list(value: str, cast) -> List:
+    return [cast(v) for v in value.split(",") if v.strip()]
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark end-to-end di Smart Parking")
+    ap.add_argument("--lots", default="1,10", help="numeri di lot da provare (separati da virgola)")
+    ap.add_argument("--spaces", default="100", help="stalli per lot da provare")
+    ap.add_argument("--rates", default="200,1000", help="messaggi/s complessivi da provare")
+    ap.add_argument("--duration", type=float, default=20.0, help="secondi di carico per punto")
+    ap.add_argument("--drain", type=float, default=3.0, help="secondi di attesa dopo il carico")
+    ap.add_argument("--pattern", default="steady", help="pattern di arrivo del loadgen")
+    ap.add_argument("--flap", type=float, default=0.25, help="probabilita' di cambio stato per messaggio")
+    ap.add_argument("--connections", type=int, default=4, help="connessioni MQTT del loadgen")
+    ap.add_argument("--payload", default="json", help=f"formati del payload da provare ({', '.join(FORMATS)})")
+    ap.add_argument("--read-rate", type=float, default=10.0, help="richieste/s per endpoint di lettura (0 = niente letture)")
+    ap.add_argument("--api-latency-ms", type=float, default=0.0, help="latenza iniettata nelle chiamate dell'aggregator")
+    ap.add_argument("--conflict-rate", type=float, default=0.0, help="probabilita' di 409 sulle create")
+    ap.add_argument("--not-found-rate", type=float, default=0.0, help="probabilita' di 404 sulle PATCH di status")
+    ap.add_argument("--aggregator-env", action="append", default=[], metavar="KEY=VALUE",
+                    help="variabile d'ambiente aggiuntiva per l'aggregator (ripetibile)")
+    ap.add_argument("--broker", default="", help="broker esistente host:porta (default: avvia mosquitto)")
+    ap.add_argument("--mosquitto", default="mosquitto", help="eseguibile di mosquitto")
+    ap.add_argument("--out", default="", help="file JSON dei risultati (default: bench/results/<commit>.json)")
+    ap.add_argument("--compare", nargs=2, metavar=("BASE", "NEW"), help="confronta due file di risultati ed esce")
+    args = ap.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    commit, dirty = git_commit()
+    out = args.out or os.path.join(ROOT, "bench", "results", f"{commit[:12]}{'-dirty' if dirty else ''}.json")
+    log_dir = tempfile.mkdtemp(prefix="smart-parking-bench-")
+    print(f"[BENCH] log in {log_dir}")
+    formats = parse_list(args.payload, str)
+    unknown = [f for f in formats if f not in FORMATS]
+    if unknown:
+        ap.error(f"formati del payload sconosciuti: {', '.join(unknown)}")
+    codec = codec_bench()
+    for fmt, c in codec.items():
+        print(f"[BENCH] payload {fmt}: {c['bytes']} byte/messaggio, decodifica {c['decodeUs']:.2f}us")
+    host, port, broker_proc = start_broker(args, log_dir)
+    results = []
+    try:
+        points = list(itertools.product(parse_list(args.lots, int), parse_list(args.spaces, int),
+                                        parse_list(args.rates, float), formats))
+        for i, (lots, spaces, rate, fmt) in enumerate(points):
+            print(f"[BENCH] {i + 1}/{len(points)}: lots={lots} stalli/lot={spaces} rate={rate:.0f} msg/s payload={fmt}")
+            r = run_point(args, (host, port), lots, spaces, rate, fmt, i, log_dir)
+            lat = r["sensorToCrdLatencyMs"]
+            print(f"[BENCH]   {r['messagesPerSecond']:.0f} msg/s, {r['payloadBytesPerMessage']:.1f} byte/msg, "
+                  f"{r['apiCallsPerMessage']:.3f} chiamate API/msg, "
+                  f"sensore->CRD p50/p99={lat['p50']:.1f}/{lat['p99']:.1f}ms (non scritti={lat['unmatched']})")
+            for name, rd in r["reads"].items():
+                print(f"[BENCH]   {name}: p50/p99={rd['p50']:.1f}/{rd['p99']:.1f}ms errori={rd['errors']}")
+            results.append(r)
+    finally:
+        if broker_proc is not None:
+            broker_proc.terminate()
+            broker_proc.wait(timeout=10)
+
+    report = {
+        "commit": commit, "dirty": dirty, "createdAt": datetime.now(timezone.utc).isoformat(),
+        "host": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()},
+        "config": {k: v for k, v in vars(args).items() if k not in ("compare", "out")},
+        "codec": codec,
+        "results": results,
+    }
+    os.makedirs(os.path.dirname(out), exist_ok=True)
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"[BENCH] risultati scritti in {out}")
+
+
+if __name__ == "__main__":
+    main()
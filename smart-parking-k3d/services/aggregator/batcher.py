@@ -0,0 +1,151 @@
+# Scrittore a batch dello stato dei ParkingSpace
+# Le variazioni degli stalli vengono raccolte per una breve finestra e inviate in parallelo su un pool
+# di connessioni HTTP. Per ogni stallo vince l'ultimo valore ricevuto (last-writer-wins): un batch
+# parte solo quando il precedente e' terminato, quindi due scritture dello stesso stallo non si
+# sovrappongono mai.
+import bisect
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+from metrics import log_sampled
+
+log = logging.getLogger("aggregator")
+
+SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+
+class Histogram:
+    # Istogramma a bucket fissi (limite superiore incluso); l'ultimo bucket raccoglie i valori oltre il massimo
+
+    def __init__(self, buckets: tuple):
+        self._lock = threading.Lock()
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        with self._lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.count += 1
+            self.sum += value
+            if value > self.max:
+                self.max = value
+
+    def quantile(self, q: float) -> float:
+        # Stima del quantile come limite superiore del bucket che lo contiene
+        with self._lock:
+            if not self.count:
+                return 0.0
+            rank = q * self.count
+            seen = 0
+            for i, c in enumerate(self.counts):
+                seen += c
+                if seen >= rank:
+                    return float(self.buckets[i]) if i < len(self.buckets) else self.max
+            return self.max
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            avg = self.sum / self.count if self.count else 0.0
+            count, mx = self.count, self.max
+        return {"count": count, "avg": avg, "max": mx, "p50": self.quantile(0.5), "p99": self.quantile(0.99)}
+
+
+class SpaceStatusBatcher:
+    # write(lot_id, space_id, occupied, sensor_online, last_seen_iso) -> bool esegue la singola scrittura
+    # window: durata in secondi della finestra di raccolta
+    # concurrency: scritture parallele per batch (dimensiona anche il pool di connessioni)
+    # max_batch: dimensione oltre la quale il batch parte senza attendere la fine della finestra
+
+    def __init__(self, write: Callable[[str, str, bool, bool, str], bool], window: float,
+                 concurrency: int, max_batch: int):
+        self._write = write
+        self._window = max(0.0, window)
+        self._max_batch = max(1, max_batch)
+        self._pool = ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix="space-writer")
+        self._cond = threading.Condition()
+        self._pending: dict[tuple[str, str], tuple] = {}
+        self._first_at = 0.0
+        self._in_flight = 0       # variazioni del batch in corso di scrittura
+        self._flushing = False    # flush() in corso: i batch partono senza attendere la finestra
+        self.submitted = 0
+        self.coalesced = 0  # variazioni sostituite da una piu' recente dello stesso stallo
+        self.written = 0
+        self.failures = 0
+        self.batch_size = Histogram(SIZE_BUCKETS)
+        self.batch_latency = Histogram(LATENCY_BUCKETS_MS)
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True, name="space-batcher").start()
+
+    def submit(self, lot_id: str, space_id: str, occupied: bool, sensor_online: bool, last_seen_iso: str):
+        key = (lot_id, space_id)
+        with self._cond:
+            self.submitted += 1
+            if key in self._pending:
+                self.coalesced += 1
+            elif not self._pending:
+                self._first_at = time.monotonic()
+            self._pending[key] = (lot_id, space_id, occupied, sensor_online, last_seen_iso)
+            self._cond.notify()
+
+    def flush(self, timeout: float) -> bool:
+        # Invia subito le variazioni in attesa e attende la fine delle scritture (allo spegnimento);
+        # restituisce False se il timeout scade prima
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            self._flushing = True
+            self._cond.notify_all()
+            while self._pending or self._in_flight:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(timeout=remaining)
+            return True
+
+    def stats(self) -> dict:
+        with self._cond:
+            base = {"pending": len(self._pending), "submitted": self.submitted, "coalesced": self.coalesced,
+                    "written": self.written, "failures": self.failures}
+        base["batchSize"] = self.batch_size.snapshot()
+        base["batchLatencyMs"] = self.batch_latency.snapshot()
+        return base
+
+    # ---------- interni ----------
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._pending:
+                        remaining = self._first_at + self._window - time.monotonic()
+                        if remaining <= 0 or len(self._pending) >= self._max_batch or self._flushing:
+                            break
+                        self._cond.wait(timeout=remaining)
+                    else:
+                        self._cond.wait()
+                batch = list(self._pending.values())
+                self._pending = {}
+                self._in_flight = len(batch)
+            start = time.monotonic()
+            results = list(self._pool.map(self._safe_write, batch))
+            self.batch_latency.observe((time.monotonic() - start) * 1000.0)
+            self.batch_size.observe(len(batch))
+            ok = sum(1 for r in results if r)
+            with self._cond:
+                self.written += ok
+                self.failures += len(batch) - ok
+                self._in_flight = 0
+                self._cond.notify_all()
+
+    def _safe_write(self, args: tuple) -> bool:
+        try:
+            return bool(self._write(*args))
+        except Exception as e:
+            log_sampled(log, logging.WARNING, "batch-write", "[BATCH] errore nella scrittura di %s/%s: %s", args[0], args[1], e)
+            return False
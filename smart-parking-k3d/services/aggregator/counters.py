@@ -0,0 +1,177 @@
+# Contatori incrementali di occupazione per lot
+# Ogni transizione di uno stallo aggiorna i contatori in tempo costante, senza ricontare l'intero lot.
+# Lo stesso modulo e' usato dall'aggregatore (stato dei lot) e dalla signage (riepilogo della dashboard).
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+
+class LotCounts:
+    # Contatori di un singolo lot (o dell'intera flotta); free e offline sono derivati
+    __slots__ = ("total", "occupied", "online")
+
+    def __init__(self, total: int = 0, occupied: int = 0, online: int = 0):
+        self.total = total
+        self.occupied = occupied
+        self.online = online
+
+    def add(self, occupied: bool, online: bool, sign: int = 1):
+        self.total += sign
+        self.occupied += sign if occupied else 0
+        self.online += sign if online else 0
+
+    def as_tuple(self) -> Tuple[int, int, int]:
+        return (self.total, self.occupied, self.online)
+
+    def as_dict(self) -> Dict[str, int]:
+        return {
+            "total": self.total,
+            "occupied": self.occupied,
+            "free": max(0, self.total - self.occupied),
+            "online": self.online,
+            "offline": max(0, self.total - self.online),
+        }
+
+
+class OccupancyCounters:
+    # Stato (occupied, online) di ogni stallo e contatori aggregati per lot e per l'intera flotta
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._spaces: Dict[str, Dict[str, Tuple[bool, bool]]] = {}  # lot -> stallo -> (occupied, online)
+        self._lots: Dict[str, LotCounts] = {}
+        self._fleet = LotCounts()
+        self.checks = 0        # verifiche di consistenza eseguite
+        self.drift_found = 0   # verifiche che hanno trovato (e corretto) una deriva
+
+    def update(self, lot_id: str, space_id: str, occupied: bool, online: bool) -> Optional[Dict[str, int]]:
+        # Registra lo stato di uno stallo; restituisce i contatori del lot se sono cambiati, altrimenti None
+        occupied, online = bool(occupied), bool(online)
+        with self._lock:
+            spaces = self._spaces.setdefault(lot_id, {})
+            counts = self._lots.setdefault(lot_id, LotCounts())
+            prev = spaces.get(space_id)
+            if prev == (occupied, online):
+                return None
+            if prev is not None:
+                counts.add(prev[0], prev[1], -1)
+                self._fleet.add(prev[0], prev[1], -1)
+            counts.add(occupied, online)
+            self._fleet.add(occupied, online)
+            spaces[space_id] = (occupied, online)
+            return counts.as_dict()
+
+    def remove(self, lot_id: str, space_id: str) -> Optional[Dict[str, int]]:
+        with self._lock:
+            spaces = self._spaces.get(lot_id)
+            prev = spaces.pop(space_id, None) if spaces is not None else None
+            if prev is None:
+                return None
+            counts = self._lots[lot_id]
+            counts.add(prev[0], prev[1], -1)
+            self._fleet.add(prev[0], prev[1], -1)
+            if not spaces:
+                del self._spaces[lot_id]
+                del self._lots[lot_id]
+                return LotCounts().as_dict()
+            return counts.as_dict()
+
+    def remove_lot(self, lot_id: str) -> List[str]:
+        # Rimuove un lot con tutti i suoi stalli (es. lot non piu' gestito da questa istanza); restituisce gli stalli
+        with self._lock:
+            spaces = self._spaces.pop(lot_id, {})
+            counts = self._lots.pop(lot_id, None)
+            if counts is not None:
+                self._fleet.total -= counts.total
+                self._fleet.occupied -= counts.occupied
+                self._fleet.online -= counts.online
+            return list(spaces)
+
+    def space(self, lot_id: str, space_id: str) -> Optional[Tuple[bool, bool]]:
+        with self._lock:
+            return self._spaces.get(lot_id, {}).get(space_id)
+
+    def lot(self, lot_id: str) -> Dict[str, int]:
+        with self._lock:
+            counts = self._lots.get(lot_id)
+            return counts.as_dict() if counts is not None else LotCounts().as_dict()
+
+    def spaces(self) -> List[Tuple[str, str, bool, bool]]:
+        # Stato di tutti gli stalli come (lot, stallo, occupied, online), ad es. per un checkpoint
+        with self._lock:
+            return [(lot_id, space_id, st[0], st[1])
+                    for lot_id, spaces in self._spaces.items() for space_id, st in spaces.items()]
+
+    def lot_ids(self) -> List[str]:
+        with self._lock:
+            return list(self._lots)
+
+    def fleet(self) -> Dict[str, int]:
+        with self._lock:
+            return self._fleet.as_dict()
+
+    def size(self) -> int:
+        with self._lock:
+            return self._fleet.total
+
+    def self_check(self) -> List[Dict[str, Any]]:
+        # Ricalcola tutti i contatori da zero partendo dallo stato degli stalli.
+        # Restituisce le derive trovate (lot, valore atteso, valore incrementale) e le corregge.
+        drifts: List[Dict[str, Any]] = []
+        with self._lock:
+            fleet = LotCounts()
+            for lot_id, spaces in self._spaces.items():
+                fresh = LotCounts()
+                for occupied, online in spaces.values():
+                    fresh.add(occupied, online)
+                fleet.total += fresh.total
+                fleet.occupied += fresh.occupied
+                fleet.online += fresh.online
+                cur = self._lots.get(lot_id)
+                if cur is None or cur.as_tuple() != fresh.as_tuple():
+                    drifts.append({"lot": lot_id, "expected": fresh.as_dict(),
+                                   "actual": cur.as_dict() if cur is not None else None})
+                    self._lots[lot_id] = fresh
+            for lot_id in [l for l in self._lots if l not in self._spaces]:
+                drifts.append({"lot": lot_id, "expected": None, "actual": self._lots.pop(lot_id).as_dict()})
+            if fleet.as_tuple() != self._fleet.as_tuple():
+                drifts.append({"lot": "*", "expected": fleet.as_dict(), "actual": self._fleet.as_dict()})
+                self._fleet = fleet
+            self.checks += 1
+            if drifts:
+                self.drift_found += 1
+        return drifts
+
+
+class LotTotals:
+    # Somme incrementali dei campi numerici dei ParkingLot (totalSpaces, occupied, free) su tutti i lot
+
+    FIELDS = ("totalSpaces", "occupied", "free")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.count = 0
+        self.sums = {f: 0 for f in self.FIELDS}
+
+    def apply(self, prev: Optional[Dict[str, Any]], obj: Optional[Dict[str, Any]]):
+        # Sostituisce il contributo di prev (None = lot nuovo) con quello di obj (None = lot eliminato)
+        with self._lock:
+            if prev is not None:
+                self.count -= 1
+                for f in self.FIELDS:
+                    self.sums[f] -= int(prev.get(f, 0) or 0)
+            if obj is not None:
+                self.count += 1
+                for f in self.FIELDS:
+                    self.sums[f] += int(obj.get(f, 0) or 0)
+
+    def snapshot(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self.sums, count=self.count)
+
+    def check(self, objs: List[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        # Confronta le somme incrementali con quelle ricalcolate da objs; restituisce la deriva (o None).
+        # Non corregge: objs puo' essere gia' superato da un apply concorrente.
+        expected = {f: sum(int(o.get(f, 0) or 0) for o in objs) for f in self.FIELDS}
+        expected["count"] = len(objs)
+        actual = self.snapshot()
+        return None if actual == expected else {"expected": expected, "actual": actual}
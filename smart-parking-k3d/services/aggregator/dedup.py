@@ -0,0 +1,84 @@
+# Deduplicazione delle scritture di stato dei ParkingSpace
+# I sensori ripubblicano lo stato periodicamente anche quando non cambia (heartbeat): si scrive solo
+# quando (occupied, sensorOnline) cambia oppure quando e' ora di rinfrescare lastSeen.
+# Il confronto avviene con l'ultimo stato inviato allo scrittore (submit), non con l'ultimo scritto: con il
+# batching una scrittura puo' essere in coda o in volo, e un messaggio che riporta lo stallo al valore
+# precedente deve comunque essere scritto. Una scrittura fallita viene annullata (rollback).
+# Accanto all'ultimo stato inviato si tiene l'ultimo stato confermato (scritto o letto dall'API server):
+# e' quello che finisce nello snapshot, perche' una scrittura in coda al momento del checkpoint puo' non
+# avvenire mai.
+import threading
+import time
+
+
+class SpaceStatusFilter:
+    # Ricorda l'ultimo stato inviato (o scritto) per ogni ParkingSpace
+    # lastseen_refresh: secondi dopo i quali uno stato invariato viene riscritto per aggiornare lastSeen
+
+    def __init__(self, lastseen_refresh: float):
+        self._refresh = max(0.0, lastseen_refresh)
+        self._lock = threading.Lock()
+        self._last: dict[str, tuple[bool, bool, float]] = {}  # nome -> (occupied, sensorOnline, istante invio)
+        self._confirmed: dict[str, tuple[bool, bool]] = {}     # nome -> ultimo stato scritto (occupied, sensorOnline)
+        self.written = 0     # scritture eseguite
+        self.suppressed = 0  # scritture evitate
+
+    def should_write(self, name: str, occupied: bool, sensor_online: bool, now: float | None = None) -> bool:
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            prev = self._last.get(name)
+            if prev is not None and prev[0] == occupied and prev[1] == sensor_online and now - prev[2] < self._refresh:
+                self.suppressed += 1
+                return False
+            return True
+
+    def submit(self, name: str, occupied: bool, sensor_online: bool, now: float | None = None):
+        # Da chiamare quando lo stato viene inviato allo scrittore (prima che la scrittura sia eseguita)
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self._last[name] = (occupied, sensor_online, now)
+
+    def record(self, name: str, occupied: bool, sensor_online: bool, now: float | None = None):
+        # Da chiamare dopo una scrittura riuscita; se nel frattempo e' stato inviato uno stato diverso resta quello
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            prev = self._last.get(name)
+            if prev is None or (prev[0], prev[1]) == (occupied, sensor_online):
+                self._last[name] = (occupied, sensor_online, now)
+            self._confirmed[name] = (occupied, sensor_online)
+            self.written += 1
+
+    def rollback(self, name: str, occupied: bool, sensor_online: bool):
+        # Da chiamare dopo una scrittura fallita: se lo stato inviato e' ancora l'ultimo viene dimenticato,
+        # cosi' il messaggio successivo dello stallo viene riscritto anche se uguale
+        with self._lock:
+            prev = self._last.get(name)
+            if prev is not None and (prev[0], prev[1]) == (occupied, sensor_online):
+                del self._last[name]
+
+    def seed(self, name: str, occupied: bool, sensor_online: bool, now: float | None = None):
+        # Stato gia' presente sull'API server (letto all'avvio): non conta come scrittura
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self._last[name] = (occupied, sensor_online, now)
+            self._confirmed[name] = (occupied, sensor_online)
+
+    def export(self) -> dict[str, tuple[bool, bool]]:
+        # Solo gli stati confermati: quelli inviati e non ancora scritti verranno riscritti dopo il riavvio
+        with self._lock:
+            return dict(self._confirmed)
+
+    def forget(self, name: str):
+        with self._lock:
+            self._last.pop(name, None)
+            self._confirmed.pop(name, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            seen = self.written + self.suppressed
+            return {
+                "spaces": len(self._last),
+                "written": self.written,
+                "suppressed": self.suppressed,
+                "suppressionRatio": self.suppressed / seen if seen else 0.0,
+            }
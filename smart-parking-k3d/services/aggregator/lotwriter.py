@@ -0,0 +1,154 @@
+# Scrittore coalescente e rate-limited dello stato dei ParkingLot
+# Le variazioni di {occupied, free, offline} marcano il lot come "sporco"; la scrittura verso l'API server
+# avviene al massimo una volta per intervallo per lot, cosi' il carico dipende dal numero di lot
+# e non dal numero di messaggi MQTT. Le PATCH sono eseguite solo dai thread flusher: mark() non fa I/O
+# e puo' essere chiamata mentre si tiene il lock dello stato dei lot.
+import threading
+import time
+from typing import Callable
+
+
+class LotStatusWriter:
+    # publish(lot_id, occupied, free, offline) -> bool esegue la PATCH vera e propria (True = scritta)
+    # interval: intervallo minimo in secondi tra due scritture dello stesso lot (0 = appena possibile)
+    # flush_on_change: se True una variazione viene scritta subito quando il lot non e' nel periodo di attesa,
+    #                  altrimenti attende sempre un intervallo intero per accorpare le variazioni successive
+    # threads: numero di thread flusher (lot diversi vengono scritti in parallelo)
+
+    def __init__(self, publish: Callable[[str, int, int, int], bool], interval: float,
+                 flush_on_change: bool = True, threads: int = 1):
+        self._publish = publish
+        self._interval = max(0.0, interval)
+        self._flush_on_change = flush_on_change
+        self._threads = max(1, threads)
+        self._cond = threading.Condition()
+        self._pending: dict[str, tuple[int, int, int]] = {}   # lot -> valore in attesa di scrittura
+        self._dirty_since: dict[str, float] = {}         # lot -> istante in cui e' diventato sporco
+        self._written: dict[str, tuple[int, int, int]] = {}   # lot -> ultimo valore scritto
+        self._last_flush: dict[str, float] = {}          # lot -> istante (monotonic) dell'ultima scrittura
+        self._inflight: set[str] = set()                 # lot con una scrittura in corso
+        self._flushing = False                           # flush() in corso: nessuna attesa del rate-limit
+        self.flushes = 0      # PATCH inviate
+        self.suppressed = 0   # aggiornamenti scartati perche' uguali all'ultimo valore scritto
+        self.coalesced = 0    # aggiornamenti sostituiti da uno piu' recente prima della scrittura
+        self.failures = 0     # PATCH fallite (verranno ritentate)
+
+    def start(self):
+        for i in range(self._threads):
+            threading.Thread(target=self._run, daemon=True, name=f"lot-writer-{i}").start()
+
+    def mark(self, lot_id: str, occupied: int, free: int, offline: int = 0):
+        # Registra il nuovo valore del lot; la scrittura avviene nel flusher quando il rate-limit lo consente
+        value = (int(occupied), int(free), int(offline))
+        with self._cond:
+            if self._written.get(lot_id) == value and lot_id not in self._inflight:
+                # Valore invariato (o variazione rientrata prima della scrittura)
+                self._pending.pop(lot_id, None)
+                self._dirty_since.pop(lot_id, None)
+                self.suppressed += 1
+                return
+            if lot_id in self._pending:
+                self.coalesced += 1
+            else:
+                self._dirty_since[lot_id] = time.monotonic()
+            self._pending[lot_id] = value
+            self._cond.notify()
+
+    def seed(self, lot_id: str, occupied: int, free: int, offline: int = 0):
+        # Valore gia' presente sull'API server (letto all'avvio): un mark() uguale non genera scritture
+        with self._cond:
+            self._written[lot_id] = (int(occupied), int(free), int(offline))
+
+    def flush(self, timeout: float) -> bool:
+        # Scrive subito tutti i lot sporchi e attende la fine delle PATCH (allo spegnimento); le scritture
+        # fallite vengono ritentate fino al timeout. Restituisce False se restano lot da scrivere
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            self._flushing = True
+            self._cond.notify_all()
+            while self._pending or self._inflight:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(timeout=remaining)
+            return True
+
+    def written(self) -> dict[str, tuple[int, int, int]]:
+        with self._cond:
+            return dict(self._written)
+
+    def forget(self, lot_id: str):
+        # Dimentica l'ultimo valore scritto (es. lot ricreato o non piu' gestito da questa istanza)
+        with self._cond:
+            self._written.pop(lot_id, None)
+            self._pending.pop(lot_id, None)
+            self._dirty_since.pop(lot_id, None)
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "lots": len(self._written),
+                "pending": len(self._pending),
+                "flushes": self.flushes,
+                "suppressed": self.suppressed,
+                "coalesced": self.coalesced,
+                "failures": self.failures,
+            }
+
+    # ---------- interni ----------
+    def _due(self, lot_id: str) -> float:
+        # Istante a partire dal quale il lot puo' essere scritto
+        if self._flushing:
+            return float("-inf")
+        due = self._last_flush.get(lot_id, float("-inf")) + self._interval
+        if not self._flush_on_change:
+            due = max(due, self._dirty_since.get(lot_id, 0.0) + self._interval)
+        return due
+
+    def _write(self, lot_id: str, value: tuple[int, int, int]):
+        ok = False
+        try:
+            ok = bool(self._publish(lot_id, *value))
+        finally:
+            with self._cond:
+                self._inflight.discard(lot_id)
+                if ok:
+                    self.flushes += 1
+                    self._written[lot_id] = value
+                else:
+                    self.failures += 1
+                    if lot_id not in self._pending:
+                        self._pending[lot_id] = value
+                        self._dirty_since[lot_id] = time.monotonic()
+                if self._pending.get(lot_id) == self._written.get(lot_id):
+                    # Variazione rientrata mentre la PATCH era in corso
+                    self._pending.pop(lot_id, None)
+                    self._dirty_since.pop(lot_id, None)
+                if self._flushing:
+                    self._cond.notify_all()
+                elif lot_id in self._pending:
+                    self._cond.notify()
+
+    def _run(self):
+        # Flusher: prende un lot sporco appena scade il suo periodo di attesa e lo scrive
+        while True:
+            with self._cond:
+                now = time.monotonic()
+                wait = None
+                picked = None
+                for lot_id in self._pending:
+                    if lot_id in self._inflight:
+                        continue
+                    due = self._due(lot_id)
+                    if due <= now:
+                        picked = lot_id
+                        break
+                    wait = due - now if wait is None else min(wait, due - now)
+                if picked is None:
+                    self._cond.wait(timeout=wait)
+                    continue
+                value = self._pending.pop(picked)
+                self._dirty_since.pop(picked, None)
+                self._inflight.add(picked)
+                self._last_flush[picked] = now
+            self._write(picked, value)
@@ -2,13 +2,32 @@
 # Riceve i messaggi MQTT dai sensori e aggiorna le CRD Kubernetes ParkingSpace/ParkingLot
 import os
 import json
+import logging
+import signal
+import socket
+import struct
+import sys
 import time
+import threading
 from datetime import datetime, timezone
+from functools import lru_cache
 
 import paho.mqtt.client as mqtt
 from kubernetes import client as k8s_client
 from kubernetes.client.rest import ApiException
 from kube import load_kube_config_safely
+from registry import KnownObjects
+from lotwriter import LotStatusWriter
+from pipeline import IngestPipeline
+from dedup import SpaceStatusFilter
+from batcher import SpaceStatusBatcher
+from counters import OccupancyCounters
+from snapshot import load_snapshot, save_snapshot
+from sharding import MEMBERS_TOPIC, ShardCoordinator
+from staleness import StalenessWheel
+from payload import BINARY_VERSION, LOT_TOPICS, decode_json, decode_v1
+from metrics import (JSON_DECODE_SECONDS, MQTT_MESSAGES, PAYLOAD_ERRORS, SENSORS_STALE, gauge, instrument_k8s, log_sampled,
+                     setup_logging, start_metrics_server, topic_class)
 
 # === Configurazione ===
 BROKER_HOST = os.getenv("BROKER_HOST", "mosquitto")  # Host del broker MQTT
@@ -24,20 +43,86 @@ MQTT_KEY  = os.getenv("MQTT_KEY", "/etc/mqtt/client.key")
 NAMESPACE = os.getenv("NAMESPACE", os.getenv("POD_NAMESPACE", "smart-parking")) # Namespace K8s
 GROUP = "parking.smart"    # Gruppo CRD
 VERSION = "v1alpha1"      # Versione CRD
+FIELD_MANAGER = "smart-parking-aggregator" # Field manager per il server-side apply
+
+# Scrittura stato ParkingLot
+LOT_FLUSH_INTERVAL = float(os.getenv("LOT_FLUSH_INTERVAL_MS", "500")) / 1000.0 # Intervallo minimo tra due PATCH dello stesso lot (0 = ogni messaggio)
+LOT_FLUSH_ON_CHANGE = os.getenv("LOT_FLUSH_ON_CHANGE", "1") == "1"             # Scrive subito una variazione se il lot non e' in attesa
+LOT_WRITER_THREADS = int(os.getenv("LOT_WRITER_THREADS", "2"))                 # Thread che eseguono le PATCH dei lot
+
+# Scrittura stato ParkingSpace
+LASTSEEN_REFRESH = float(os.getenv("LASTSEEN_REFRESH", "30")) # Secondi dopo i quali uno stato invariato viene riscritto per aggiornare lastSeen
+SPACE_BATCH_WINDOW = float(os.getenv("SPACE_BATCH_WINDOW_MS", "50")) / 1000.0 # Finestra di raccolta delle variazioni (0 = scrittura immediata)
+SPACE_BATCH_CONCURRENCY = int(os.getenv("SPACE_BATCH_CONCURRENCY", "16"))      # Scritture parallele per batch
+SPACE_BATCH_MAX = int(os.getenv("SPACE_BATCH_MAX", "500"))                     # Dimensione massima di un batch
+
+# Pipeline di ingest (I/O Kubernetes fuori dal thread di rete MQTT)
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "4"))          # Worker che processano i messaggi (0 = nel thread MQTT)
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", "10000")) # Capienza complessiva delle code
+INGEST_QUEUE_POLICY = os.getenv("INGEST_QUEUE_POLICY", "block")  # Coda piena: "block" oppure "drop-oldest"
+
+# Contatori dei lot
+COUNTERS_CHECK_INTERVAL = float(os.getenv("COUNTERS_CHECK_INTERVAL", "300")) # Secondi tra due verifiche di consistenza dei contatori (0 = disabilitato)
+
+# Sensori silenziosi: oltre alla Last Will, uno stallo che non pubblica per SENSOR_STALE_AFTER secondi va offline
+SENSOR_STALE_AFTER = float(os.getenv("SENSOR_STALE_AFTER", "120")) # Secondi senza messaggi prima di segnare lo stallo offline (0 = solo Last Will)
+SENSOR_STALE_TICK = float(os.getenv("SENSOR_STALE_TICK", "1"))     # Secondi tra due controlli delle scadenze
+SENSOR_STALE_BUDGET = int(os.getenv("SENSOR_STALE_BUDGET", "2000")) # Scadenze esaminate al massimo per controllo
+
+# Ripristino dello stato all'avvio
+SNAPSHOT_PATH = os.getenv("SNAPSHOT_PATH", "")                          # File di checkpoint dello stato ("" = disabilitato)
+SNAPSHOT_INTERVAL = float(os.getenv("SNAPSHOT_INTERVAL", "30"))         # Secondi tra due checkpoint
+SNAPSHOT_MAX_AGE = float(os.getenv("SNAPSHOT_MAX_AGE", "3600"))         # Eta' massima di uno snapshot utilizzabile (0 = nessun limite)
+SHUTDOWN_TIMEOUT = float(os.getenv("SHUTDOWN_TIMEOUT", "20"))           # Secondi per completare le scritture in sospeso su SIGTERM
+
+# Repliche: con SHARD_MODE=hash i lot sono partizionati tra le repliche con un hash consistente
+SHARD_MODE = os.getenv("SHARD_MODE", "off")                                   # "off" (una sola replica) oppure "hash"
+REPLICA_ID = os.getenv("REPLICA_ID", f"{socket.gethostname()}-{os.getpid()}") # Identificativo univoco della replica
+SHARD_HANDOFF_DELAY = float(os.getenv("SHARD_HANDOFF_DELAY", "5"))           # Secondi di attesa prima di gestire i lot acquisiti
+SHARD_VNODES = int(os.getenv("SHARD_VNODES", "64"))                          # Punti sull'anello di hash per replica
+SHARD_MEMBER_TTL = float(os.getenv("SHARD_MEMBER_TTL", "60"))                # Secondi senza annunci dopo i quali una replica e' considerata uscita
+
+# Stato dei sensori: JSON su .../status, formato binario compatto su .../status/v1 (vedi payload.py)
+STATUS_TOPICS = [("parking/+/+/status", 1), (f"parking/+/+/status/{BINARY_VERSION}", 1)]
+
+# Con SHARD_MODE=hash i topic di stato sono sottoscritti lot per lot
+def lot_status_topics(lot_id: str):
+    return [(f"parking/{lot_id}/+/status", 1), (f"parking/{lot_id}/+/status/{BINARY_VERSION}", 1)]
+
+# Statistiche e metriche
+STATS_INTERVAL = float(os.getenv("STATS_INTERVAL", "60")) # Secondi tra due log delle statistiche (0 = disabilitato)
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))     # Porta di /metrics (0 = disabilitato)
+
+log = setup_logging("aggregator")
 
 # === Inizializza client Kubernetes ===
 load_kube_config_safely()
-crd = k8s_client.CustomObjectsApi()
+# Il pool di connessioni urllib3 viene dimensionato sul numero di thread che scrivono in parallelo
+_kube_cfg = k8s_client.Configuration.get_default_copy()
+_kube_cfg.connection_pool_maxsize = max(_kube_cfg.connection_pool_maxsize or 0,
+                                        SPACE_BATCH_CONCURRENCY + LOT_WRITER_THREADS + INGEST_WORKERS)
+crd = k8s_client.CustomObjectsApi(instrument_k8s(k8s_client.ApiClient(_kube_cfg)))
+
+# Registro degli oggetti CRD gia' esistenti (evita create/GET ripetute sul percorso caldo)
+known = KnownObjects()
 
 def now_iso():
     return datetime.now(timezone.utc).isoformat()
 
+# lastSeen dei messaggi: i ts hanno risoluzione di un secondo e arrivano quasi in ordine, la conversione
+# viene fatta una volta per secondo invece che per messaggio
+@lru_cache(maxsize=64)
+def ts_iso(ts: int) -> str:
+    return datetime.fromtimestamp(ts, tz=timezone.utc).isoformat()
+
 # ---------- CRD helpers ----------
 # Funzioni helper per creare/patchare ParkingLot
 # ensure_parkinglot: crea la risorsa ParkingLot se non esiste, aggiorna totalSpaces se necessario
-# upsert_parkinglot_status: aggiorna lo stato (occupied, free, lastUpdate) della risorsa ParkingLot
+# upsert_parkinglot_status: aggiorna lo stato (occupied, free, offline, lastUpdate) della risorsa ParkingLot
 def ensure_parkinglot(lot_id: str, total_spaces: int | None = None):
     name = lot_id.lower()
+    if known.lot_is_current(name, total_spaces):
+        return
     body = {
         "apiVersion": f"{GROUP}/{VERSION}",
         "kind": "ParkingLot",
@@ -47,48 +132,64 @@ def ensure_parkinglot(lot_id: str, total_spaces: int | None = None):
     try:
         try:
             crd.create_namespaced_custom_object(GROUP, VERSION, NAMESPACE, "parkinglots", body)
-            print(f"[CRD] ParkingLot creato: {name}")
+            known.remember_lot(name, total_spaces)
+            log_sampled(log, logging.INFO, "crd-create-lot", "[CRD] ParkingLot creato: %s", name)
         except ApiException as e:
             if e.status == 409:
+                known.remember_lot(name, None)
                 if total_spaces is not None:
                     try:
                         cur = crd.get_namespaced_custom_object(GROUP, VERSION, NAMESPACE, "parkinglots", name)
                         cur_spec = cur.get("spec", {})
                         cur_total = int(cur_spec.get("totalSpaces", 0))
+                        known.remember_lot(name, cur_total)
                         if total_spaces > cur_total:
                             patch = {"spec": {"totalSpaces": int(total_spaces)}}
                             crd.patch_namespaced_custom_object(GROUP, VERSION, NAMESPACE, "parkinglots", name, patch)
+                            known.remember_lot(name, total_spaces)
                     except Exception as e2:
-                        print("[CRD] errore nel patchare lot spec.totalSpaces:", e2)
+                        log_sampled(log, logging.WARNING, "crd-lot-spec", "[CRD] errore nel patchare lot spec.totalSpaces: %s", e2)
             else:
                 raise
     except Exception as e:
-        print("[CRD] errore in ensure_parkinglot:", e)
+        log_sampled(log, logging.WARNING, "crd-ensure-lot", "[CRD] errore in ensure_parkinglot: %s", e)
 
-def upsert_parkinglot_status(lot_id: str, occupied: int, free: int):
+# Restituisce True se lo stato e' stato scritto
+def upsert_parkinglot_status(lot_id: str, occupied: int, free: int, offline: int) -> bool:
     name = lot_id.lower()
-    status = {"occupied": int(occupied), "free": int(free), "lastUpdate": now_iso()}
+    status = {"occupied": int(occupied), "free": int(free), "offline": int(offline), "lastUpdate": now_iso()}
     try:
         crd.patch_namespaced_custom_object_status(
             GROUP, VERSION, NAMESPACE, "parkinglots", name, {"status": status}
         )
+        return True
     except ApiException as e:
         if e.status == 404:
+            known.forget_lot(name)
             ensure_parkinglot(lot_id, occupied + free)
             try:
                 crd.patch_namespaced_custom_object_status(
                     GROUP, VERSION, NAMESPACE, "parkinglots", name, {"status": status}
                 )
+                return True
             except Exception as e2:
-                print("[CRD] errore nel patchare lo stato del lot dopo la creazione:", e2)
+                log_sampled(log, logging.WARNING, "crd-lot-status", "[CRD] errore nel patchare lo stato del lot dopo la creazione: %s", e2)
         else:
-            print("[CRD] errore nel patchare lo stato del lot:", e)
+            log_sampled(log, logging.WARNING, "crd-lot-status", "[CRD] errore nel patchare lo stato del lot: %s", e)
+    except Exception as e:
+        log_sampled(log, logging.WARNING, "crd-lot-status", "[CRD] errore nel patchare lo stato del lot: %s", e)
+    return False
+
+# Scrittore coalescente: al massimo una PATCH per lot ogni LOT_FLUSH_INTERVAL, nessuna se {occupied, free} non cambia
+lot_writer = LotStatusWriter(upsert_parkinglot_status, LOT_FLUSH_INTERVAL, LOT_FLUSH_ON_CHANGE, LOT_WRITER_THREADS)
 
 # Funzioni helper per creare/patchare ParkingSpace
 # ensure_parkingspace: crea la risorsa ParkingSpace se non esiste
 # upsert_parkingspace_status: aggiorna lo stato (occupied, sensorOnline, lastSeen) della risorsa ParkingSpace
 def ensure_parkingspace(lot_id: str, space_id: str):
     name = f"{lot_id}-{space_id}".lower()
+    if known.has_space(name):
+        return
     body = {
         "apiVersion": f"{GROUP}/{VERSION}",
         "kind": "ParkingSpace",
@@ -98,78 +199,541 @@ def ensure_parkingspace(lot_id: str, space_id: str):
     try:
         try:
             crd.create_namespaced_custom_object(GROUP, VERSION, NAMESPACE, "parkingspaces", body)
-            print(f"[CRD] ParkingSpace creato: {name}")
+            known.remember_space(name)
+            log_sampled(log, logging.INFO, "crd-create-space", "[CRD] ParkingSpace creato: %s", name)
         except ApiException as e:
             if e.status != 409:
                 raise
+            known.remember_space(name)
     except Exception as e:
-        print("[CRD] errore in ensure_parkingspace:", e)
+        log_sampled(log, logging.WARNING, "crd-ensure-space", "[CRD] errore in ensure_parkingspace: %s", e)
+
+# Server-side apply sulla sottorisorsa status (il client generato supporta solo merge-patch)
+def apply_status(plural: str, kind: str, name: str, status: dict):
+    body = {
+        "apiVersion": f"{GROUP}/{VERSION}",
+        "kind": kind,
+        "metadata": {"name": name},
+        "status": status,
+    }
+    return crd.api_client.call_api(
+        "/apis/{group}/{version}/namespaces/{namespace}/{plural}/{name}/status", "PATCH",
+        path_params={"group": GROUP, "version": VERSION, "namespace": NAMESPACE, "plural": plural, "name": name},
+        query_params=[("fieldManager", FIELD_MANAGER), ("force", "true")],
+        header_params={"Accept": "application/json", "Content-Type": "application/apply-patch+yaml"},
+        body=body,
+        response_type="object",
+        auth_settings=["BearerToken"],
+        _return_http_data_only=True,
+    )
 
-def upsert_parkingspace_status(lot_id: str, space_id: str, occupied: bool, sensor_online: bool, last_seen_iso: str):
+# Scrive lo stato di un ParkingSpace; restituisce True se la scrittura e' riuscita
+# Le scritture riuscite vengono confermate a space_filter, quelle fallite annullate
+def write_parkingspace_status(lot_id: str, space_id: str, occupied: bool, sensor_online: bool, last_seen_iso: str) -> bool:
     name = f"{lot_id}-{space_id}".lower()
     status = {"occupied": bool(occupied), "sensorOnline": bool(sensor_online), "lastSeen": last_seen_iso}
     try:
-        crd.patch_namespaced_custom_object_status(
-            GROUP, VERSION, NAMESPACE, "parkingspaces", name, {"status": status}
-        )
+        apply_status("parkingspaces", "ParkingSpace", name, status)
+        space_filter.record(name, bool(occupied), bool(sensor_online))
+        return True
     except ApiException as e:
         if e.status == 404:
+            known.forget_space(name)
             ensure_parkingspace(lot_id, space_id)
             try:
-                crd.patch_namespaced_custom_object_status(
-                    GROUP, VERSION, NAMESPACE, "parkingspaces", name, {"status": status}
-                )
+                apply_status("parkingspaces", "ParkingSpace", name, status)
+                space_filter.record(name, bool(occupied), bool(sensor_online))
+                return True
             except Exception as e2:
-                print("[CRD] errore nel patchare lo stato dello spazio dopo la creazione:", e2)
+                log_sampled(log, logging.WARNING, "crd-space-status", "[CRD] errore nel patchare lo stato dello spazio dopo la creazione: %s", e2)
         else:
-            print("[CRD] errore nel patchare lo stato dello spazio:", e)
+            log_sampled(log, logging.WARNING, "crd-space-status", "[CRD] errore nel patchare lo stato dello spazio: %s", e)
+    except Exception as e:
+        log_sampled(log, logging.WARNING, "crd-space-status", "[CRD] errore nel patchare lo stato dello spazio: %s", e)
+    space_filter.rollback(name, bool(occupied), bool(sensor_online))
+    return False
+
+# Ultimo stato inviato per ogni ParkingSpace: gli heartbeat invariati non generano PATCH
+space_filter = SpaceStatusFilter(LASTSEEN_REFRESH)
+
+# Variazioni degli stalli raccolte in batch e scritte in parallelo (None = scrittura immediata)
+space_batcher = (SpaceStatusBatcher(write_parkingspace_status, SPACE_BATCH_WINDOW, SPACE_BATCH_CONCURRENCY, SPACE_BATCH_MAX)
+                 if SPACE_BATCH_WINDOW > 0 else None)
+
+# Aggiorna lo stato di un ParkingSpace: con il batching attivo la variazione viene accodata
+# e la funzione restituisce True appena accettata. Lo stato viene registrato in space_filter all'invio,
+# cosi' i messaggi successivi si confrontano con la variazione in coda o in volo
+def upsert_parkingspace_status(lot_id: str, space_id: str, occupied: bool, sensor_online: bool, last_seen_iso: str) -> bool:
+    space_filter.submit(f"{lot_id}-{space_id}".lower(), bool(occupied), bool(sensor_online))
+    if space_batcher is None:
+        return write_parkingspace_status(lot_id, space_id, occupied, sensor_online, last_seen_iso)
+    space_batcher.submit(lot_id, space_id, occupied, sensor_online, last_seen_iso)
+    return True
 
 # ---------- Stato per-lot ----------
-lot_state: dict[str, dict[str, bool]] = {}
+# Contatori incrementali per lot (occupied/online per stallo), condivisi tra i worker della pipeline
+lot_counters = OccupancyCounters()
+state_lock = threading.Lock()
+
+# Aggiorna lo stato di uno stallo e pubblica i contatori del lot se sono cambiati (costo O(1) per messaggio)
+def update_space_state(lot_id: str, space_id: str, occupied: bool, sensor_online: bool):
+    # Aggiornamento e marcatura avvengono sotto lock, cosi' il writer riceve i valori nell'ordine giusto
+    with state_lock:
+        counts = lot_counters.update(lot_id, space_id, occupied, sensor_online)
+        if counts is None:
+            return
+        lot_writer.mark(lot_id, counts["occupied"], counts["free"], counts["offline"])
+
+    ensure_parkinglot(lot_id, counts["total"])
+
+# Scadenze degli stalli online (None = offline solo tramite Last Will)
+staleness = StalenessWheel(SENSOR_STALE_AFTER, SENSOR_STALE_TICK, SENSOR_STALE_BUDGET) if SENSOR_STALE_AFTER > 0 else None
+
+# ---------- Ripristino dello stato ----------
+# All'avvio lo stato di ogni stallo viene ricostruito da una sola LIST dei ParkingSpace (o, se l'API server
+# non risponde, dall'ultimo snapshot locale). I contatori sono quindi corretti da subito e i messaggi
+# retained ricevuti alla sottoscrizione vengono confrontati con questo stato: solo gli stalli cambiati
+# mentre l'aggregatore era fermo generano scritture.
+def restore_state(spaces: list, written: dict, lots: dict, source: str, keep=None):
+    # spaces: [(lot, stallo, occupied, online)], written: {nome stallo: (occupied, online)},
+    # lots: {lot: (occupied, free, offline)} (gli snapshot precedenti non hanno offline)
+    # keep(lot) -> bool limita il ripristino ai lot indicati (lot acquisiti da questa replica)
+    if keep is not None:
+        spaces = [s for s in spaces if keep(s[0])]
+        names = {f"{s[0]}-{s[1]}".lower() for s in spaces}
+        written = {name: v for name, v in written.items() if name in names}
+        lots = {lot_id: v for lot_id, v in lots.items() if keep(lot_id)}
+    now = time.monotonic()
+    repaired = 0
+    with state_lock:
+        for lot_id, space_id, occupied, sensor_online in spaces:
+            lot_counters.update(lot_id, space_id, occupied, sensor_online)
+            # Uno stallo online che non pubblica piu' dopo il riavvio scade come gli altri
+            if staleness is not None and sensor_online:
+                staleness.touch((lot_id, space_id), int(time.time()))
+        for name, (occupied, sensor_online) in written.items():
+            space_filter.seed(name, bool(occupied), bool(sensor_online), now)
+        for lot_id, value in lots.items():
+            lot_writer.seed(lot_id, *value)
+        # Lot il cui stato non corrisponde agli stalli (es. crash tra la scrittura dello stallo e quella del lot)
+        for lot_id in lot_counters.lot_ids():
+            if keep is not None and not keep(lot_id):
+                continue
+            counts = lot_counters.lot(lot_id)
+            if tuple(lots.get(lot_id, ())) != (counts["occupied"], counts["free"], counts["offline"]):
+                lot_writer.mark(lot_id, counts["occupied"], counts["free"], counts["offline"])
+                repaired += 1
+    log.info(f"[STATE] stato ripristinato da {source}: {len(spaces)} stalli, {len(lots)} lot, {repaired} lot da riallineare")
+
+def restore_from_list(lot_items: list, space_items: list, keep=None):
+    spaces, written, lots = [], {}, {}
+    for item in space_items:
+        name = (item.get("metadata") or {}).get("name")
+        spec = item.get("spec") or {}
+        status = item.get("status") or {}
+        # Gli stalli senza stato non sono mai stati scritti: li popolera' il traffico
+        if not name or not spec.get("lotId") or not spec.get("spaceId") or "occupied" not in status:
+            continue
+        occupied, sensor_online = bool(status.get("occupied")), bool(status.get("sensorOnline", False))
+        spaces.append((spec["lotId"], spec["spaceId"], occupied, sensor_online))
+        written[name] = (occupied, sensor_online)
+    for item in lot_items:
+        spec = item.get("spec") or {}
+        status = item.get("status") or {}
+        if spec.get("lotId") and "occupied" in status:
+            lots[spec["lotId"]] = (int(status.get("occupied", 0) or 0), int(status.get("free", 0) or 0),
+                                   int(status.get("offline", 0) or 0))
+    restore_state(spaces, written, lots, "LIST", keep)
+
+def restore_from_snapshot():
+    if not SNAPSHOT_PATH:
+        return
+    try:
+        snap = load_snapshot(SNAPSHOT_PATH, SNAPSHOT_MAX_AGE)
+    except Exception as e:
+        log.warning(f"[STATE] snapshot non leggibile: {e}")
+        return
+    if snap is None:
+        log.info(f"[STATE] nessuno snapshot utilizzabile in {SNAPSHOT_PATH}")
+        return
+    restore_state([tuple(s) for s in snap.get("spaces", [])], snap.get("written", {}),
+                  snap.get("lots", {}), f"snapshot ({snap['age']:.0f}s fa)")
+
+# Popola il registro degli oggetti noti e lo stato degli stalli con una sola LIST per tipo
+# (all'avvio oppure, con SHARD_MODE=hash, per i lot acquisiti a ogni ribilanciamento)
+def seed_state(keep=None):
+    try:
+        lots = crd.list_namespaced_custom_object(GROUP, VERSION, NAMESPACE, "parkinglots")
+        spaces = crd.list_namespaced_custom_object(GROUP, VERSION, NAMESPACE, "parkingspaces")
+    except Exception as e:
+        log.warning(f"[CACHE] LIST iniziale fallita, il registro si popolera' dal traffico: {e}")
+        # Con SHARD_MODE=hash lo snapshot locale puo' essere superato dalle scritture di un'altra replica:
+        # lo stato dei lot acquisiti viene ricostruito dai messaggi retained
+        if keep is None:
+            restore_from_snapshot()
+        return
+    known.seed(lots.get("items", []), spaces.get("items", []))
+    if shard is not None:
+        register_lots(item["spec"]["lotId"] for item in lots.get("items", []) if item.get("spec", {}).get("lotId"))
+    st = known.stats()
+    log.info(f"[CACHE] registro inizializzato: {st['lots']} ParkingLot, {st['spaces']} ParkingSpace")
+    restore_from_list(lots.get("items", []), spaces.get("items", []), keep)
+
+# Checkpoint dello stato su file
+def write_snapshot():
+    with state_lock:
+        spaces = lot_counters.spaces()
+    size = save_snapshot(SNAPSHOT_PATH, spaces, space_filter.export(), lot_writer.written())
+    return len(spaces), size
+
+def snapshot_loop():
+    while True:
+        time.sleep(SNAPSHOT_INTERVAL)
+        try:
+            write_snapshot()
+        except Exception as e:
+            log.warning(f"[STATE] errore nella scrittura dello snapshot: {e}")
+
+# Su SIGTERM (rolling update, drain del nodo) lascia il gruppo delle repliche, smette di ricevere messaggi,
+# completa le scritture in sospeso (pipeline, batch degli stalli, lot) e salva un ultimo snapshot
+def on_sigterm(_signum, _frame):
+    if mqtt_client is not None:
+        if shard is not None:
+            # Uscita esplicita: le altre repliche prendono in carico i lot senza attendere la Last Will
+            mqtt_client.publish(shard.presence_topic, b"", qos=1, retain=True)
+            log.info("[SHARD] replica uscita dal gruppo")
+        mqtt_client.disconnect()
+    # Il gestore gira nel thread principale, lo stesso di loop_forever: dopo disconnect() non arrivano altri messaggi
+    deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+    drained = (pipeline.drain(SHUTDOWN_TIMEOUT)
+               and (space_batcher is None or space_batcher.flush(max(0.0, deadline - time.monotonic())))
+               and lot_writer.flush(max(0.0, deadline - time.monotonic())))
+    if drained:
+        log.info("[STATE] scritture in sospeso completate")
+    else:
+        log.warning(f"[STATE] scritture in sospeso non completate entro {SHUTDOWN_TIMEOUT:.0f}s: "
+                    f"pipeline={pipeline.depth()} stalli={space_batcher.stats()['pending'] if space_batcher else 0} "
+                    f"lot={lot_writer.stats()['pending']}")
+    if SNAPSHOT_PATH:
+        try:
+            count, size = write_snapshot()
+            log.info(f"[STATE] snapshot finale salvato: {count} stalli, {size} byte")
+        except Exception as e:
+            log.warning(f"[STATE] errore nella scrittura dello snapshot finale: {e}")
+    sys.exit(0)
+
+# Verifica periodica: ricalcola i contatori da zero e segnala (correggendola) ogni deriva
+def counters_check_loop():
+    while True:
+        time.sleep(COUNTERS_CHECK_INTERVAL)
+        with state_lock:
+            drifts = lot_counters.self_check()
+            for d in drifts:
+                if d["lot"] != "*" and d["expected"] is not None:
+                    lot_writer.mark(d["lot"], d["expected"]["occupied"], d["expected"]["free"], d["expected"]["offline"])
+        for d in drifts:
+            log.warning(f"[COUNTERS] deriva sul lot {d['lot']}: atteso={d['expected']} incrementale={d['actual']}")
+
+# ---------- Repliche ----------
+# Con SHARD_MODE=hash ogni replica si iscrive ai topic di stato dei soli lot che gestisce: i lot sono scoperti
+# dagli annunci retained su parking/+/lot e dalle ParkingLot lette a ogni ribilanciamento, e le sottoscrizioni
+# cambiano solo per i lot che passano da una replica all'altra. Il controllo del proprietario su ogni
+# messaggio resta come rete di sicurezza (messaggi gia' in volo durante un passaggio).
+mqtt_client: mqtt.Client | None = None
+lots_seen: set[str] = set()          # lot noti
+lots_subscribed: set[str] = set()    # lot con i topic di stato sottoscritti
+subscriptions_lock = threading.Lock()
+
+def register_lots(lot_ids):
+    with subscriptions_lock:
+        lots_seen.update(lot_ids)
+
+def sync_subscriptions():
+    # Allinea le sottoscrizioni ai lot della replica: disiscrizione dai lot persi, iscrizione ai lot acquisiti
+    # (il broker invia loro i messaggi retained, cioe' lo stato corrente di ogni stallo)
+    client = mqtt_client
+    if client is None:
+        return
+    with subscriptions_lock:
+        owned = {lot_id for lot_id in lots_seen if shard.owns(lot_id)}
+        dropped, added = lots_subscribed - owned, owned - lots_subscribed
+        if dropped:
+            client.unsubscribe([t for lot_id in sorted(dropped) for t, _qos in lot_status_topics(lot_id)])
+        if added:
+            client.subscribe([t for lot_id in sorted(added) for t in lot_status_topics(lot_id)])
+        lots_subscribed.difference_update(dropped)
+        lots_subscribed.update(added)
+    if dropped or added:
+        log.info(f"[SHARD] sottoscrizioni: +{len(added)} -{len(dropped)} lot, {len(lots_subscribed)} lot sottoscritti")
+
+def on_lot_announce(client: mqtt.Client, lot_id: str):
+    # Annuncio di un lot (anche retained, alla connessione): iscrizione immediata se il lot e' della replica
+    with subscriptions_lock:
+        if lot_id in lots_seen:
+            return
+        lots_seen.add(lot_id)
+        if shard.owns(lot_id):
+            client.subscribe(lot_status_topics(lot_id))
+            lots_subscribed.add(lot_id)
+
+def on_rebalance(owned, previously_owned):
+    # I lot persi hanno smesso di ricevere messaggi all'inizio del passaggio e le loro scritture in sospeso
+    # sono gia' state completate: il loro stato viene rilasciato
+    released = 0
+    with state_lock:
+        for lot_id in lot_counters.lot_ids():
+            if owned(lot_id):
+                continue
+            for space_id in lot_counters.remove_lot(lot_id):
+                space_filter.forget(f"{lot_id}-{space_id}".lower())
+                if staleness is not None:
+                    staleness.discard((lot_id, space_id))
+            lot_writer.forget(lot_id)
+            released += 1
+    if released:
+        log.info(f"[SHARD] {released} lot rilasciati")
+    sync_subscriptions()
+    # Lo stato gia' scritto dei lot acquisiti viene letto con una LIST, cosi' i messaggi retained
+    # rinviati in on_settled generano scritture solo per gli stalli effettivamente cambiati
+    seed_state(lambda lot_id: owned(lot_id) and not previously_owned(lot_id))
 
-# Funzione per ricalcolare e pubblicare lo stato di un ParkingLot
-def recompute_and_publish_lot(lot_id: str):
-    spaces = lot_state.get(lot_id, {})
-    total = len(spaces)
-    occupied = sum(1 for v in spaces.values() if v)
-    free = max(0, total - occupied)
+def on_settled():
+    st = shard.stats()
+    log.info(f"[SHARD] ribilanciamento completato: {st['members']} repliche, {len(lot_counters.lot_ids())} lot gestiti")
+    sync_subscriptions()
 
-    ensure_parkinglot(lot_id, total)
-    upsert_parkinglot_status(lot_id, occupied, free)
+shard = (ShardCoordinator(REPLICA_ID, SHARD_HANDOFF_DELAY, on_rebalance, on_settled, SHARD_VNODES, SHARD_MEMBER_TTL)
+         if SHARD_MODE == "hash" else None)
+
+def publish_presence(client: mqtt.Client):
+    client.publish(shard.presence_topic, json.dumps({"id": REPLICA_ID, "ts": time.time()}), qos=1, retain=True)
+
+# Annuncio periodico della presenza: le repliche che non si annunciano per SHARD_MEMBER_TTL vengono escluse
+def presence_loop():
+    while True:
+        time.sleep(SHARD_MEMBER_TTL / 3)
+        if mqtt_client is not None and mqtt_client.is_connected():
+            publish_presence(mqtt_client)
+
+def on_presence(member_id: str, payload: bytes):
+    # Payload vuoto = replica uscita (anche tramite Last Will); un annuncio retained piu' vecchio di
+    # SHARD_MEMBER_TTL e' di una replica non piu' attiva
+    present = False
+    if payload:
+        try:
+            present = SHARD_MEMBER_TTL <= 0 or time.time() - float(json.loads(payload)["ts"]) < SHARD_MEMBER_TTL
+        except Exception:
+            log_sampled(log, logging.WARNING, "presence-json", "[SHARD] annuncio non valido da %s", member_id)
+    shard.member_update(member_id, present)
 
 # ---------- Callback MQTT ----------
 def on_connect(client: mqtt.Client, _userdata, _flags, rc: int):
-    print(f"[MQTT] connesso rc={rc}")
-    client.subscribe("parking/+/+/status", qos=1)
-    print("[MQTT] iscritto a parking/+/+/status")
+    log.info(f"[MQTT] connesso rc={rc}")
+    if shard is not None:
+        # Ogni (ri)connessione riparte da un passaggio completo: i membri vengono riletti dagli annunci retained,
+        # i lot dagli annunci dei lot, e i topic di stato vengono sottoscritti al termine del passaggio
+        shard.reset()
+        with subscriptions_lock:
+            lots_subscribed.clear()
+        client.subscribe([(f"{MEMBERS_TOPIC}/+", 1), (LOT_TOPICS, 1)])
+        publish_presence(client)
+        log.info(f"[MQTT] iscritto a {MEMBERS_TOPIC}/+, {LOT_TOPICS}")
+        return
+    client.subscribe(STATUS_TOPICS)
+    log.info(f"[MQTT] iscritto a {', '.join(t for t, _qos in STATUS_TOPICS)}")
+
+def on_disconnect(_client: mqtt.Client, _userdata, rc: int):
+    log.warning(f"[MQTT] disconnesso rc={rc}")
+    if shard is not None:
+        shard.reset()
+
+# Nel thread di rete paho si fa solo il parsing del topic (e l'unpack del formato binario): decode JSON e I/O
+# avvengono nei worker
+_mqtt_in_status = MQTT_MESSAGES.labels("in", "status")
+_mqtt_in_status_bin = MQTT_MESSAGES.labels("in", f"status/{BINARY_VERSION}")
 
 def on_message(_client: mqtt.Client, _userdata, msg):
+    parts = msg.topic.split("/")
+    if len(parts) == 4 and parts[0] == "parking" and parts[3] == "status":
+        _mqtt_in_status.inc()
+        if shard is None or shard.owns(parts[1]):
+            pipeline.submit(parts[1], parts[2], msg.payload)
+    elif len(parts) == 5 and parts[0] == "parking" and parts[3] == "status" and parts[4] == BINARY_VERSION:
+        _mqtt_in_status_bin.inc()
+        if shard is None or shard.owns(parts[1]):
+            submit_binary(parts[1], parts[2], msg.payload)
+    elif shard is not None and msg.topic.startswith(MEMBERS_TOPIC + "/"):
+        on_presence(msg.topic[len(MEMBERS_TOPIC) + 1:], msg.payload)
+    elif shard is not None and len(parts) == 3 and parts[0] == "parking" and parts[2] == "lot":
+        if msg.payload:
+            on_lot_announce(_client, parts[1])
+    else:
+        MQTT_MESSAGES.labels("in", topic_class(msg.topic)).inc()
+
+# Formato binario: l'unpack di 5 byte costa meno dell'accodamento, quindi avviene gia' nel thread MQTT
+# e ai worker arriva la tupla (occupied, sensorOnline, ts)
+def submit_binary(lot_id: str, space_id: str, payload: bytes):
+    if not payload:
+        # Messaggio retained cancellato
+        return
     try:
-        data = json.loads(msg.payload.decode("utf-8"))
-    except Exception:
-        print("[MQTT] payload non-JSON su", msg.topic)
+        status = decode_v1(payload)
+    except struct.error:
+        PAYLOAD_ERRORS.labels(f"status/{BINARY_VERSION}").inc()
+        log_sampled(log, logging.WARNING, "payload-binary",
+                    "[MQTT] payload di %s byte non valido su parking/%s/%s/status/%s", len(payload), lot_id, space_id, BINARY_VERSION)
         return
+    pipeline.submit(lot_id, space_id, status)
 
-    parts = msg.topic.split("/")
-    if len(parts) >= 4 and parts[0] == "parking" and parts[3] == "status":
-        lot_id, space_id = parts[1], parts[2]
-        occupied = bool(data.get("occupied"))
-        sensor_online = bool(data.get("sensorOnline", True))
-        ts = int(data.get("ts", time.time()))
-        last_seen_iso = datetime.fromtimestamp(ts, tz=timezone.utc).isoformat()
+# Elaborazione di un messaggio di stato (eseguita da un worker della pipeline)
+# payload: JSON grezzo, tupla gia' decodificata (formato binario) oppure None = stallo scaduto per silenzio,
+# accodato da staleness_loop
+def handle_status(lot_id: str, space_id: str, payload: bytes | tuple | None):
+    # Messaggio accodato prima che il lot passasse a un'altra replica
+    if shard is not None and not shard.owns(lot_id):
+        return
+    if payload is None:
+        mark_stale(lot_id, space_id)
+        return
+    if isinstance(payload, tuple):
+        occupied, sensor_online, ts = payload
+    elif not payload:
+        # Messaggio retained cancellato (es. sensore passato al formato binario)
+        return
+    else:
+        start = time.perf_counter()
+        try:
+            occupied, sensor_online, ts = decode_json(payload)
+        except Exception:
+            PAYLOAD_ERRORS.labels("status").inc()
+            log_sampled(log, logging.WARNING, "payload-json", "[MQTT] payload non-JSON su parking/%s/%s/status", lot_id, space_id)
+            return
+        JSON_DECODE_SECONDS.observe(time.perf_counter() - start)
+
+    # Anche gli heartbeat soppressi contano come contatto
+    if staleness is not None:
+        if sensor_online:
+            staleness.touch((lot_id, space_id), ts)
+        else:
+            staleness.discard((lot_id, space_id))
+
+    # Heartbeat con (occupied, sensorOnline) invariato e lastSeen ancora recente: nessuna scrittura
+    if not space_filter.should_write(f"{lot_id}-{space_id}".lower(), occupied, sensor_online):
+        return
 
-        ensure_parkinglot(lot_id)
-        ensure_parkingspace(lot_id, space_id)
-        upsert_parkingspace_status(lot_id, space_id, occupied, sensor_online, last_seen_iso)
+    last_seen_iso = ts_iso(ts)
 
-        lot = lot_state.setdefault(lot_id, {})
-        lot[space_id] = occupied
-        recompute_and_publish_lot(lot_id)
+    ensure_parkinglot(lot_id)
+    ensure_parkingspace(lot_id, space_id)
+    upsert_parkingspace_status(lot_id, space_id, occupied, sensor_online, last_seen_iso)
+
+    update_space_state(lot_id, space_id, occupied, sensor_online)
+
+# Stallo silenzioso da SENSOR_STALE_AFTER secondi: va offline mantenendo l'ultimo stato di occupazione noto
+# e come lastSeen l'istante dell'ultimo messaggio
+def mark_stale(lot_id: str, space_id: str):
+    ts = staleness.claim((lot_id, space_id))
+    if ts is None:
+        # Lo stallo ha pubblicato mentre la scadenza era in coda
+        return
+    state = lot_counters.space(lot_id, space_id)
+    occupied = state[0] if state is not None else False
+    SENSORS_STALE.inc()
+    log_sampled(log, logging.INFO, "sensor-stale",
+                "[STALE] %s/%s senza messaggi da oltre %.0fs: segnato offline", lot_id, space_id, SENSOR_STALE_AFTER)
+    if not space_filter.should_write(f"{lot_id}-{space_id}".lower(), occupied, False):
+        return
+    last_seen_iso = ts_iso(ts)
+    upsert_parkingspace_status(lot_id, space_id, occupied, False, last_seen_iso)
+    update_space_state(lot_id, space_id, occupied, False)
+
+pipeline = IngestPipeline(handle_status, INGEST_WORKERS, INGEST_QUEUE_SIZE, INGEST_QUEUE_POLICY)
+
+# Controllo delle scadenze: gli stalli scaduti passano dalla pipeline come i messaggi, cosi' l'ordine
+# rispetto ai messaggi dello stesso stallo e' preservato
+def staleness_loop():
+    while True:
+        time.sleep(SENSOR_STALE_TICK)
+        for (lot_id, space_id), _ts in staleness.advance():
+            pipeline.submit(lot_id, space_id, None)
+
+# ---------- Metriche ----------
+# Dimensioni dello stato in memoria e delle code, lette al momento dello scrape
+gauge("smartparking_lot_state_lots", "Lot nello stato in memoria", lambda: len(lot_counters.lot_ids()))
+gauge("smartparking_lot_state_spaces", "Stalli nello stato in memoria", lot_counters.size)
+gauge("smartparking_ingest_queue_depth", "Messaggi in coda nella pipeline di ingest", pipeline.depth)
+gauge("smartparking_lot_writer_pending", "Lot in attesa di scrittura", lambda: lot_writer.stats()["pending"])
+gauge("smartparking_space_batch_pending", "Stalli in attesa nel batch corrente",
+      lambda: space_batcher.stats()["pending"] if space_batcher is not None else 0)
+if staleness is not None:
+    gauge("smartparking_staleness_tracked", "Stalli online con una scadenza per silenzio",
+          lambda: staleness.stats()["tracked"])
+if shard is not None:
+    gauge("smartparking_shard_members", "Repliche dell'aggregatore viste da questa istanza",
+          lambda: shard.stats()["members"])
+
+# ---------- Statistiche ----------
+# Log periodico dei contatori interni (chiamate API evitate dal registro, scritture dei lot, ecc.)
+def stats_loop():
+    while True:
+        time.sleep(STATS_INTERVAL)
+        st = known.stats()
+        log.info(f"[CACHE] lots={st['lots']} spaces={st['spaces']} "
+                 f"chiamate evitate={st['savedCalls']} (lot={st['savedLotCalls']} space={st['savedSpaceCalls']})")
+        lw = lot_writer.stats()
+        log.info(f"[LOT] flush={lw['flushes']} soppressi={lw['suppressed']} accorpati={lw['coalesced']} "
+                 f"in attesa={lw['pending']} errori={lw['failures']}")
+        sf = space_filter.stats()
+        log.info(f"[SPACE] scritture={sf['written']} soppresse={sf['suppressed']} "
+                 f"rapporto soppressione={sf['suppressionRatio']:.1%}")
+        if space_batcher is not None:
+            sb = space_batcher.stats()
+            bs, bl = sb["batchSize"], sb["batchLatencyMs"]
+            log.info(f"[BATCH] batch={bs['count']} scritte={sb['written']} errori={sb['failures']} accorpate={sb['coalesced']} "
+                     f"dimensione avg/p99/max={bs['avg']:.1f}/{bs['p99']:.0f}/{bs['max']:.0f} "
+                     f"latenza p50/p99={bl['p50']:.0f}/{bl['p99']:.0f}ms")
+        fl = lot_counters.fleet()
+        log.info(f"[COUNTERS] lots={len(lot_counters.lot_ids())} stalli={fl['total']} occupati={fl['occupied']} "
+                 f"offline={fl['offline']} verifiche={lot_counters.checks} derive={lot_counters.drift_found}")
+        pl = pipeline.stats()
+        qw, ht = pl["queueWait"], pl["handle"]
+        log.info(f"[PIPE] workers={pl['workers']} coda={pl['depth']} accodati={pl['enqueued']} scartati={pl['dropped']} "
+                 f"bloccati={pl['blocked']} errori={pl['errors']} "
+                 f"attesa avg/max={qw['avgMs']:.1f}/{qw['maxMs']:.1f}ms elaborazione avg/max={ht['avgMs']:.1f}/{ht['maxMs']:.1f}ms")
+        if staleness is not None:
+            sw = staleness.stats()
+            log.info(f"[STALE] stalli controllati={sw['tracked']} scaduti={sw['expired']} "
+                     f"ripianificati={sw['rescheduled']} arretrati={sw['backlog']}")
+        if shard is not None:
+            sh = shard.stats()
+            log.info(f"[SHARD] replica={REPLICA_ID} repliche={sh['members']} lot gestiti={len(lot_counters.lot_ids())} "
+                     f"stabile={sh['settled']} ribilanciamenti={sh['rebalances']}")
 
 # ---------- Main ----------
 def main():
-    client = mqtt.Client(client_id="aggregator")
+    global mqtt_client
+    start_metrics_server(METRICS_PORT)
+    # Con SHARD_MODE=hash lo stato viene ripristinato al primo ribilanciamento, solo per i lot della replica
+    if shard is None:
+        seed_state()
+    lot_writer.start()
+    if space_batcher is not None:
+        space_batcher.start()
+    pipeline.start()
+    if staleness is not None:
+        threading.Thread(target=staleness_loop, daemon=True, name="staleness").start()
+    if COUNTERS_CHECK_INTERVAL > 0:
+        threading.Thread(target=counters_check_loop, daemon=True, name="counters-check").start()
+    if SNAPSHOT_PATH and SNAPSHOT_INTERVAL > 0:
+        threading.Thread(target=snapshot_loop, daemon=True, name="snapshot").start()
+    signal.signal(signal.SIGTERM, on_sigterm)
+    if STATS_INTERVAL > 0:
+        threading.Thread(target=stats_loop, daemon=True, name="stats").start()
+
+    # Client id univoco: repliche con lo stesso id si disconnetterebbero a vicenda dal broker
+    client = mqtt_client = mqtt.Client(client_id=f"aggregator-{REPLICA_ID}")
     client.on_connect = on_connect
+    client.on_disconnect = on_disconnect
     client.on_message = on_message
     client.reconnect_delay_set(min_delay=1, max_delay=5)
 
@@ -177,8 +741,15 @@ def main():
         client.tls_set(ca_certs=MQTT_CA, certfile=MQTT_CERT, keyfile=MQTT_KEY)
         client.tls_insecure_set(False)
 
+    if shard is not None:
+        client.will_set(shard.presence_topic, b"", qos=1, retain=True)
+        shard.start()
+        if SHARD_MEMBER_TTL > 0:
+            threading.Thread(target=presence_loop, daemon=True, name="presence").start()
+        log.info(f"[SHARD] replica {REPLICA_ID}, attesa di {SHARD_HANDOFF_DELAY:.0f}s prima di gestire i lot")
+
     client.connect_async(BROKER_HOST, BROKER_PORT, keepalive=30)
-    print(f"[MQTT] connessione a {BROKER_HOST}:{BROKER_PORT} ...")
+    log.info(f"[MQTT] connessione a {BROKER_HOST}:{BROKER_PORT} ...")
     client.loop_forever()
 
 
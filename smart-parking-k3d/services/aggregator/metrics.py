@@ -0,0 +1,151 @@
+# Strumentazione comune dei servizi Smart Parking: metriche Prometheus e logging a livelli campionato
+# Lo stesso modulo e' copiato in ogni servizio (come kube.py). Le metriche sono esposte su /metrics:
+# dai servizi FastAPI con una route, dagli altri con il server HTTP di prometheus_client.
+import logging
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest, start_http_server
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()   # DEBUG abilita i log per messaggio (campionati)
+LOG_SAMPLE = int(os.getenv("LOG_SAMPLE", "100"))     # Dei log ripetuti viene scritto il primo e poi uno ogni LOG_SAMPLE
+
+# Bucket per operazioni in memoria (decode JSON) e per chiamate di rete
+FAST_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01)
+NETWORK_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# ---------- Metriche ----------
+MQTT_MESSAGES = Counter("smartparking_mqtt_messages_total", "Messaggi MQTT per direzione e classe di topic",
+                        ["direction", "topic_class"])
+MQTT_PUBLISH_FAILURES = Counter("smartparking_mqtt_publish_failures_total", "Pubblicazioni MQTT rifiutate dal client")
+JSON_DECODE_SECONDS = Histogram("smartparking_json_decode_seconds", "Tempo di decodifica dei payload JSON",
+                                buckets=FAST_BUCKETS)
+PAYLOAD_ERRORS = Counter("smartparking_payload_errors_total", "Payload non decodificabili", ["topic_class"])
+SENSORS_STALE = Counter("smartparking_sensors_stale_total", "Stalli segnati offline per silenzio del sensore")
+K8S_API_CALLS = Counter("smartparking_k8s_api_calls_total", "Chiamate all'API server Kubernetes",
+                        ["verb", "resource", "code"])
+K8S_API_SECONDS = Histogram("smartparking_k8s_api_call_seconds", "Latenza delle chiamate all'API server Kubernetes",
+                            ["verb", "resource"], buckets=NETWORK_BUCKETS)
+HTTP_REQUESTS = Counter("smartparking_http_requests_total", "Richieste HTTP servite", ["method", "route", "code"])
+RESPONSE_CACHE = Counter("smartparking_response_cache_total", "Risposte servite dalla cache pre-serializzata",
+                         ["route", "result"])
+HTTP_REQUEST_SECONDS = Histogram("smartparking_http_request_seconds", "Latenza delle richieste HTTP servite",
+                                 ["method", "route"], buckets=NETWORK_BUCKETS)
+
+
+def topic_class(topic: str) -> str:
+    # Classe del topic per le etichette: parking/{lot}/{space}/status -> "status"
+    parts = topic.split("/")
+    if len(parts) >= 4 and parts[0] == "parking":
+        return "/".join(parts[3:])
+    return "other"
+
+
+def gauge(name: str, documentation: str, fn) -> Gauge:
+    # Gauge calcolato al momento dello scrape (nessun costo sul percorso caldo)
+    g = Gauge(name, documentation)
+    g.set_function(fn)
+    return g
+
+
+# ---------- Kubernetes ----------
+def _k8s_verb(method: str, path_params: dict, query_params, header_params: dict) -> str:
+    if method == "GET":
+        if "name" in path_params:
+            return "get"
+        watch = any(k == "watch" and str(v).lower() == "true" for k, v in (query_params or []))
+        return "watch" if watch else "list"
+    if method == "PATCH":
+        return "apply" if "apply-patch" in (header_params or {}).get("Content-Type", "") else "patch"
+    return {"POST": "create", "PUT": "update", "DELETE": "delete"}.get(method, method.lower())
+
+
+def instrument_k8s(api_client):
+    # Avvolge ApiClient.call_api: tutte le chiamate di CustomObjectsApi (e le call_api dirette) vengono misurate.
+    # Per le WATCH la latenza misurata e' quella di apertura dello stream.
+    from kubernetes.client.rest import ApiException
+
+    original = api_client.call_api
+
+    def call_api(resource_path, method, path_params=None, query_params=None, header_params=None, *args, **kwargs):
+        params = path_params or {}
+        verb = _k8s_verb(method, params, query_params, header_params)
+        resource = params.get("plural", "") + ("/status" if resource_path.endswith("/status") else "")
+        code = "2xx"
+        start = time.perf_counter()
+        try:
+            return original(resource_path, method, path_params, query_params, header_params, *args, **kwargs)
+        except ApiException as e:
+            code = str(e.status)
+            raise
+        except Exception:
+            code = "error"
+            raise
+        finally:
+            K8S_API_SECONDS.labels(verb, resource).observe(time.perf_counter() - start)
+            K8S_API_CALLS.labels(verb, resource, code).inc()
+
+    api_client.call_api = call_api
+    return api_client
+
+
+# ---------- HTTP ----------
+def metrics_response() -> tuple[bytes, str]:
+    return generate_latest(), CONTENT_TYPE_LATEST
+
+
+def start_metrics_server(port: int):
+    # Per i servizi senza server HTTP proprio (aggregator, simulatore); port = 0 disabilita
+    if port > 0:
+        start_http_server(port)
+
+
+class RequestMetricsMiddleware:
+    """Middleware ASGI: latenza e codice di risposta per route (il template del path, non l'URL)."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        code = {"value": 500}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                code["value"] = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = getattr(scope.get("route"), "path", None) or "unmatched"
+            HTTP_REQUEST_SECONDS.labels(scope["method"], route).observe(time.perf_counter() - start)
+            HTTP_REQUESTS.labels(scope["method"], route, str(code["value"])).inc()
+
+
+# ---------- Logging ----------
+_sample_lock = threading.Lock()
+_sample_counts: dict[str, int] = defaultdict(int)
+
+
+def setup_logging(name: str) -> logging.Logger:
+    logging.basicConfig(level=LOG_LEVEL, stream=sys.stdout, format="%(asctime)s %(levelname)s %(message)s")
+    return logging.getLogger(name)
+
+
+def log_sampled(logger: logging.Logger, level: int, key: str, msg: str, *args):
+    # Log ripetuti (per messaggio o per oggetto): il primo e poi uno ogni LOG_SAMPLE per chiave.
+    # Se il livello e' disabilitato non viene formattato nulla.
+    if not logger.isEnabledFor(level):
+        return
+    with _sample_lock:
+        _sample_counts[key] += 1
+        n = _sample_counts[key]
+    if LOG_SAMPLE <= 1 or n % LOG_SAMPLE == 1:
+        logger.log(level, msg + (f" [{n} occorrenze]" if n > 1 else ""), *args)
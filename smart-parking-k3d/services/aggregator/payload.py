@@ -0,0 +1,57 @@
+# Formati del payload di stato dei sensori
+# Lo stesso modulo e' copiato nell'aggregatore e nel simulatore (come kube.py).
+# - json (storico) su parking/{lot}/{space}/status:
+#   {"occupied", "sensorOnline", "ts", "lotId", "spaceId", "sensorId"}
+# - binary (v1) su parking/{lot}/{space}/status/v1: 5 byte, lot e stallo sono gia' nel topic
+#   byte 0: flag (bit 0 = occupied, bit 1 = sensorOnline), byte 1-4: ts Unix in secondi (uint32 big-endian)
+# La versione sta nel topic: un layout diverso avra' un nuovo suffisso e i due formati convivono.
+# Ogni lot e' annunciato con un messaggio retained su parking/{lot}/lot ({"lotId"}): con SHARD_MODE=hash le
+# repliche dell'aggregatore scoprono i lot da qui e si iscrivono solo ai topic di stato dei propri.
+import json
+import struct
+import time
+from typing import Optional, Tuple, Union
+
+FORMATS = ("json", "binary")
+BINARY_VERSION = "v1"
+LOT_TOPICS = "parking/+/lot"
+
+_V1 = struct.Struct(">BI")
+_OCCUPIED = 0x01
+_ONLINE = 0x02
+
+
+def status_topic(lot_id: str, space_id: str, fmt: str = "json") -> str:
+    topic = f"parking/{lot_id}/{space_id}/status"
+    return topic if fmt == "json" else f"{topic}/{BINARY_VERSION}"
+
+
+def lot_topic(lot_id: str) -> str:
+    return f"parking/{lot_id}/lot"
+
+
+def encode_lot(lot_id: str) -> str:
+    return json.dumps({"lotId": lot_id})
+
+
+def encode_status(fmt: str, occupied: Optional[bool], online: bool, ts: int,
+                  lot_id: str, space_id: str, sensor_id: str) -> Union[str, bytes]:
+    # occupied None = stato sconosciuto (Last Will): nel formato binario vale come libero
+    if fmt == "json":
+        return json.dumps({"occupied": occupied, "sensorOnline": online, "ts": int(ts),
+                           "lotId": lot_id, "spaceId": space_id, "sensorId": sensor_id})
+    if fmt == "binary":
+        return _V1.pack((_OCCUPIED if occupied else 0) | (_ONLINE if online else 0), int(ts) & 0xFFFFFFFF)
+    raise ValueError(f"formato sconosciuto: {fmt} ({', '.join(FORMATS)})")
+
+
+def decode_json(payload: bytes) -> Tuple[bool, bool, int]:
+    # (occupied, sensorOnline, ts); solleva ValueError/TypeError se il payload non e' valido
+    data = json.loads(payload)
+    return bool(data.get("occupied")), bool(data.get("sensorOnline", True)), int(data.get("ts", time.time()))
+
+
+def decode_v1(payload: bytes) -> Tuple[bool, bool, int]:
+    # (occupied, sensorOnline, ts); solleva struct.error se la lunghezza non e' quella del layout
+    flags, ts = _V1.unpack(payload)
+    return bool(flags & _OCCUPIED), bool(flags & _ONLINE), ts
@@ -0,0 +1,181 @@
+# Pipeline di ingest dell'aggregatore
+# Sposta l'I/O verso Kubernetes fuori dal thread di rete paho: i messaggi vengono accodati in code
+# limitate e processati da un pool di worker. Ogni stallo (lot_id/space_id) e' assegnato sempre allo
+# stesso worker, quindi l'ordine dei messaggi per stallo e' preservato.
+import logging
+import threading
+import time
+import zlib
+from collections import deque
+from typing import Callable
+
+from metrics import log_sampled
+
+log = logging.getLogger("aggregator")
+
+POLICY_BLOCK = "block"             # coda piena: il thread MQTT attende (backpressure verso il broker)
+POLICY_DROP_OLDEST = "drop-oldest" # coda piena: scarta il messaggio piu' vecchio dello stesso stallo
+
+
+class StageTimer:
+    # Latenza cumulativa di una fase della pipeline (conteggio, somma e massimo in secondi)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float):
+        with self._lock:
+            self.count += 1
+            self.total += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    def snapshot(self, reset_max: bool = True) -> dict:
+        with self._lock:
+            avg = self.total / self.count if self.count else 0.0
+            snap = {"count": self.count, "avgMs": avg * 1000.0, "maxMs": self.max * 1000.0}
+            if reset_max:
+                self.max = 0.0
+            return snap
+
+
+class _Entry:
+    __slots__ = ("key", "lot_id", "space_id", "payload", "enqueued")
+
+    def __init__(self, key: str, lot_id: str, space_id: str, payload: bytes, enqueued: float):
+        self.key = key
+        self.lot_id = lot_id
+        self.space_id = space_id
+        self.payload = payload
+        self.enqueued = enqueued
+
+
+class _Shard:
+    # Coda limitata di un singolo worker; "latest" indica l'ultimo messaggio in coda per ogni stallo
+
+    def __init__(self, capacity: int):
+        self.capacity = max(1, capacity)
+        self.items: deque[_Entry] = deque()
+        self.latest: dict[str, _Entry] = {}
+        self.busy = False   # il worker sta elaborando un messaggio
+        self.cond = threading.Condition()
+
+
+class IngestPipeline:
+    # handler(lot_id, space_id, payload) viene eseguito da un worker per ogni messaggio
+    # workers = 0 esegue l'handler direttamente nel thread chiamante (comportamento originale)
+
+    def __init__(self, handler: Callable[[str, str, bytes], None], workers: int,
+                 queue_size: int, policy: str = POLICY_BLOCK):
+        if policy not in (POLICY_BLOCK, POLICY_DROP_OLDEST):
+            raise ValueError(f"politica di coda non valida: {policy}")
+        self._handler = handler
+        self._policy = policy
+        self._workers = max(0, workers)
+        per_shard = -(-queue_size // self._workers) if self._workers else 0
+        self._shards = [_Shard(per_shard) for _ in range(self._workers)]
+        self._lock = threading.Lock()
+        self.enqueued = 0
+        self.dropped = 0    # messaggi scartati o sostituiti a coda piena
+        self.blocked = 0    # inserimenti che hanno dovuto attendere spazio in coda
+        self.errors = 0     # eccezioni sollevate dall'handler
+        self.queue_wait = StageTimer()  # tempo trascorso in coda
+        self.handle_time = StageTimer() # tempo di elaborazione (decode + I/O Kubernetes)
+
+    def start(self):
+        for i, shard in enumerate(self._shards):
+            threading.Thread(target=self._run, args=(shard,), daemon=True, name=f"ingest-{i}").start()
+
+    def submit(self, lot_id: str, space_id: str, payload: bytes):
+        now = time.monotonic()
+        if not self._workers:
+            self._handle(lot_id, space_id, payload, now)
+            return
+        key = f"{lot_id}/{space_id}"
+        shard = self._shards[zlib.crc32(key.encode("utf-8")) % self._workers]
+        entry = _Entry(key, lot_id, space_id, payload, now)
+        with shard.cond:
+            if len(shard.items) >= shard.capacity:
+                if self._policy == POLICY_DROP_OLDEST:
+                    older = shard.latest.get(key)
+                    if older is not None:
+                        # Lo stallo ha gia' un messaggio in coda: viene sostituito mantenendo la posizione
+                        older.payload = payload
+                        self._count_drop()
+                        shard.cond.notify()
+                        return
+                    victim = shard.items.popleft()
+                    if shard.latest.get(victim.key) is victim:
+                        del shard.latest[victim.key]
+                    self._count_drop()
+                else:
+                    with self._lock:
+                        self.blocked += 1
+                    while len(shard.items) >= shard.capacity:
+                        shard.cond.wait()
+            shard.items.append(entry)
+            shard.latest[key] = entry
+            shard.cond.notify_all()
+        with self._lock:
+            self.enqueued += 1
+
+    def drain(self, timeout: float) -> bool:
+        # Attende che i worker abbiano elaborato tutti i messaggi in coda (allo spegnimento, dopo aver
+        # fermato l'ingresso dei messaggi); restituisce False se il timeout scade prima
+        deadline = time.monotonic() + timeout
+        for shard in self._shards:
+            with shard.cond:
+                while shard.items or shard.busy:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                    shard.cond.wait(timeout=remaining)
+        return True
+
+    def depth(self) -> int:
+        return sum(len(s.items) for s in self._shards)
+
+    def stats(self) -> dict:
+        with self._lock:
+            base = {"enqueued": self.enqueued, "dropped": self.dropped,
+                    "blocked": self.blocked, "errors": self.errors}
+        base["workers"] = self._workers
+        base["depth"] = self.depth()
+        base["queueWait"] = self.queue_wait.snapshot()
+        base["handle"] = self.handle_time.snapshot()
+        return base
+
+    # ---------- interni ----------
+    def _count_drop(self):
+        with self._lock:
+            self.dropped += 1
+
+    def _run(self, shard: _Shard):
+        while True:
+            with shard.cond:
+                while not shard.items:
+                    shard.cond.wait()
+                entry = shard.items.popleft()
+                if shard.latest.get(entry.key) is entry:
+                    del shard.latest[entry.key]
+                shard.busy = True
+                shard.cond.notify_all()
+            self._handle(entry.lot_id, entry.space_id, entry.payload, entry.enqueued)
+            with shard.cond:
+                shard.busy = False
+                shard.cond.notify_all()
+
+    def _handle(self, lot_id: str, space_id: str, payload: bytes, enqueued: float):
+        start = time.monotonic()
+        self.queue_wait.observe(start - enqueued)
+        try:
+            self._handler(lot_id, space_id, payload)
+        except Exception as e:
+            with self._lock:
+                self.errors += 1
+            log_sampled(log, logging.WARNING, "pipeline-handler", "[PIPE] errore nell'elaborazione di %s/%s: %s", lot_id, space_id, e)
+        finally:
+            self.handle_time.observe(time.monotonic() - start)
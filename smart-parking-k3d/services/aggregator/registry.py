@@ -0,0 +1,84 @@
+# Registro in-process degli oggetti CRD gia' noti all'aggregatore
+# Evita di chiamare l'API server per creare ParkingLot/ParkingSpace che esistono gia'
+import threading
+
+
+class KnownObjects:
+    # Tiene traccia dei nomi ParkingLot/ParkingSpace esistenti e del totalSpaces noto per ogni lot.
+    # Viene popolato con una LIST all'avvio e aggiornato dagli esiti di create (201/409) e patch (404).
+    # I contatori "saved_*" indicano quante chiamate all'API server sono state evitate.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._lots: dict[str, int] = {}   # nome ParkingLot -> totalSpaces noto
+        self._spaces: set[str] = set()    # nomi ParkingSpace esistenti
+        self.saved_lot_calls = 0
+        self.saved_space_calls = 0
+        self.seeded = False
+
+    # ---------- ParkingLot ----------
+    def lot_total(self, name: str) -> int | None:
+        with self._lock:
+            return self._lots.get(name)
+
+    def lot_is_current(self, name: str, total_spaces: int | None) -> bool:
+        # True se il lot esiste e il totalSpaces richiesto non supera quello gia' scritto
+        with self._lock:
+            cur = self._lots.get(name)
+            if cur is None:
+                return False
+            if total_spaces is not None and total_spaces > cur:
+                return False
+            # Senza cache: create (409) + eventuale GET del totalSpaces
+            self.saved_lot_calls += 1 if total_spaces is None else 2
+            return True
+
+    def remember_lot(self, name: str, total_spaces: int | None):
+        with self._lock:
+            cur = self._lots.get(name, 0)
+            self._lots[name] = max(cur, int(total_spaces or 0))
+
+    def forget_lot(self, name: str):
+        with self._lock:
+            self._lots.pop(name, None)
+
+    # ---------- ParkingSpace ----------
+    def has_space(self, name: str) -> bool:
+        with self._lock:
+            if name in self._spaces:
+                self.saved_space_calls += 1
+                return True
+            return False
+
+    def remember_space(self, name: str):
+        with self._lock:
+            self._spaces.add(name)
+
+    def forget_space(self, name: str):
+        with self._lock:
+            self._spaces.discard(name)
+
+    # ---------- Seed / statistiche ----------
+    def seed(self, lots: list[dict], spaces: list[dict]):
+        # Popola il registro a partire dal risultato di una LIST di parkinglots e parkingspaces
+        with self._lock:
+            for item in lots:
+                name = (item.get("metadata") or {}).get("name")
+                if name:
+                    total = int((item.get("spec") or {}).get("totalSpaces", 0) or 0)
+                    self._lots[name] = max(self._lots.get(name, 0), total)
+            for item in spaces:
+                name = (item.get("metadata") or {}).get("name")
+                if name:
+                    self._spaces.add(name)
+            self.seeded = True
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "lots": len(self._lots),
+                "spaces": len(self._spaces),
+                "savedLotCalls": self.saved_lot_calls,
+                "savedSpaceCalls": self.saved_space_calls,
+                "savedCalls": self.saved_lot_calls + self.saved_space_calls,
+            }
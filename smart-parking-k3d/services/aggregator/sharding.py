@@ -0,0 +1,157 @@
+# Partizionamento dei lot tra piu' repliche dell'aggregatore
+# Ogni replica annuncia la propria presenza con un messaggio retained su aggregator/members/{id}; la Last Will
+# (payload vuoto) lo cancella se la replica cade. Tutte le repliche vedono lo stesso insieme di membri e
+# assegnano ogni lot con un hash consistente: ogni lot ha un solo proprietario, che e' l'unico a scriverne
+# lo stato. Quando i membri cambiano una replica smette subito di gestire i lot persi, mentre prende in
+# carico quelli acquisiti solo dopo handoff_delay secondi senza ulteriori cambi: nel frattempo il
+# proprietario precedente ha completato le scritture in sospeso. La presenza viene ripubblicata
+# periodicamente: un membro che non si fa sentire per member_ttl secondi viene considerato uscito (ad es.
+# se il broker e' stato riavviato senza pubblicare la Last Will).
+import bisect
+import hashlib
+import threading
+import time
+from typing import Callable, Dict, Iterable, Optional, Tuple
+
+MEMBERS_TOPIC = "aggregator/members"
+
+
+def _hash(key: str) -> int:
+    # Hash stabile tra processi (hash() di Python e' randomizzato per processo)
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    # Anello di hash consistente con vnodes punti per membro: l'ingresso o l'uscita di un membro
+    # sposta solo circa 1/N dei lot
+
+    def __init__(self, members: Iterable[str], vnodes: int = 64):
+        self.members = tuple(sorted(set(members)))
+        points = sorted((_hash(f"{m}#{i}"), m) for m in self.members for i in range(max(1, vnodes)))
+        self._keys = [p[0] for p in points]
+        self._owners = [p[1] for p in points]
+
+    def owner(self, key: str) -> Optional[str]:
+        if not self._keys:
+            return None
+        i = bisect.bisect(self._keys, _hash(key)) % len(self._keys)
+        return self._owners[i]
+
+
+class ShardCoordinator:
+    # replica_id: identificativo univoco della replica (nome del pod)
+    # handoff_delay: secondi senza cambi di membri prima di prendere in carico i lot acquisiti
+    # on_rebalance(owned, previously_owned): prepara lo stato dei lot acquisiti e rilascia quelli persi;
+    #     owned(lot) e previously_owned(lot) dicono se il lot e' della replica con i nuovi membri e con i precedenti
+    # on_settled(): chiamata dopo che i lot acquisiti sono diventati attivi
+    # member_ttl: secondi senza annunci dopo i quali un membro viene rimosso (0 = solo payload vuoto/Last Will)
+
+    def __init__(self, replica_id: str, handoff_delay: float,
+                 on_rebalance: Callable[[Callable[[str], bool], Callable[[str], bool]], None],
+                 on_settled: Callable[[], None], vnodes: int = 64, member_ttl: float = 0.0):
+        self.replica_id = replica_id
+        self._delay = max(0.0, handoff_delay)
+        self._ttl = max(0.0, member_ttl)
+        self._on_rebalance = on_rebalance
+        self._on_settled = on_settled
+        self._vnodes = vnodes
+        self._cond = threading.Condition()
+        self._members = {replica_id}
+        self._seen: Dict[str, float] = {}   # membro -> istante (monotonic) dell'ultimo annuncio
+        self._deadline = time.monotonic() + self._delay
+        # Vista letta dal percorso caldo, sostituita in blocco: (anello, cache lot -> proprietario,
+        # anello dell'ultimo ribilanciamento completato, ribilanciamento completato)
+        self._view: Tuple[HashRing, Dict[str, Optional[str]], Optional[HashRing], bool] = \
+            (HashRing(self._members, vnodes), {}, None, False)
+        self.rebalances = 0   # ribilanciamenti completati
+
+    @property
+    def presence_topic(self) -> str:
+        return f"{MEMBERS_TOPIC}/{self.replica_id}"
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True, name="shard-coordinator").start()
+
+    def owns(self, lot_id: str) -> bool:
+        # O(1) per messaggio: il proprietario di ogni lot viene calcolato una volta per anello
+        ring, owners, settled_ring, settled = self._view
+        owner = owners.get(lot_id)
+        if owner is None:
+            owner = owners[lot_id] = ring.owner(lot_id)
+        if owner != self.replica_id:
+            return False
+        # Durante il passaggio restano attivi solo i lot che la replica gestiva gia'
+        return settled or (settled_ring is not None and settled_ring.owner(lot_id) == self.replica_id)
+
+    def member_update(self, member_id: str, present: bool):
+        # Da chiamare per ogni messaggio su aggregator/members/+ (payload vuoto = membro uscito)
+        if member_id == self.replica_id:
+            return
+        with self._cond:
+            if present:
+                self._seen[member_id] = time.monotonic()
+            else:
+                self._seen.pop(member_id, None)
+            if (member_id in self._members) == present:
+                return
+            if present:
+                self._members.add(member_id)
+            else:
+                self._members.discard(member_id)
+            self._changed()
+
+    def reset(self):
+        # Connessione al broker persa: la vista dei membri non e' piu' affidabile e altre repliche
+        # possono aver preso in carico i lot; si riparte da zero alla riconnessione
+        with self._cond:
+            self._members = {self.replica_id}
+            self._seen.clear()
+            self._view = (self._view[0], self._view[1], None, False)
+            self._changed()
+
+    def stats(self) -> dict:
+        ring, _owners, _settled_ring, settled = self._view
+        return {"members": len(ring.members), "settled": settled, "rebalances": self.rebalances}
+
+    # ---------- interni ----------
+    def _changed(self):
+        # Nuovo anello: i lot persi smettono subito di essere gestiti, quelli acquisiti attendono handoff_delay
+        _ring, _owners, settled_ring, _settled = self._view
+        self._view = (HashRing(self._members, self._vnodes), {}, settled_ring, False)
+        self._deadline = time.monotonic() + self._delay
+        self._cond.notify()
+
+    def _expire(self) -> Optional[float]:
+        # Rimuove i membri silenziosi da piu' di member_ttl; restituisce i secondi alla prossima scadenza
+        if not self._ttl or not self._seen:
+            return None
+        now = time.monotonic()
+        expired = [m for m, seen in self._seen.items() if now - seen >= self._ttl]
+        for m in expired:
+            del self._seen[m]
+            self._members.discard(m)
+        if expired:
+            self._changed()
+        return min(self._ttl - (now - seen) for seen in self._seen.values()) if self._seen else None
+
+    def _run(self):
+        while True:
+            with self._cond:
+                wait = self._expire()
+                ring, _owners, settled_ring, settled = self._view
+                if not settled:
+                    until_deadline = self._deadline - time.monotonic()
+                    wait = until_deadline if wait is None else min(wait, until_deadline)
+                if settled or wait > 0:
+                    self._cond.wait(timeout=wait)
+                    continue
+            me = self.replica_id
+            self._on_rebalance(lambda lot: ring.owner(lot) == me,
+                               lambda lot: settled_ring is not None and settled_ring.owner(lot) == me)
+            with self._cond:
+                if self._view[0] is not ring:
+                    # I membri sono cambiati durante la preparazione: si ripete con il nuovo anello
+                    continue
+                self._view = (ring, self._view[1], ring, True)
+                self.rebalances += 1
+            self._on_settled()
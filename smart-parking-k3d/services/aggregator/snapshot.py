@@ -0,0 +1,47 @@
+# Checkpoint locale dello stato dell'aggregatore
+# Salva periodicamente su file lo stato di ogni stallo e l'ultimo stato scritto di stalli e lot, cosi'
+# un riavvio puo' ripartire da uno stato completo anche quando la LIST iniziale non e' disponibile.
+import json
+import os
+import time
+
+SNAPSHOT_VERSION = 1
+
+
+def save_snapshot(path: str, spaces: list, written: dict, lots: dict) -> int:
+    # spaces: [(lot, stallo, occupied, online)], written: {nome stallo: (occupied, online)}, lots: {lot: (occupied, free, offline)}
+    # La scrittura e' atomica (file temporaneo + rename): un crash non lascia mai un file troncato.
+    data = {
+        "version": SNAPSHOT_VERSION,
+        "savedAt": time.time(),
+        "spaces": [list(s) for s in spaces],
+        "written": {name: list(v) for name, v in written.items()},
+        "lots": {lot_id: list(v) for lot_id, v in lots.items()},
+    }
+    raw = json.dumps(data, separators=(",", ":")).encode("utf-8")
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(raw)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    return len(raw)
+
+
+def load_snapshot(path: str, max_age: float) -> dict | None:
+    # Restituisce None se il file non esiste o e' piu' vecchio di max_age secondi (0 = nessun limite)
+    try:
+        with open(path, "rb") as f:
+            data = json.loads(f.read().decode("utf-8"))
+    except FileNotFoundError:
+        return None
+    if data.get("version") != SNAPSHOT_VERSION:
+        raise ValueError(f"versione dello snapshot non supportata: {data.get('version')}")
+    age = time.time() - float(data.get("savedAt", 0))
+    if max_age > 0 and age > max_age:
+        return None
+    data["age"] = age
+    return data
@@ -0,0 +1,109 @@
+# Rilevamento dei sensori silenziosi
+# La Last Will copre solo le disconnessioni: un sensore che resta connesso ma smette di pubblicare (o che
+# sta dietro un gateway che tiene aperta la connessione) resterebbe online per sempre. Ogni stallo online
+# ha una scadenza in una ruota temporizzata (hashed timing wheel): un messaggio aggiorna solo l'istante
+# dell'ultimo contatto, in O(1), e ogni stallo ha al piu' una voce nella ruota. A ogni tick si esaminano
+# solo le voci dello slot corrente: quelle ancora valide vengono ripianificate sull'ultima scadenza,
+# le altre sono scadute. Il costo di un tick non dipende quindi dal numero totale di stalli ed e' comunque
+# limitato a budget voci: gli stalli partiti insieme (es. dopo un riavvio) restano allineati sulla stessa
+# scadenza, e le voci oltre il budget vengono esaminate nei tick successivi.
+import math
+import threading
+import time
+from typing import Dict, Hashable, List, Optional, Set, Tuple
+
+
+class StalenessWheel:
+    # threshold: secondi di silenzio dopo i quali uno stallo e' scaduto
+    # tick: granularita' della ruota (la scadenza viene rilevata entro un tick, salvo arretrati oltre il budget)
+    # budget: voci esaminate al massimo per chiamata di advance()
+
+    def __init__(self, threshold: float, tick: float = 1.0, budget: int = 2000):
+        self.threshold = threshold
+        self._tick = max(0.01, tick)
+        self._budget = max(1, budget)
+        # Le scadenze sono al piu' threshold secondi nel futuro: un giro di ruota basta, niente contatori di giri.
+        # Il giro e' lungo il doppio per assorbire il ritardo del cursore quando il budget non basta.
+        self._size = 2 * int(math.ceil(threshold / self._tick)) + 2
+        self._slots: List[Set[Hashable]] = [set() for _ in range(self._size)]
+        self._lock = threading.Lock()
+        self._seen: Dict[Hashable, Tuple[float, int]] = {}  # chiave -> (ultimo contatto monotonic, ts del messaggio)
+        self._slot_of: Dict[Hashable, int] = {}             # chiave -> tick in cui e' pianificata
+        self._expired: Dict[Hashable, int] = {}             # scadute e non ancora applicate -> ts dell'ultimo messaggio
+        self._cursor = self._tick_of(time.monotonic())
+        self.expirations = 0   # stalli scaduti
+        self.reschedules = 0   # voci ripianificate perche' lo stallo ha pubblicato nel frattempo
+        self.backlog = 0       # voci rimaste negli slot gia' scaduti alla fine dell'ultimo advance()
+
+    def touch(self, key: Hashable, ts: int, now: Optional[float] = None):
+        # Contatto da uno stallo online: aggiorna solo l'ultimo contatto, la voce nella ruota resta dov'e'
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self._expired.pop(key, None)
+            if key not in self._slot_of:
+                self._schedule(key, now + self.threshold)
+            self._seen[key] = (now, ts)
+
+    def discard(self, key: Hashable):
+        # Stallo offline (Last Will) o non piu' gestito: non va piu' controllato
+        with self._lock:
+            self._seen.pop(key, None)
+            self._expired.pop(key, None)
+            slot = self._slot_of.pop(key, None)
+            if slot is not None:
+                self._slots[slot % self._size].discard(key)
+
+    def advance(self, now: Optional[float] = None) -> List[Tuple[Hashable, int]]:
+        # Esamina gli slot fino all'istante corrente; restituisce le chiavi scadute con il ts dell'ultimo messaggio
+        now = time.monotonic() if now is None else now
+        expired: List[Tuple[Hashable, int]] = []
+        with self._lock:
+            target = self._tick_of(now)
+            # Dopo una pausa piu' lunga di un giro ogni slot va esaminato una sola volta
+            self._cursor = max(self._cursor, target - self._size + 1)
+            budget = self._budget
+            while self._cursor <= target and budget > 0:
+                slot = self._slots[self._cursor % self._size]
+                if len(slot) <= budget:
+                    due = list(slot)
+                    slot.clear()
+                    self._cursor += 1
+                else:
+                    # Slot oltre il budget: il resto al prossimo tick, il cursore non avanza
+                    due = [slot.pop() for _ in range(budget)]
+                budget -= len(due)
+                for key in due:
+                    del self._slot_of[key]
+                    last, ts = self._seen[key]
+                    if last + self.threshold > now:
+                        self._schedule(key, last + self.threshold)
+                        self.reschedules += 1
+                    else:
+                        del self._seen[key]
+                        self._expired[key] = ts
+                        expired.append((key, ts))
+                        self.expirations += 1
+            self.backlog = sum(len(self._slots[t % self._size]) for t in range(self._cursor, target + 1)) \
+                if self._cursor <= target else 0
+        return expired
+
+    def claim(self, key: Hashable) -> Optional[int]:
+        # Da chiamare quando si applica la scadenza: None se lo stallo ha pubblicato dopo essere scaduto
+        with self._lock:
+            return self._expired.pop(key, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"tracked": len(self._seen), "expired": self.expirations, "rescheduled": self.reschedules,
+                    "backlog": self.backlog}
+
+    # ---------- interni ----------
+    def _tick_of(self, t: float) -> int:
+        return int(t / self._tick)
+
+    def _schedule(self, key: Hashable, deadline: float):
+        # Slot del primo tick successivo alla scadenza (mai in anticipo), entro un giro dal cursore: con un
+        # ritardo eccezionale la voce viene esaminata prima della scadenza e semplicemente ripianificata
+        slot = min(max(self._tick_of(deadline) + 1, self._cursor), self._cursor + self._size - 1)
+        self._slot_of[key] = slot
+        self._slots[slot % self._size].add(key)
@@ -0,0 +1,99 @@
+# Test della deduplicazione delle scritture degli stalli con il batching attivo
+# Il filtro e lo scrittore a batch sono collegati come in main.py (submit all'invio, record/rollback
+# alla fine della scrittura), con una scrittura lenta che tiene il batch in volo.
+#
+#   cd services/aggregator && python -m unittest test_dedup
+import threading
+import time
+import unittest
+
+from batcher import SpaceStatusBatcher
+from dedup import SpaceStatusFilter
+
+NAME = "a-a-1"
+
+
+class FlipDuringInFlightBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.filter = SpaceStatusFilter(lastseen_refresh=300)
+        self.writes = []
+        self.failing = False
+        self.in_flight = threading.Event()
+        self.batcher = SpaceStatusBatcher(self._write, window=0.01, concurrency=2, max_batch=100)
+        self.batcher.start()
+        self.filter.seed(NAME, False, True)
+
+    def _write(self, lot_id, space_id, occupied, sensor_online, _last_seen):
+        # Come write_parkingspace_status: scrittura lenta, poi conferma o annullamento nel filtro
+        self.in_flight.set()
+        time.sleep(0.2)
+        if self.failing:
+            self.filter.rollback(NAME, occupied, sensor_online)
+            return False
+        self.writes.append((occupied, sensor_online))
+        self.filter.record(NAME, occupied, sensor_online)
+        return True
+
+    def _message(self, occupied, sensor_online=True) -> bool:
+        # Come handle_status + upsert_parkingspace_status
+        if not self.filter.should_write(NAME, occupied, sensor_online):
+            return False
+        self.filter.submit(NAME, occupied, sensor_online)
+        self.batcher.submit("A", "A-1", occupied, sensor_online, "")
+        return True
+
+    def _drain(self):
+        deadline = time.monotonic() + 5
+        while time.monotonic() < deadline:
+            if self.batcher.stats()["pending"] == 0 and self.batcher.written + self.batcher.failures == \
+                    self.batcher.submitted - self.batcher.coalesced:
+                return
+            time.sleep(0.02)
+        self.fail("batcher non svuotato")
+
+    def test_flip_back_while_write_in_flight_is_written(self):
+        self.assertTrue(self._message(True))
+        self.assertTrue(self.in_flight.wait(2))
+        # Lo stallo torna libero mentre la scrittura di occupied=True e' in volo
+        self.assertTrue(self._message(False))
+        self._drain()
+        self.assertEqual(self.writes, [(True, True), (False, True)])
+        # L'heartbeat successivo con lo stato scritto per ultimo viene soppresso
+        self.assertFalse(self._message(False))
+
+    def test_repeated_state_while_pending_is_suppressed(self):
+        self.assertTrue(self._message(True))
+        self.assertFalse(self._message(True))
+        self._drain()
+        self.assertEqual(self.writes, [(True, True)])
+
+    def test_failed_write_is_rolled_back(self):
+        self.failing = True
+        self.assertTrue(self._message(True))
+        self._drain()
+        self.assertEqual(self.writes, [])
+        # Lo stato non e' stato scritto: il messaggio successivo uguale viene ritentato
+        self.failing = False
+        self.assertTrue(self._message(True))
+        self._drain()
+        self.assertEqual(self.writes, [(True, True)])
+
+    def test_export_has_only_written_states(self):
+        # Lo snapshot non deve contenere uno stato inviato ma non ancora scritto
+        self.assertTrue(self._message(True))
+        self.assertTrue(self.in_flight.wait(2))
+        self.assertEqual(self.filter.export(), {NAME: (False, True)})
+        self._drain()
+        self.assertEqual(self.filter.export(), {NAME: (True, True)})
+
+    def test_flush_writes_pending_without_waiting_window(self):
+        self.batcher = SpaceStatusBatcher(self._write, window=30, concurrency=2, max_batch=100)
+        self.batcher.start()
+        self.assertTrue(self._message(True))
+        self.assertTrue(self.batcher.flush(5))
+        self.assertEqual(self.writes, [(True, True)])
+
+
+if __name__ == "__main__":
+    unittest.main()
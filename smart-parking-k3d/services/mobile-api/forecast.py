@@ -0,0 +1,269 @@
+# Previsione a breve termine dei posti liberi per lot
+# Il modello e' un flusso di arrivi e partenze: dO/dt = lambda(t) - mu(t) * O, con lambda = arrivi al secondo
+# e mu = partenze al secondo per stallo occupato. Le transizioni degli stalli (dalla WATCH dei ParkingSpace) e
+# l'occupazione dei lot (dalla WATCH dei ParkingLot) aggiornano in O(1) contatori a decadimento esponenziale;
+# alla chiusura di ogni quarto d'ora i tassi osservati aggiornano un profilo per fascia oraria (media mobile
+# esponenziale tra un giorno e l'altro). Un thread in background integra ogni FORECAST_INTERVAL secondi
+# il modello fino all'orizzonte piu' lungo, pesando il tasso attuale (che decade con l'orizzonte) e quello
+# del profilo per le fasce future, e pubblica la previsione in una tabella: le richieste la leggono in O(1).
+# I profili possono essere salvati su file (scrittura atomica) per sopravvivere ai riavvii.
+import json
+import logging
+import math
+import os
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Sequence
+
+log = logging.getLogger("forecast")
+
+SLOT = 900                  # durata di una fascia del profilo (s)
+SLOTS = 86400 // SLOT
+STEP = 60                   # passo di integrazione (s)
+_MIN_SLOT_COVERAGE = 0.3    # frazione minima di fascia osservata per aggiornare il profilo
+_MIN_WARMUP = 300           # finestra minima su cui si normalizzano i tassi appena avviati (s)
+
+
+def _slot_start(t: float) -> float:
+    # Inizio della fascia (ora locale) che contiene t
+    off = time.localtime(t).tm_gmtoff
+    return t - ((t + off) % SLOT)
+
+
+def _slot_of(t: float) -> int:
+    return int(((t + time.localtime(t).tm_gmtoff) % 86400) // SLOT)
+
+
+def _blend(current: Optional[float], profile: Optional[float], w: float) -> Optional[float]:
+    if profile is None:
+        return current
+    if current is None:
+        return profile
+    return w * current + (1.0 - w) * profile
+
+
+class _Lot:
+    __slots__ = ("total", "occupied", "free", "since", "t", "arr", "dep", "occ_int",
+                 "slot_start", "slot_arr", "slot_dep", "slot_occ", "prof_arr", "prof_dep")
+
+    def __init__(self, now: float, prof_arr: Optional[List[Optional[float]]] = None,
+                 prof_dep: Optional[List[Optional[float]]] = None):
+        self.total = 0
+        self.occupied = 0
+        self.free = 0
+        self.since = now          # inizio dell'osservazione: corregge i contatori ancora "freddi"
+        self.t = now              # istante a cui sono aggiornati i contatori
+        self.arr = 0.0            # arrivi con decadimento esponenziale
+        self.dep = 0.0            # partenze con decadimento esponenziale
+        self.occ_int = 0.0        # stalli occupati x secondi con lo stesso decadimento
+        self.slot_start = _slot_start(now)
+        self.slot_arr = 0
+        self.slot_dep = 0
+        self.slot_occ = 0.0
+        self.prof_arr: List[Optional[float]] = prof_arr or [None] * SLOTS
+        self.prof_dep: List[Optional[float]] = prof_dep or [None] * SLOTS
+
+
+class Forecaster:
+    """Tassi di arrivo/partenza per lot e previsione dei posti liberi a orizzonti fissi.
+
+    ``on_lot``/``on_space`` sono listener degli informer; ``get`` legge la previsione precalcolata.
+    """
+
+    def __init__(self, horizons: Sequence[int] = (5, 15, 30), interval: float = 60.0, tau: float = 900.0,
+                 alpha: float = 0.2, path: str = ""):
+        # horizons: minuti; tau: costante di tempo dei tassi attuali (s); alpha: peso di un nuovo giorno nel profilo
+        self.horizons = sorted(set(int(h) for h in horizons))
+        self._interval = interval
+        self._tau = tau
+        self._alpha = alpha
+        self._path = path
+        self._lock = threading.Lock()
+        self._lots: Dict[str, _Lot] = {}
+        self._table: Dict[str, Dict[str, Any]] = {}   # lotId -> ultima previsione (sostituita, mai modificata)
+        self._profiles: Dict[str, Dict[str, List[Optional[float]]]] = self._load() if path else {}
+        self._dirty = False
+        self.transitions = 0
+        self.runs = 0
+        self.last_run_ms = 0.0
+
+    # ---------- listener degli informer ----------
+    def on_lot(self, _event: str, _name: str, obj: Optional[Dict[str, Any]], prev: Optional[Dict[str, Any]]):
+        now = time.time()
+        with self._lock:
+            if obj is None:
+                self._lots.pop(prev["lotId"], None)
+                self._table.pop(prev["lotId"], None)
+                return
+            lot = self._lot(obj["lotId"], now)
+            self._advance(lot, now)
+            lot.total, lot.occupied, lot.free = obj["totalSpaces"], obj["occupied"], obj["free"]
+
+    def on_space(self, _event: str, _name: str, obj: Optional[Dict[str, Any]], prev: Optional[Dict[str, Any]]):
+        # Solo le transizioni di occupazione: la LIST iniziale (prev None) e le cancellazioni non sono arrivi/partenze
+        if obj is None or prev is None or obj["occupied"] == prev["occupied"]:
+            return
+        now = time.time()
+        with self._lock:
+            lot = self._lot(obj["lotId"], now)
+            self._advance(lot, now)
+            if obj["occupied"]:
+                lot.arr += 1.0
+                lot.slot_arr += 1
+            else:
+                lot.dep += 1.0
+                lot.slot_dep += 1
+            self.transitions += 1
+
+    # ---------- previsioni ----------
+    def get(self, lot_id: str) -> Optional[Dict[str, Any]]:
+        return self._table.get(lot_id)
+
+    def start(self):
+        threading.Thread(target=self._loop, daemon=True, name="forecast").start()
+
+    def run_once(self, now: Optional[float] = None):
+        now = time.time() if now is None else now
+        start = time.perf_counter()
+        generated = datetime.fromtimestamp(now, timezone.utc).isoformat().replace("+00:00", "Z")
+        with self._lock:
+            lot_ids = list(self._lots)
+        for lot_id in lot_ids:
+            with self._lock:
+                lot = self._lots.get(lot_id)
+                if lot is None:
+                    continue
+                self._advance(lot, now)
+                result = self._forecast(lot_id, lot, now, generated)
+            self._table[lot_id] = result
+        if self._dirty and self._path:
+            self._save()
+        self.runs += 1
+        self.last_run_ms = (time.perf_counter() - start) * 1000.0
+
+    def stats(self) -> dict:
+        return {"lots": len(self._table), "transitions": self.transitions, "runs": self.runs,
+                "lastRunMs": round(self.last_run_ms, 2)}
+
+    def close(self):
+        if self._path:
+            with self._lock:
+                self._advance_all(time.time())
+            self._save()
+
+    # ---------- interni ----------
+    def _loop(self):
+        while True:
+            try:
+                self.run_once()
+            except Exception as e:
+                log.warning(f"[FORECAST] errore nel calcolo delle previsioni: {e}")
+            time.sleep(self._interval)
+
+    def _lot(self, lot_id: str, now: float) -> _Lot:
+        lot = self._lots.get(lot_id)
+        if lot is None:
+            profile = self._profiles.pop(lot_id, None) or {}
+            lot = _Lot(now, profile.get("arrivals"), profile.get("departures"))
+            self._lots[lot_id] = lot
+        return lot
+
+    def _advance_all(self, now: float):
+        for lot in self._lots.values():
+            self._advance(lot, now)
+
+    def _advance(self, lot: _Lot, now: float):
+        # Porta i contatori a now chiudendo le fasce attraversate; il ciclo conta le fasce trascorse
+        # dall'ultimo aggiornamento, che il thread in background tiene a una o due
+        while lot.t < now:
+            boundary = lot.slot_start + SLOT
+            end = min(boundary, now)
+            dt = end - lot.t
+            decay = math.exp(-dt / self._tau)
+            lot.arr *= decay
+            lot.dep *= decay
+            lot.occ_int = lot.occ_int * decay + lot.occupied * self._tau * (1.0 - decay)
+            lot.slot_occ += lot.occupied * dt
+            lot.t = end
+            if end >= boundary:
+                self._close_slot(lot, boundary)
+
+    def _close_slot(self, lot: _Lot, boundary: float):
+        observed = boundary - max(lot.slot_start, lot.since)
+        if observed >= SLOT * _MIN_SLOT_COVERAGE:
+            slot = _slot_of(lot.slot_start)
+            rate = lot.slot_arr / observed
+            old = lot.prof_arr[slot]
+            lot.prof_arr[slot] = rate if old is None else (1.0 - self._alpha) * old + self._alpha * rate
+            if lot.slot_occ > 0:
+                rate = lot.slot_dep / lot.slot_occ
+                old = lot.prof_dep[slot]
+                lot.prof_dep[slot] = rate if old is None else (1.0 - self._alpha) * old + self._alpha * rate
+            self._dirty = True
+        lot.slot_start = boundary
+        lot.slot_arr = lot.slot_dep = 0
+        lot.slot_occ = 0.0
+
+    def _forecast(self, lot_id: str, lot: _Lot, now: float, generated: str) -> Dict[str, Any]:
+        # Tassi attuali; nei primi minuti i contatori sono normalizzati sul tempo effettivamente osservato
+        # e pesano meno del profilo, in proporzione a quanto e' stato osservato
+        # (con una finestra minima: pochi eventi nei primi secondi non diventano un tasso enorme)
+        warm = self._tau * (1.0 - math.exp(-max(now - lot.since, _MIN_WARMUP) / self._tau))
+        confidence = warm / self._tau
+        lam_now = lot.arr / warm if warm > 0 else None
+        mu_now = lot.dep / lot.occ_int if lot.occ_int > 0 else None
+        occ = float(lot.occupied)
+        points = []
+        elapsed = 0
+        for minutes in self.horizons:
+            while elapsed < minutes * 60:
+                mid = elapsed + STEP / 2
+                slot = _slot_of(now + mid)
+                w = confidence * math.exp(-mid / self._tau)
+                lam = _blend(lam_now, lot.prof_arr[slot], w) or 0.0
+                mu = _blend(mu_now, lot.prof_dep[slot], w) or 0.0
+                occ = min(max(occ + (lam - mu * occ) * STEP, 0.0), float(lot.total))
+                elapsed += STEP
+            # Posti liberi coerenti con il conteggio del lot: si sposta il valore attuale della variazione prevista
+            free = min(max(lot.free - (occ - lot.occupied), 0.0), float(lot.total))
+            points.append({"minutes": minutes, "free": int(round(free)), "occupied": round(occ, 1)})
+        return {
+            "lotId": lot_id,
+            "generatedAt": generated,
+            "free": lot.free,
+            "arrivalsPerHour": round((lam_now or 0.0) * 3600, 2),
+            "departuresPerHour": round((mu_now or 0.0) * lot.occupied * 3600, 2),
+            "profile": any(v is not None for v in lot.prof_arr),
+            "forecast": points,
+        }
+
+    def _load(self) -> Dict[str, Dict[str, List[Optional[float]]]]:
+        try:
+            with open(self._path, encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            log.warning(f"[FORECAST] profili non leggibili ({self._path}): {e}")
+            return {}
+        if data.get("slot") != SLOT:
+            return {}
+        return {lot_id: p for lot_id, p in (data.get("lots") or {}).items()
+                if len(p.get("arrivals") or []) == SLOTS and len(p.get("departures") or []) == SLOTS}
+
+    def _save(self):
+        with self._lock:
+            lots = {lot_id: {"arrivals": list(lot.prof_arr), "departures": list(lot.prof_dep)}
+                    for lot_id, lot in self._lots.items()}
+            # I profili caricati e non ancora usati (lot non piu' visti) restano nel file
+            for lot_id, p in self._profiles.items():
+                lots.setdefault(lot_id, p)
+            self._dirty = False
+        tmp = self._path + ".tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"slot": SLOT, "lots": lots}, f, separators=(",", ":"))
+            os.replace(tmp, self._path)
+        except OSError as e:
+            log.warning(f"[FORECAST] salvataggio dei profili fallito ({self._path}): {e}")
@@ -0,0 +1,395 @@
+# Storico dell'occupazione dei lot
+# Le variazioni di {occupied, free, offline} di ogni lot vengono accodate a file append-only mappati in memoria
+# (mmap), insieme ad aggregati per lot a 1 minuto, 15 minuti e 1 ora. Ogni serie e' divisa in segmenti di
+# durata fissa: la retention elimina i segmenti interi, senza riscrivere nulla. Gli aggregati vengono scritti
+# solo per gli intervalli in cui il lot e' cambiato (negli altri vale l'ultimo valore), e un indice in memoria
+# per lot e risoluzione (inizio intervallo -> record) permette alle query di leggere solo gli aggregati
+# dell'intervallo richiesto, mai gli eventi grezzi. Gli eventi grezzi servono solo a ricostruire
+# all'avvio gli intervalli ancora aperti.
+import bisect
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+from array import array
+from typing import Dict, Iterator, List, Optional, Tuple
+
+RESOLUTIONS = (60, 900, 3600)
+
+# Evento grezzo (32 byte): tipo, lot, ts, occupied, free, offline
+_RAW = struct.Struct("<BxxxIdIII4x")
+# Aggregato (48 byte): tipo, lot, inizio intervallo, media occupied pesata sul tempo, min, max, ultimo valore
+_ROLLUP = struct.Struct("<BxxxIddIIIII4x")
+_RECORD_KIND = 1        # 0 = spazio non ancora scritto: segna la fine dei record validi
+_INITIAL_RECORDS = 4096
+
+Value = Tuple[int, int, int]   # (occupied, free, offline)
+
+
+class _Segment:
+    # File di record a dimensione fissa mappato in memoria; cresce per raddoppio
+
+    def __init__(self, path: str, record_size: int):
+        self.path = path
+        self._size = record_size
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        if os.fstat(self._fd).st_size == 0:
+            os.ftruncate(self._fd, record_size * _INITIAL_RECORDS)
+        self._mm = mmap.mmap(self._fd, 0)
+        # I record sono contigui e il resto del file e' a zero: il primo tipo nullo segna la fine
+        lo, hi = 0, len(self._mm) // record_size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._mm[mid * record_size]:
+                lo = mid + 1
+            else:
+                hi = mid
+        self.count = lo
+
+    def append(self, record: bytes) -> int:
+        offset = self.count * self._size
+        if offset + self._size > len(self._mm):
+            self._mm.resize(len(self._mm) * 2)
+        # Il tipo viene scritto per ultimo: un record interrotto a meta' resta invisibile
+        self._mm[offset + 1:offset + self._size] = record[1:]
+        self._mm[offset] = record[0]
+        self.count += 1
+        return self.count - 1
+
+    def read(self, index: int) -> bytes:
+        offset = index * self._size
+        return self._mm[offset:offset + self._size]
+
+    def records(self) -> Iterator[bytes]:
+        for i in range(self.count):
+            yield self.read(i)
+
+    def flush(self):
+        self._mm.flush()
+
+    def close(self):
+        self._mm.close()
+        os.close(self._fd)
+
+
+class _Series:
+    # Serie append-only in segmenti di span secondi ({name}-{inizio}.seg); retention in secondi (0 = illimitata)
+
+    def __init__(self, directory: str, name: str, record: struct.Struct, span: int, retention: float):
+        self._dir = directory
+        self._name = name
+        self._record = record
+        self.span = span
+        self.retention = retention
+        self._segments: Dict[int, _Segment] = {}
+        prefix = f"{name}-"
+        for fname in os.listdir(directory):
+            if fname.startswith(prefix) and fname.endswith(".seg"):
+                start = int(fname[len(prefix):-4])
+                self._segments[start] = _Segment(os.path.join(directory, fname), record.size)
+
+    def segment_of(self, ts: float) -> int:
+        return int(ts) - int(ts) % self.span
+
+    def append(self, ts: float, *fields) -> int:
+        start = self.segment_of(ts)
+        seg = self._segments.get(start)
+        if seg is None:
+            seg = self._segments[start] = _Segment(os.path.join(self._dir, f"{self._name}-{start}.seg"),
+                                                   self._record.size)
+        return seg.append(self._record.pack(_RECORD_KIND, *fields))
+
+    def get(self, start: int, index: int) -> Optional[tuple]:
+        seg = self._segments.get(start)
+        if seg is None or index >= seg.count:
+            return None
+        return self._record.unpack(seg.read(index))
+
+    def scan(self) -> Iterator[Tuple[int, int, tuple]]:
+        # Tutti i record in ordine di segmento: (inizio segmento, indice, campi)
+        for start in sorted(self._segments):
+            for i, raw in enumerate(self._segments[start].records()):
+                yield start, i, self._record.unpack(raw)
+
+    def expire(self, now: float) -> int:
+        # Elimina i segmenti interamente piu' vecchi della retention; restituisce il limite applicato
+        if self.retention <= 0:
+            return 0
+        cutoff = now - self.retention
+        for start in [s for s in self._segments if s + self.span <= cutoff]:
+            seg = self._segments.pop(start)
+            seg.close()
+            os.unlink(seg.path)
+        return int(cutoff)
+
+    def flush(self):
+        for seg in self._segments.values():
+            seg.flush()
+
+    def close(self):
+        for seg in self._segments.values():
+            seg.close()
+        self._segments.clear()
+
+
+class _Bucket:
+    # Intervallo aperto di una risoluzione: integrale di occupied nel tempo, min/max e ultimo valore
+    __slots__ = ("start", "t", "area", "covered", "min", "max", "value")
+
+    def __init__(self, start: int, t: float, value: Value):
+        self.start = start
+        self.t = t
+        self.area = 0.0
+        self.covered = 0.0
+        self.min = self.max = value[0]
+        self.value = value
+
+    def advance(self, t: float):
+        dt = max(0.0, t - self.t)
+        self.area += self.value[0] * dt
+        self.covered += dt
+        self.t = max(self.t, t)
+
+    def set(self, t: float, value: Value):
+        self.advance(t)
+        self.value = value
+        self.min = min(self.min, value[0])
+        self.max = max(self.max, value[0])
+
+    def average(self) -> float:
+        return self.area / self.covered if self.covered > 0 else float(self.value[0])
+
+
+class _Index:
+    # Aggregati chiusi di un lot a una risoluzione: inizi crescenti e indice del record nel segmento
+    __slots__ = ("starts", "records")
+
+    def __init__(self):
+        self.starts = array("I")
+        self.records = array("I")
+
+    def trim(self, cutoff: int):
+        n = bisect.bisect_left(self.starts, cutoff)
+        if n:
+            del self.starts[:n]
+            del self.records[:n]
+
+
+class HistoryStore:
+    """Storico dell'occupazione per lot, con aggregati a 1m/15m/1h e retention per serie.
+
+    ``record()`` va chiamata ad ogni variazione di un lot (anche con valori invariati: vengono scartati);
+    ``query()`` restituisce punti a passo costante costruiti dagli aggregati della risoluzione piu' grossa
+    compatibile con il passo. Le due chiamate sono thread-safe.
+    """
+
+    def __init__(self, directory: str, raw_retention: float, retention: Dict[int, float]):
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._dir = directory
+        # Segmenti: 1 ora per gli eventi grezzi e per il minuto, 1 giorno per 15m, 1 settimana per l'ora
+        self._raw = _Series(directory, "raw", _RAW, 3600, raw_retention)
+        spans = {60: 3600, 900: 86400, 3600: 7 * 86400}
+        self._rollups = {res: _Series(directory, f"{res}s", _ROLLUP, spans[res], retention.get(res, 0))
+                         for res in RESOLUTIONS}
+        self._lot_ids: List[str] = []
+        self._lot_index: Dict[str, int] = {}
+        self._last: Dict[int, Tuple[float, Value]] = {}            # lot -> (ts, valore) dell'ultimo evento
+        self._open: Dict[int, Dict[int, _Bucket]] = {res: {} for res in RESOLUTIONS}
+        self._index: Dict[int, Dict[int, _Index]] = {res: {} for res in RESOLUTIONS}
+        self.events = 0   # eventi registrati da questo processo
+        self._load()
+        self._expired_at = self._raw.segment_of(time.time())
+
+    # ---------- API ----------
+    def record(self, lot_id: str, ts: float, occupied: int, free: int, offline: int):
+        value = (int(occupied), int(free), int(offline))
+        with self._lock:
+            lot = self._lot(lot_id)
+            last = self._last.get(lot)
+            if last is not None:
+                if last[1] == value:
+                    return
+                ts = max(ts, last[0])   # eventi fuori ordine: il tempo non torna indietro
+            self._raw.append(ts, lot, ts, *value)
+            self._apply(lot, ts, value, last)
+            self.events += 1
+            # La retention viene applicata a ogni nuovo segmento degli eventi grezzi (una volta all'ora)
+            segment = self._raw.segment_of(ts)
+            if segment != self._expired_at:
+                self._expired_at = segment
+                self._expire(ts)
+
+    def query(self, lot_id: str, t_from: float, t_to: float, step: int) -> Optional[dict]:
+        # Punti ogni step secondi in [t_from, t_to): media pesata sul tempo, min e max di occupied e
+        # ultimo valore di free/offline; None per gli intervalli senza dati. None se il lot e' sconosciuto.
+        res = max(r for r in RESOLUTIONS if step % r == 0)
+        with self._lock:
+            lot = self._lot_index.get(lot_id)
+            if lot is None:
+                return None
+            t0 = int(t_from) - int(t_from) % step
+            acc = self._accumulate(lot, res, step, t0, int(t_to), time.time())
+        points = []
+        for p, a in enumerate(acc):
+            t = t0 + p * step
+            if a is None:
+                points.append({"t": t, "occupiedAvg": None, "occupiedMin": None, "occupiedMax": None,
+                               "free": None, "offline": None})
+                continue
+            total, n, lo, hi, value = a
+            points.append({"t": t, "occupiedAvg": round(total / n, 3), "occupiedMin": lo, "occupiedMax": hi,
+                           "free": value[1], "offline": value[2]})
+        return {"lotId": lot_id, "from": t0, "to": int(t_to), "step": step, "resolution": res, "points": points}
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"lots": len(self._lot_ids), "events": self.events,
+                    "rollups": {res: sum(len(ix.starts) for ix in self._index[res].values()) for res in RESOLUTIONS}}
+
+    def close(self):
+        with self._lock:
+            for series in (self._raw, *self._rollups.values()):
+                series.flush()
+                series.close()
+
+    # ---------- interni ----------
+    def _lot(self, lot_id: str) -> int:
+        lot = self._lot_index.get(lot_id)
+        if lot is None:
+            # Nomi dei lot in un file di testo append-only: la riga e' l'indice usato nei record
+            with open(os.path.join(self._dir, "lots.txt"), "a", encoding="utf-8") as f:
+                f.write(lot_id + "\n")
+            lot = self._lot_index[lot_id] = len(self._lot_ids)
+            self._lot_ids.append(lot_id)
+        return lot
+
+    def _apply(self, lot: int, ts: float, value: Value, last: Optional[Tuple[float, Value]],
+               closed_until: Optional[Dict[int, Dict[int, int]]] = None):
+        # closed_until (solo all'avvio): fine dell'ultimo aggregato gia' scritto per risoluzione e lot
+        for res in RESOLUTIONS:
+            if closed_until is not None and ts < closed_until[res].get(lot, 0):
+                continue
+            start = int(ts) - int(ts) % res
+            bucket = self._open[res].get(lot)
+            if bucket is not None and bucket.start != start:
+                self._close(res, lot, bucket)
+                bucket = None
+            if bucket is None:
+                if last is None:
+                    bucket = _Bucket(start, ts, value)
+                else:
+                    # Dall'inizio dell'intervallo fino all'evento vale il valore precedente
+                    bucket = _Bucket(start, max(start, last[0]), last[1])
+                self._open[res][lot] = bucket
+            bucket.set(ts, value)
+        self._last[lot] = (ts, value)
+
+    def _close(self, res: int, lot: int, bucket: _Bucket):
+        bucket.advance(bucket.start + res)
+        series = self._rollups[res]
+        index = series.append(bucket.start, lot, float(bucket.start), bucket.average(), bucket.min, bucket.max,
+                              *bucket.value)
+        ix = self._index[res].setdefault(lot, _Index())
+        ix.starts.append(bucket.start)
+        ix.records.append(index)
+
+    def _accumulate(self, lot: int, res: int, step: int, t0: int, t_to: int, now: float) -> list:
+        # Un elemento per punto di step secondi: [somma delle medie, intervalli, min, max, valore finale] oppure
+        # None. Si leggono solo gli aggregati esistenti nell'intervallo (bisect sull'indice); tra un aggregato e
+        # il successivo vale il valore finale del precedente, sommato per punto e non per intervallo di res
+        # secondi: il costo e' O(punti + aggregati), non O((t_to - t0) / res)
+        series = self._rollups[res]
+        per_point = step // res
+        count = max(0, (t_to - t0 + res - 1) // res)
+        acc: list = [None] * ((count + per_point - 1) // per_point)
+        # Gli intervalli senza aggregato sono riempiti solo fino ad ora
+        limit = min(count, max(0, math.ceil((now - t0) / res)))
+
+        def add(k: int, total: float, n: int, lo: int, hi: int, value: Value):
+            a = acc[k // per_point]
+            if a is None:
+                acc[k // per_point] = [total, n, lo, hi, value]
+            else:
+                a[0] += total
+                a[1] += n
+                a[2] = min(a[2], lo)
+                a[3] = max(a[3], hi)
+                a[4] = value
+
+        def fill(a: int, b: int, value: Value):
+            # Intervalli [a, b) al valore costante value, un passo per punto
+            b = min(b, limit)
+            while a < b:
+                end = min(b, (a // per_point + 1) * per_point)
+                add(a, float(value[0]) * (end - a), end - a, value[0], value[0], value)
+                a = end
+
+        entries = []   # (intervallo, (media, min, max, valore finale)) in ordine
+        carry: Optional[Value] = None
+        ix = self._index[res].get(lot)
+        if ix is not None:
+            i = bisect.bisect_left(ix.starts, t0)
+            if i > 0:
+                # Ultimo aggregato prima dell'intervallo: il suo valore finale vale fino al successivo
+                rec = series.get(series.segment_of(ix.starts[i - 1]), ix.records[i - 1])
+                if rec is not None:
+                    carry = rec[6:9]
+            for j in range(i, bisect.bisect_left(ix.starts, t_to)):
+                rec = series.get(series.segment_of(ix.starts[j]), ix.records[j])
+                if rec is not None:
+                    entries.append(((ix.starts[j] - t0) // res, (rec[3], rec[4], rec[5], rec[6:9])))
+        bucket = self._open[res].get(lot)
+        if bucket is not None and bucket.start < t_to:
+            # Intervallo ancora aperto (sempre l'ultimo): calcolato fino ad ora senza modificarlo; se e' iniziato
+            # prima di t0 il suo valore vale per tutto l'intervallo richiesto
+            k = (bucket.start - t0) // res
+            if k >= 0:
+                dt = max(0.0, min(now, bucket.start + res) - bucket.t)
+                covered = bucket.covered + dt
+                avg = (bucket.area + bucket.value[0] * dt) / covered if covered > 0 else float(bucket.value[0])
+                entries.append((k, (avg, bucket.min, bucket.max, bucket.value)))
+            else:
+                carry = bucket.value
+        pos = 0
+        for k, (avg, lo, hi, value) in entries:
+            if carry is not None:
+                fill(pos, k, carry)
+            add(k, avg, 1, lo, hi, value)
+            carry, pos = value, k + 1
+        if carry is not None:
+            fill(pos, count, carry)
+        return acc
+
+    def _expire(self, now: float):
+        self._raw.expire(now)
+        for res, series in self._rollups.items():
+            cutoff = series.expire(now)
+            if cutoff:
+                for ix in self._index[res].values():
+                    ix.trim(cutoff - cutoff % series.span)
+
+    def _load(self):
+        # Ricostruzione all'avvio: nomi dei lot, indici degli aggregati chiusi e, dagli eventi grezzi,
+        # l'ultimo valore di ogni lot e gli intervalli ancora aperti
+        path = os.path.join(self._dir, "lots.txt")
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    lot_id = line.rstrip("\n")
+                    self._lot_index[lot_id] = len(self._lot_ids)
+                    self._lot_ids.append(lot_id)
+        closed_until: Dict[int, Dict[int, int]] = {res: {} for res in RESOLUTIONS}
+        for res, series in self._rollups.items():
+            for _seg, i, rec in series.scan():
+                lot, start = rec[1], int(rec[2])
+                self._index[res].setdefault(lot, _Index())
+                self._index[res][lot].starts.append(start)
+                self._index[res][lot].records.append(i)
+                closed_until[res][lot] = start + res
+        for _seg, _i, rec in self._raw.scan():
+            lot = rec[1]
+            self._apply(lot, rec[2], tuple(rec[3:6]), self._last.get(lot), closed_until)
+        self._expire(time.time())
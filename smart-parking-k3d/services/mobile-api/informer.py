@@ -0,0 +1,150 @@
+# Cache locale (informer) delle CRD, alimentata da LIST + WATCH
+# Le richieste HTTP leggono dalla memoria invece di interrogare l'API server ad ogni chiamata.
+
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from kubernetes import watch
+from kubernetes.client.rest import ApiException
+
+log = logging.getLogger("informer")
+
+# Listener: (evento, nome, oggetto nuovo o None, oggetto precedente o None)
+Listener = Callable[[str, str, Optional[Dict[str, Any]], Optional[Dict[str, Any]]], None]
+
+
+class Informer:
+    """Mantiene in memoria gli oggetti di una CRD namespaced.
+
+    Esegue una LIST iniziale e poi una WATCH che riprende dall'ultimo resourceVersion visto;
+    se il resourceVersion non e' piu' disponibile (410 Gone) ripete la LIST. Con ``transform``
+    gli oggetti vengono normalizzati una sola volta, al momento della ricezione. Ogni chiamata ha un
+    timeout (``request_timeout``): un API server lento o una WATCH bloccata fanno ripartire il ciclo
+    invece di fermarlo, mentre le richieste HTTP continuano a leggere la cache.
+    """
+
+    def __init__(self, api, group: str, version: str, namespace: str, plural: str,
+                 transform: Optional[Callable[[Dict[str, Any]], Dict[str, Any]]] = None,
+                 watch_timeout: int = 300, request_timeout: float = 10.0):
+        self._api = api
+        self._args = (group, version, namespace, plural)
+        self._plural = plural
+        self._transform = transform or (lambda obj: obj)
+        self._watch_timeout = watch_timeout
+        self._request_timeout = request_timeout
+        self._lock = threading.Lock()
+        self._items: Dict[str, Dict[str, Any]] = {}
+        self._resource_version: Optional[str] = None
+        self._synced = threading.Event()
+        self._listeners: List[Listener] = []
+        self.version = 0   # incrementato ad ogni modifica della cache
+        self.relists = 0   # LIST eseguite (iniziale + dopo 410 o errori)
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True, name=f"informer-{self._plural}").start()
+
+    def add_listener(self, listener: Listener):
+        self._listeners.append(listener)
+
+    def wait_synced(self, timeout: Optional[float] = None) -> bool:
+        return self._synced.wait(timeout)
+
+    def has_synced(self) -> bool:
+        return self._synced.is_set()
+
+    def list(self) -> List[Dict[str, Any]]:
+        """Restituisce gli oggetti in cache ordinati per nome (come la LIST dell'API server)."""
+        with self._lock:
+            return [self._items[k] for k in sorted(self._items)]
+
+    def get(self, name: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            return self._items.get(name)
+
+    # ---------- interni ----------
+    def _run(self):
+        backoff = 1.0
+        while True:
+            try:
+                if self._resource_version is None:
+                    self._relist()
+                self._watch()
+                backoff = 1.0
+            except ApiException as e:
+                if e.status == 410:
+                    # resourceVersion scaduto: serve una nuova LIST
+                    self._resource_version = None
+                    continue
+                log.warning(f"[INFORMER] {self._plural}: errore API ({e.status}), nuovo tentativo tra {backoff:.0f}s")
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 30.0)
+            except Exception as e:
+                log.warning(f"[INFORMER] {self._plural}: errore {e}, nuovo tentativo tra {backoff:.0f}s")
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 30.0)
+
+    def _relist(self):
+        resp = self._api.list_namespaced_custom_object(*self._args, _request_timeout=self._request_timeout)
+        fresh = {}
+        for raw in resp.get("items", []):
+            name = (raw.get("metadata") or {}).get("name", "")
+            fresh[name] = self._transform(raw)
+        with self._lock:
+            old = self._items
+            self._items = fresh
+            self._resource_version = (resp.get("metadata") or {}).get("resourceVersion")
+            self.relists += 1
+            self.version += 1
+        # I listener ricevono solo le differenze rispetto alla cache precedente
+        for name, obj in fresh.items():
+            prev = old.get(name)
+            if prev is None:
+                self._notify("ADDED", name, obj, None)
+            elif prev != obj:
+                self._notify("MODIFIED", name, obj, prev)
+        for name, prev in old.items():
+            if name not in fresh:
+                self._notify("DELETED", name, None, prev)
+        self._synced.set()
+
+    def _watch(self):
+        w = watch.Watch()
+        for event in w.stream(self._api.list_namespaced_custom_object, *self._args,
+                              resource_version=self._resource_version,
+                              timeout_seconds=self._watch_timeout,
+                              allow_watch_bookmarks=True,
+                              # (connessione, lettura): l'API server chiude la WATCH dopo watch_timeout,
+                              # oltre quel limite lo stream e' bloccato
+                              _request_timeout=(self._request_timeout,
+                                                self._watch_timeout + self._request_timeout)):
+            etype = event.get("type")
+            raw = event.get("raw_object") or {}
+            meta = raw.get("metadata") or {}
+            if meta.get("resourceVersion"):
+                self._resource_version = meta["resourceVersion"]
+            if etype not in ("ADDED", "MODIFIED", "DELETED"):
+                continue
+            name = meta.get("name", "")
+            with self._lock:
+                prev = self._items.get(name)
+                if etype == "DELETED":
+                    if prev is None:
+                        continue
+                    obj = None
+                    self._items.pop(name, None)
+                else:
+                    obj = self._transform(raw)
+                    if obj == prev:
+                        continue
+                    self._items[name] = obj
+                self.version += 1
+            self._notify(etype if prev is not None or obj is None else "ADDED", name, obj, prev)
+
+    def _notify(self, etype: str, name: str, obj, prev):
+        for listener in self._listeners:
+            try:
+                listener(etype, name, obj, prev)
+            except Exception as e:
+                log.warning(f"[INFORMER] {self._plural}: errore nel listener: {e}")
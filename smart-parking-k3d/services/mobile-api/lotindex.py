@@ -0,0 +1,120 @@
+# Indice in memoria di lot e stalli per le query della API mobile
+# Alimentato dai listener degli informer: ogni variazione aggiorna l'indice in O(log n) (piu' lo spostamento
+# in memoria delle liste ordinate), e le query costano in proporzione al risultato, non al numero di lot
+# o di stalli della flotta:
+# - lot per lotId (dict) e lot ordinati per posti liberi decrescenti (lista ordinata + bisect)
+# - stalli di ogni lot divisi per stato (occupied, online) in liste ordinate per spaceId: un filtro
+#   su stato legge solo le liste coinvolte, a partire dal cursore
+import bisect
+import heapq
+import itertools
+import re
+import threading
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+_DIGITS = re.compile(r"(\d+)")
+
+SpaceKey = Tuple[Any, ...]
+State = Tuple[bool, bool]   # (occupied, online)
+
+
+def space_key(space_id: str) -> SpaceKey:
+    # Ordinamento naturale: A-2 precede A-10. Le parti numeriche sono sempre in posizione dispari,
+    # quindi le chiavi restano confrontabili tra loro
+    parts = _DIGITS.split(space_id)
+    return tuple(int(p) if i % 2 else p for i, p in enumerate(parts))
+
+
+class _LotSpaces:
+    __slots__ = ("spaces", "by_state")
+
+    def __init__(self):
+        self.spaces: Dict[str, Dict[str, Any]] = {}          # spaceId -> stallo
+        self.by_state: Dict[State, List[Tuple[SpaceKey, str]]] = {}
+
+    def add(self, space: Dict[str, Any]):
+        state = (space["occupied"], space["sensorOnline"])
+        bisect.insort(self.by_state.setdefault(state, []), (space_key(space["spaceId"]), space["spaceId"]))
+        self.spaces[space["spaceId"]] = space
+
+    def remove(self, space_id: str) -> bool:
+        space = self.spaces.pop(space_id, None)
+        if space is None:
+            return False
+        entries = self.by_state[(space["occupied"], space["sensorOnline"])]
+        entry = (space_key(space_id), space_id)
+        entries.pop(bisect.bisect_left(entries, entry))
+        return True
+
+
+class LotIndex:
+    """Lot e stalli della API mobile, indicizzati per lotId, posti liberi e stato degli stalli."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._lots: Dict[str, Dict[str, Any]] = {}      # lotId -> lot
+        self._by_free: List[Tuple[int, str]] = []        # (-free, lotId) ordinati: piu' liberi prima
+        self._spaces: Dict[str, _LotSpaces] = {}         # lotId -> stalli del lot
+
+    # ---------- listener degli informer ----------
+    def on_lot(self, _event: str, _name: str, obj: Optional[Dict[str, Any]], prev: Optional[Dict[str, Any]]):
+        with self._lock:
+            if prev is not None and self._lots.get(prev["lotId"]) is prev:
+                del self._lots[prev["lotId"]]
+                self._by_free.pop(bisect.bisect_left(self._by_free, (-prev["free"], prev["lotId"])))
+            if obj is not None:
+                old = self._lots.get(obj["lotId"])
+                if old is not None:
+                    # Stesso lotId su un altro oggetto: vale l'ultimo ricevuto
+                    self._by_free.pop(bisect.bisect_left(self._by_free, (-old["free"], old["lotId"])))
+                self._lots[obj["lotId"]] = obj
+                bisect.insort(self._by_free, (-obj["free"], obj["lotId"]))
+
+    def on_space(self, _event: str, _name: str, obj: Optional[Dict[str, Any]], prev: Optional[Dict[str, Any]]):
+        with self._lock:
+            if prev is not None:
+                spaces = self._spaces.get(prev["lotId"])
+                if spaces is not None and spaces.remove(prev["spaceId"]) and not spaces.spaces:
+                    del self._spaces[prev["lotId"]]
+            if obj is not None:
+                spaces = self._spaces.setdefault(obj["lotId"], _LotSpaces())
+                spaces.remove(obj["spaceId"])
+                spaces.add(obj)
+
+    # ---------- query ----------
+    def lot(self, lot_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            return self._lots.get(lot_id)
+
+    def lots_with_free(self, min_free: int, limit: int) -> List[Dict[str, Any]]:
+        # Lot con almeno min_free posti liberi, dal piu' libero; O(log n + risultato)
+        with self._lock:
+            # (-min_free + 1,) precede ogni voce con free == min_free - 1 e segue quelle con free >= min_free
+            end = bisect.bisect_left(self._by_free, (-min_free + 1,))
+            return [self._lots[lot_id] for _neg_free, lot_id in self._by_free[:min(end, limit)]]
+
+    def spaces(self, lot_id: str, occupied: Optional[bool], online: Optional[bool], limit: int,
+               cursor: Optional[str]) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        # Stalli del lot in ordine naturale di spaceId, dopo cursor (spaceId dell'ultimo stallo gia' restituito);
+        # restituisce anche il cursore della pagina successiva (None se non ce ne sono altre)
+        with self._lock:
+            lot = self._spaces.get(lot_id)
+            if lot is None:
+                return [], None
+            states = [s for s in lot.by_state
+                      if (occupied is None or s[0] == occupied) and (online is None or s[1] == online)]
+            start = (space_key(cursor), cursor) if cursor is not None else None
+            merged = heapq.merge(*(self._after(lot.by_state[s], start) for s in states))
+            page = list(itertools.islice(merged, limit + 1))
+            items = [lot.spaces[space_id] for _key, space_id in page[:limit]]
+            return items, (page[limit - 1][1] if len(page) > limit else None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"lots": len(self._lots), "spaces": sum(len(s.spaces) for s in self._spaces.values())}
+
+    @staticmethod
+    def _after(entries: List[Tuple[SpaceKey, str]], start: Optional[Tuple[SpaceKey, str]]) -> Iterator[Tuple[SpaceKey, str]]:
+        # Per indice dalla posizione del cursore: islice scorrerebbe anche le voci precedenti
+        i = bisect.bisect_right(entries, start) if start is not None else 0
+        return (entries[j] for j in range(i, len(entries)))
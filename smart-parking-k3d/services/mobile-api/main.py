@@ -1,64 +1,267 @@
 # API mobile per Smart Parking
 # Espone API REST (FastAPI) per consultare lo stato dei parcheggi tramite le CRD ParkingLot
+import asyncio
 import os
-from typing import List, Dict, Any
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from typing import List, Dict, Any, Optional
 
-from fastapi import FastAPI
-from fastapi.responses import JSONResponse, PlainTextResponse
+from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, Response
+from starlette.concurrency import run_in_threadpool
 from kubernetes import client as k8s_client
 from kube import load_kube_config_safely
+from informer import Informer
+from history import HistoryStore
+from respcache import CachedJSONResponse
+from lotindex import LotIndex
+from forecast import Forecaster
+from metrics import RequestMetricsMiddleware, instrument_k8s, metrics_response, setup_logging
 
 # Configurazione CRD e namespace
 GROUP = "parking.smart"
 VERSION = "v1alpha1"
 NAMESPACE = os.getenv("NAMESPACE", "smart-parking")
+INFORMER_SYNC_TIMEOUT = float(os.getenv("INFORMER_SYNC_TIMEOUT", "10"))  # Attesa massima della prima LIST all'avvio (s)
+WATCH_TIMEOUT = int(os.getenv("WATCH_TIMEOUT", "300"))                  # Durata di una singola WATCH prima di riaprirla (s)
+API_REQUEST_TIMEOUT = float(os.getenv("API_REQUEST_TIMEOUT", "10"))      # Timeout di una chiamata all'API server (s)
 
-app = FastAPI(title="Smart Parking Mobile API")
+# Storico dell'occupazione dei lot (vedi history.py)
+HISTORY_PATH = os.getenv("HISTORY_PATH", "")                                  # Directory dello storico (vuoto = disabilitato)
+HISTORY_RETENTION_RAW = float(os.getenv("HISTORY_RETENTION_RAW", "172800"))   # Secondi di eventi grezzi conservati
+HISTORY_RETENTION_1M = float(os.getenv("HISTORY_RETENTION_1M", "604800"))     # Secondi di aggregati a 1 minuto
+HISTORY_RETENTION_15M = float(os.getenv("HISTORY_RETENTION_15M", "2592000"))  # Secondi di aggregati a 15 minuti
+HISTORY_RETENTION_1H = float(os.getenv("HISTORY_RETENTION_1H", "31536000"))   # Secondi di aggregati a 1 ora (0 = illimitati)
+HISTORY_MAX_POINTS = int(os.getenv("HISTORY_MAX_POINTS", "2000"))             # Punti massimi per richiesta
 
-# Inizializza client Kubernetes (in-cluster o kubeconfig)
+# Query puntuali su lot e stalli (vedi lotindex.py)
+QUERY_DEFAULT_LIMIT = int(os.getenv("QUERY_DEFAULT_LIMIT", "100"))  # Elementi per pagina se limit non e' indicato
+QUERY_MAX_LIMIT = int(os.getenv("QUERY_MAX_LIMIT", "1000"))         # Elementi massimi per pagina
+
+# Previsione dei posti liberi (vedi forecast.py)
+FORECAST_INTERVAL = float(os.getenv("FORECAST_INTERVAL", "60"))             # Secondi tra due ricalcoli (0 = disabilitata)
+FORECAST_HORIZONS = os.getenv("FORECAST_HORIZONS", "5,15,30")              # Orizzonti in minuti
+FORECAST_TAU = float(os.getenv("FORECAST_TAU", "900"))                      # Costante di tempo dei tassi attuali (s)
+FORECAST_PROFILE_ALPHA = float(os.getenv("FORECAST_PROFILE_ALPHA", "0.2"))  # Peso di un nuovo giorno nei profili orari
+FORECAST_PATH = os.getenv("FORECAST_PATH", "")                              # File dei profili orari (vuoto = solo in memoria)
+
+log = setup_logging("mobile-api")
+
+# Inizializza client Kubernetes (in-cluster o kubeconfig); le chiamate all'API server sono misurate
 load_kube_config_safely()
-crd = k8s_client.CustomObjectsApi()
+crd = k8s_client.CustomObjectsApi(instrument_k8s(k8s_client.ApiClient()))
 
 
-def list_lots_data() -> List[Dict[str, Any]]:
-    # Funzione per leggere e normalizzare i dati dei ParkingLot
-    # Restituisce una lista di dict con info su ogni parcheggio
-    items: List[Dict[str, Any]] = []
+def normalize_lot(item: Dict[str, Any]) -> Dict[str, Any]:
+    # Normalizza un ParkingLot nel dict esposto dalle API
+    meta = item.get("metadata", {})
+    spec = item.get("spec", {}) or {}
+    status = item.get("status", {}) or {}
+
+    name = meta.get("name", "")
+    lot_id = spec.get("lotId") or name.upper()
+    total = int(spec.get("totalSpaces", 0) or 0)
+    occupied = int(status.get("occupied", 0) or 0)
+    free = int(status.get("free", max(0, total - occupied)) or 0)
+    offline = int(status.get("offline", 0) or 0)
+    last_update = status.get("lastUpdate")
+
+    return {
+        "name": name,
+        "lotId": lot_id,
+        "totalSpaces": total,
+        "occupied": occupied,
+        "free": free,
+        "offline": offline,
+        "lastUpdate": last_update,
+    }
+
+
+def normalize_space(item: Dict[str, Any]) -> Dict[str, Any]:
+    # Normalizza un ParkingSpace nel dict esposto dalle API
+    meta = item.get("metadata", {})
+    spec = item.get("spec", {}) or {}
+    status = item.get("status", {}) or {}
+
+    name = meta.get("name", "")
+    return {
+        "name": name,
+        "lotId": spec.get("lotId") or "",
+        "spaceId": spec.get("spaceId") or name.upper(),
+        "occupied": bool(status.get("occupied", False)),
+        "sensorOnline": bool(status.get("sensorOnline", False)),
+        "lastSeen": status.get("lastSeen"),
+    }
+
+
+# Cache locali di ParkingLot e ParkingSpace (LIST iniziale + WATCH): le richieste non interrogano l'API server
+lots_informer = Informer(crd, GROUP, VERSION, NAMESPACE, "parkinglots", normalize_lot, WATCH_TIMEOUT,
+                         API_REQUEST_TIMEOUT)
+spaces_informer = Informer(crd, GROUP, VERSION, NAMESPACE, "parkingspaces", normalize_space, WATCH_TIMEOUT,
+                           API_REQUEST_TIMEOUT)
+
+# Indice per lotId, posti liberi e stato degli stalli: le query puntuali costano in proporzione al risultato
+lot_index = LotIndex()
+lots_informer.add_listener(lot_index.on_lot)
+spaces_informer.add_listener(lot_index.on_space)
+
+# Tassi di arrivo/partenza aggiornati ad ogni transizione; le previsioni sono ricalcolate in background
+forecaster = (Forecaster([int(h) for h in FORECAST_HORIZONS.split(",") if h.strip()], FORECAST_INTERVAL,
+                         FORECAST_TAU, FORECAST_PROFILE_ALPHA, FORECAST_PATH)
+              if FORECAST_INTERVAL > 0 else None)
+if forecaster is not None:
+    lots_informer.add_listener(forecaster.on_lot)
+    spaces_informer.add_listener(forecaster.on_space)
+
+
+def parse_time(value: str) -> float:
+    # Istante come secondi Unix oppure ISO 8601 (senza fuso = UTC)
     try:
-        resp = crd.list_namespaced_custom_object(GROUP, VERSION, NAMESPACE, "parkinglots")
-        for item in resp.get("items", []):
-            meta = item.get("metadata", {})
-            spec = item.get("spec", {}) or {}
-            status = item.get("status", {}) or {}
-
-            name = meta.get("name", "")
-            lot_id = spec.get("lotId") or name.upper()
-            total = int(spec.get("totalSpaces", 0) or 0)
-            occupied = int(status.get("occupied", 0) or 0)
-            free = int(status.get("free", max(0, total - occupied)) or 0)
-            last_update = status.get("lastUpdate")
-
-            items.append({
-                "name": name,
-                "lotId": lot_id,
-                "totalSpaces": total,
-                "occupied": occupied,
-                "free": free,
-                "lastUpdate": last_update,
-            })
-    except Exception:
-        return []
-    return items
+        return float(value)
+    except ValueError:
+        pass
+    dt = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    return dt.timestamp() if dt.tzinfo is not None else dt.replace(tzinfo=timezone.utc).timestamp()
+
+
+# Ogni variazione di un ParkingLot vista dall'informer e' una transizione di occupazione del lot:
+# l'istante e' il lastUpdate scritto dall'aggregator
+history = (HistoryStore(HISTORY_PATH, HISTORY_RETENTION_RAW, {60: HISTORY_RETENTION_1M, 900: HISTORY_RETENTION_15M,
+                                                              3600: HISTORY_RETENTION_1H})
+           if HISTORY_PATH else None)
+
+
+def record_history(_event: str, _name: str, obj: Optional[Dict[str, Any]], _prev):
+    if obj is None:
+        return
+    try:
+        ts = parse_time(obj["lastUpdate"]) if obj.get("lastUpdate") else time.time()
+    except ValueError:
+        ts = time.time()
+    history.record(obj["lotId"], ts, obj["occupied"], obj["free"], obj["offline"])
+
+
+if history is not None:
+    lots_informer.add_listener(record_history)
 
+# Risposta di /lots serializzata una volta per versione dei dati (ETag/304, gzip/brotli)
+lots_response = CachedJSONResponse("/lots", lambda: list_lots_data())
+lots_informer.add_listener(lambda *_args: lots_response.invalidate())
+
+
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    lots_informer.start()
+    spaces_informer.start()
+    # Attende (con timeout) la prima LIST, cosi' le prime richieste non vedono una cache vuota;
+    # le due LIST procedono in parallelo, ciascuna nel thread del proprio informer
+    await asyncio.gather(run_in_threadpool(lots_informer.wait_synced, INFORMER_SYNC_TIMEOUT),
+                         run_in_threadpool(spaces_informer.wait_synced, INFORMER_SYNC_TIMEOUT))
+    if forecaster is not None:
+        forecaster.start()
+    yield
+    if history is not None:
+        history.close()
+    if forecaster is not None:
+        forecaster.close()
+
+
+app = FastAPI(title="Smart Parking Mobile API", lifespan=lifespan)
+app.add_middleware(RequestMetricsMiddleware)
+
+
+def list_lots_data() -> List[Dict[str, Any]]:
+    # Restituisce i ParkingLot normalizzati dalla cache locale
+    return lots_informer.list()
+
+
+# Gli handler leggono solo la memoria: girano direttamente sull'event loop, senza occupare il threadpool.
+# Fa eccezione /lots/{lotId}/history, che legge i file dello storico e resta nel threadpool
 
 @app.get("/health", response_class=PlainTextResponse)
-def health() -> str:
+async def health() -> str:
     # Endpoint /health: diagnostica
     return "ok"
 
 
+@app.get("/metrics")
+async def metrics():
+    # Endpoint /metrics: metriche Prometheus del servizio
+    body, content_type = metrics_response()
+    return Response(body, media_type=content_type)
+
+
+def page_limit(limit: Optional[int]) -> int:
+    if limit is None:
+        return QUERY_DEFAULT_LIMIT
+    if limit < 1 or limit > QUERY_MAX_LIMIT:
+        raise HTTPException(400, f"limit: tra 1 e {QUERY_MAX_LIMIT}")
+    return limit
+
+
 @app.get("/lots")
-def lots():
-    # Endpoint /lots: restituisce i dati dei parcheggi in JSON
-    return JSONResponse(list_lots_data())
+async def lots(request: Request, min_free: Optional[int] = Query(None, alias="minFree"), limit: Optional[int] = None):
+    # Endpoint /lots: restituisce i dati dei parcheggi in JSON (304 se il client ha gia' la versione corrente).
+    # Con minFree solo i lot con almeno minFree posti liberi, dal piu' libero, letti dall'indice
+    if min_free is None:
+        return await lots_response.respond(request)
+    if min_free < 0:
+        raise HTTPException(400, "minFree: intero non negativo")
+    return JSONResponse(lot_index.lots_with_free(min_free, page_limit(limit)))
+
+
+@app.get("/lots/{lot_id}")
+async def lot(lot_id: str):
+    # Endpoint /lots/{lotId}: un singolo lot
+    item = lot_index.lot(lot_id)
+    if item is None:
+        raise HTTPException(404, f"lot {lot_id} non trovato")
+    return JSONResponse(item)
+
+
+@app.get("/lots/{lot_id}/spaces")
+async def lot_spaces(lot_id: str, occupied: Optional[bool] = None, online: Optional[bool] = None,
+                     limit: Optional[int] = None, cursor: Optional[str] = None):
+    # Endpoint /lots/{lotId}/spaces: stalli del lot in ordine di spaceId, filtrabili per stato e paginati;
+    # cursor = nextCursor della pagina precedente
+    if lot_index.lot(lot_id) is None:
+        raise HTTPException(404, f"lot {lot_id} non trovato")
+    items, next_cursor = lot_index.spaces(lot_id, occupied, online, page_limit(limit), cursor)
+    return JSONResponse({"lotId": lot_id, "items": items, "nextCursor": next_cursor})
+
+
+@app.get("/lots/{lot_id}/forecast")
+async def lot_forecast(lot_id: str):
+    # Endpoint /lots/{lotId}/forecast: posti liberi previsti, letti dalla tabella precalcolata
+    if forecaster is None:
+        raise HTTPException(404, "previsione non abilitata (FORECAST_INTERVAL)")
+    result = forecaster.get(lot_id)
+    if result is None:
+        raise HTTPException(404, f"lot {lot_id} senza previsione")
+    return JSONResponse(result)
+
+
+@app.get("/lots/{lot_id}/history")
+def lot_history(lot_id: str, from_: Optional[str] = Query(None, alias="from"), to: Optional[str] = None,
+                step: int = 300):
+    # Endpoint /lots/{lotId}/history: occupazione del lot a passo costante, servita dagli aggregati
+    # (default: ultime 24 ore a passo di 5 minuti)
+    if history is None:
+        raise HTTPException(404, "storico non abilitato (HISTORY_PATH)")
+    try:
+        t_to = parse_time(to) if to else time.time()
+        t_from = parse_time(from_) if from_ else t_to - 86400
+    except ValueError:
+        raise HTTPException(400, "from/to: secondi Unix oppure ISO 8601")
+    if step < 60 or step % 60:
+        raise HTTPException(400, "step: multiplo di 60 secondi")
+    if t_from >= t_to:
+        raise HTTPException(400, "from deve precedere to")
+    if (t_to - t_from) / step > HISTORY_MAX_POINTS:
+        raise HTTPException(400, f"troppi punti: al massimo {HISTORY_MAX_POINTS}, aumentare step")
+    result = history.query(lot_id, t_from, t_to, step)
+    if result is None:
+        raise HTTPException(404, f"lot {lot_id} senza storico")
+    return JSONResponse(result)
 
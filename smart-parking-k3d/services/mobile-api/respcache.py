@@ -0,0 +1,169 @@
+# Cache delle risposte JSON pre-serializzate
+# Lo stesso modulo e' copiato in signage e mobile-api (come informer.py).
+# Il corpo di una risposta viene serializzato una sola volta per versione dei dati: i listener degli informer
+# chiamano invalidate() ad ogni variazione e la richiesta successiva ricostruisce il corpo. Le varianti
+# gzip/brotli vengono compresse alla prima richiesta che le accetta e restano in cache con il corpo.
+# L'ETag e' un hash del contenuto: un client che ripete la richiesta con If-None-Match riceve 304
+# senza corpo, anche da un'altra replica o dopo un riavvio se i dati non sono cambiati.
+# respond() gira sull'event loop: la richiesta servita dalla cache non lascia mai il loop, mentre
+# serializzazione e compressione (una volta per versione) vengono eseguite nel threadpool.
+import gzip
+import hashlib
+import itertools
+import json
+import threading
+from typing import Any, Callable, Dict, Optional
+
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+from starlette.responses import Response
+
+from metrics import RESPONSE_CACHE
+
+try:
+    import brotli
+except ImportError:  # brotli e' opzionale: senza il modulo si servono solo gzip e identity
+    brotli = None
+
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+MIN_COMPRESS_SIZE = 512   # sotto questa dimensione la compressione non conviene
+
+
+def _accepted_encodings(header: str) -> Dict[str, float]:
+    # Accept-Encoding -> {codifica: q}
+    out = {}
+    for part in header.split(","):
+        fields = part.strip().split(";")
+        name = fields[0].strip().lower()
+        if not name:
+            continue
+        q = 1.0
+        for f in fields[1:]:
+            f = f.strip()
+            if f.startswith("q="):
+                try:
+                    q = float(f[2:])
+                except ValueError:
+                    q = 0.0
+        out[name] = q
+    return out
+
+
+def _etag_matches(header: str, etag: str) -> bool:
+    # Confronto debole (RFC 9110): W/"x" e "x" sono equivalenti
+    if header.strip() == "*":
+        return True
+    tag = etag[2:] if etag.startswith("W/") else etag
+    return any((t.strip()[2:] if t.strip().startswith("W/") else t.strip()) == tag for t in header.split(","))
+
+
+class _Entry:
+    __slots__ = ("generation", "etag", "bodies")
+
+    def __init__(self, generation: int, etag: str, body: bytes):
+        self.generation = generation
+        self.etag = etag
+        self.bodies: Dict[str, bytes] = {"identity": body}
+
+
+class CachedJSONResponse:
+    """Risposta JSON serializzata una volta per versione dei dati, con ETag/304 e varianti compresse.
+
+    ``build`` produce l'oggetto da serializzare leggendo le cache in memoria; ``invalidate()`` va chiamata
+    dopo ogni variazione dei dati sottostanti.
+    """
+
+    def __init__(self, route: str, build: Callable[[], Any]):
+        # route: etichetta delle metriche
+        self._build = build
+        self._lock = threading.Lock()
+        self._counter = itertools.count(1)
+        self._generation = 0
+        self._entry: Optional[_Entry] = None
+        self._hit = RESPONSE_CACHE.labels(route, "hit")
+        self._miss = RESPONSE_CACHE.labels(route, "miss")
+        self._not_modified = RESPONSE_CACHE.labels(route, "not_modified")
+
+    def invalidate(self):
+        # Chiamata dai listener degli informer (anche da thread diversi): next() su itertools.count e' atomico,
+        # la serializzazione avviene alla richiesta
+        self._generation = next(self._counter)
+
+    async def respond(self, request: Request) -> Response:
+        entry = self._fresh()
+        if entry is None:
+            entry = await run_in_threadpool(self._current)
+        headers = {"ETag": entry.etag, "Vary": "Accept-Encoding", "Cache-Control": "no-cache"}
+        inm = request.headers.get("if-none-match")
+        if inm and _etag_matches(inm, entry.etag):
+            self._not_modified.inc()
+            return Response(status_code=304, headers=headers)
+        encoding = self._choose_encoding(request.headers.get("accept-encoding", ""), entry)
+        body = entry.bodies.get(encoding)
+        if body is None:
+            body = await run_in_threadpool(self._variant, entry, encoding)
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+        return Response(body, media_type="application/json", headers=headers)
+
+    async def body(self) -> bytes:
+        # Corpo JSON (non compresso) della versione corrente, per chi lo incapsula in un'altra risposta
+        entry = self._fresh()
+        if entry is None:
+            entry = await run_in_threadpool(self._current)
+        return entry.bodies["identity"]
+
+    # ---------- interni ----------
+    def _fresh(self) -> Optional[_Entry]:
+        # Corpo della versione corrente se gia' serializzato, senza prendere il lock
+        entry = self._entry
+        if entry is not None and entry.generation == self._generation:
+            self._hit.inc()
+            return entry
+        return None
+
+    def _current(self) -> _Entry:
+        with self._lock:
+            # Una sola ricostruzione per versione: le richieste concorrenti attendono e trovano il corpo pronto
+            entry = self._entry
+            generation = self._generation
+            if entry is not None and entry.generation == generation:
+                self._hit.inc()
+                return entry
+            self._miss.inc()
+            # La generazione e' letta prima della build: una variazione concorrente forza un'altra ricostruzione
+            body = json.dumps(self._build(), ensure_ascii=False, allow_nan=False,
+                              separators=(",", ":")).encode("utf-8")
+            etag = 'W/"' + hashlib.blake2b(body, digest_size=12).hexdigest() + '"'
+            if entry is not None and entry.etag == etag:
+                # Contenuto invariato (es. variazione poi rientrata): le varianti compresse restano valide
+                entry.generation = generation
+            else:
+                entry = _Entry(generation, etag, body)
+            self._entry = entry
+            return entry
+
+    def _choose_encoding(self, header: str, entry: _Entry) -> str:
+        if not header or len(entry.bodies["identity"]) < MIN_COMPRESS_SIZE:
+            return "identity"
+        accepted = _accepted_encodings(header)
+        if brotli is not None and accepted.get("br", 0) > 0:
+            return "br"
+        if accepted.get("gzip", 0) > 0:
+            return "gzip"
+        return "identity"
+
+    def _variant(self, entry: _Entry, encoding: str) -> bytes:
+        body = entry.bodies.get(encoding)
+        if body is None:
+            with self._lock:
+                body = entry.bodies.get(encoding)
+                if body is None:
+                    raw = entry.bodies["identity"]
+                    if encoding == "br":
+                        body = brotli.compress(raw, quality=BROTLI_QUALITY)
+                    else:
+                        body = gzip.compress(raw, compresslevel=GZIP_LEVEL, mtime=0)
+                    entry.bodies[encoding] = body
+        return body
@@ -0,0 +1,466 @@
+# Generatore di carico per Smart Parking
+# Migliaia di sensori virtuali pubblicano su poche connessioni MQTT, tutte pilotate da un solo event loop
+# asyncio (nessun thread per sensore). Con lwt=True ogni sensore ha invece una propria connessione con
+# Last Will, sempre sullo stesso event loop, cosi' le disconnessioni reali restano simulabili.
+import asyncio
+import bisect
+import heapq
+import logging
+import random
+import socket
+import time
+from typing import Callable, Dict, List, Optional, Union
+
+import paho.mqtt.client as mqtt
+
+from payload import encode_lot, encode_status, lot_topic, status_topic
+
+log = logging.getLogger("loadgen")
+
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+
+class Histogram:
+    # Istogramma a bucket fissi (limite superiore incluso); l'ultimo bucket raccoglie i valori oltre il massimo
+
+    def __init__(self, buckets: tuple):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q: float) -> float:
+        # Stima del quantile come limite superiore del bucket che lo contiene
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen >= rank:
+                return float(self.buckets[i]) if i < len(self.buckets) else self.max
+        return self.max
+
+    def snapshot(self) -> dict:
+        avg = self.sum / self.count if self.count else 0.0
+        return {"count": self.count, "avg": avg, "max": self.max, "p50": self.quantile(0.5), "p99": self.quantile(0.99)}
+
+
+def _exact_quantile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+# ---------- Pattern di arrivo ----------
+class SteadyPattern:
+    # Traffico costante: ogni sensore pubblica ad intervallo fisso e cambia stato con probabilita' flap
+    name = "steady"
+
+    def __init__(self, flap: float):
+        self.flap = flap
+
+    def interval_factor(self, _t: float) -> float:
+        return 1.0
+
+    def next_occupied(self, occupied: bool, _t: float, rng: random.Random) -> bool:
+        return (not occupied) if rng.random() < self.flap else occupied
+
+
+class RushPattern(SteadyPattern):
+    # Ora di punta: ogni period secondi una raffica di duration secondi con pubblicazioni factor volte piu'
+    # frequenti; le raffiche si alternano tra arrivi (stalli che si occupano) e partenze (stalli che si liberano)
+    name = "rush"
+
+    def __init__(self, flap: float, period: float, duration: float, factor: float, rush_flap: float):
+        super().__init__(flap)
+        self.period = max(1.0, period)
+        self.duration = min(max(0.0, duration), self.period)
+        self.factor = max(1.0, factor)
+        self.rush_flap = rush_flap
+
+    def _burst(self, t: float) -> Optional[bool]:
+        # None fuori dalla raffica, altrimenti lo stato verso cui tendono gli stalli
+        if t % self.period >= self.duration:
+            return None
+        return int(t // self.period) % 2 == 0
+
+    def interval_factor(self, t: float) -> float:
+        return 1.0 / self.factor if self._burst(t) is not None else 1.0
+
+    def next_occupied(self, occupied: bool, t: float, rng: random.Random) -> bool:
+        target = self._burst(t)
+        if target is None:
+            return super().next_occupied(occupied, t, rng)
+        return target if occupied != target and rng.random() < self.rush_flap else occupied
+
+
+class MassDisconnectPattern(SteadyPattern):
+    # Traffico costante, ma ogni period secondi una frazione dei sensori va offline per duration secondi
+    name = "mass-disconnect"
+
+    def __init__(self, flap: float, period: float, duration: float, fraction: float):
+        super().__init__(flap)
+        self.period = max(1.0, period)
+        self.duration = max(0.0, duration)
+        self.fraction = min(max(0.0, fraction), 1.0)
+
+
+def make_pattern(name: str, flap: float, rush_period: float = 300, rush_duration: float = 60,
+                 rush_factor: float = 5, rush_flap: float = 0.5, disconnect_period: float = 120,
+                 disconnect_duration: float = 30, disconnect_fraction: float = 0.3) -> SteadyPattern:
+    if name == "steady":
+        return SteadyPattern(flap)
+    if name == "rush":
+        return RushPattern(flap, rush_period, rush_duration, rush_factor, rush_flap)
+    if name == "mass-disconnect":
+        return MassDisconnectPattern(flap, disconnect_period, disconnect_duration, disconnect_fraction)
+    raise ValueError(f"pattern sconosciuto: {name} (steady, rush, mass-disconnect)")
+
+
+# ---------- Connessioni MQTT sull'event loop ----------
+class _Connection:
+    # Client paho i cui socket sono gestiti da asyncio (add_reader/add_writer) invece che da un thread di rete
+
+    def __init__(self, gen: "LoadGenerator", client_id: str, sensor: Optional["_Sensor"] = None):
+        self.gen = gen
+        self.client_id = client_id
+        self.sensor = sensor  # sensore proprietario (solo con una connessione per sensore)
+        self.connected = False
+        self.active = True    # False dopo drop(): la connessione non viene riaperta automaticamente
+        self.inflight: Dict[int, float] = {}
+        c = mqtt.Client(client_id=client_id, clean_session=True)
+        c.max_inflight_messages_set(gen.max_inflight)
+        c.max_queued_messages_set(0)
+        c.on_socket_open = self._on_socket_open
+        c.on_socket_close = self._on_socket_close
+        c.on_socket_register_write = self._on_register_write
+        c.on_socket_unregister_write = self._on_unregister_write
+        c.on_connect = self._on_connect
+        c.on_disconnect = self._on_disconnect
+        c.on_publish = self._on_publish
+        if gen.tls is not None:
+            c.tls_set(**gen.tls)
+            c.tls_insecure_set(False)
+        self.client = c
+
+    def connect(self):
+        self.active = True
+        try:
+            self.client.connect(self.gen.host, self.gen.port, keepalive=self.gen.keepalive)
+        except (OSError, ValueError) as e:
+            self.gen.stats.connect_errors += 1
+            log.warning(f"[LOADGEN] connessione {self.client_id} fallita: {e}")
+            self.gen.schedule_reconnect(self)
+
+    def drop(self):
+        # Chiusura brusca del socket senza DISCONNECT: il broker pubblica la Last Will
+        self.active = False
+        sock = self.client.socket()
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def publish(self, topic: str, payload: Union[str, bytes], qos: int, retain: bool) -> bool:
+        start = time.monotonic()
+        info = self.client.publish(topic, payload, qos=qos, retain=retain)
+        if info.rc != mqtt.MQTT_ERR_SUCCESS:
+            return False
+        if info.is_published():
+            self.gen.stats.ack((time.monotonic() - start) * 1000.0)
+        else:
+            self.inflight[info.mid] = start
+        return True
+
+    # ---------- callback ----------
+    def _on_socket_open(self, _client, _userdata, sock):
+        self.gen.loop.add_reader(sock, self.client.loop_read)
+
+    def _on_socket_close(self, _client, _userdata, sock):
+        self.gen.loop.remove_reader(sock)
+        self.gen.loop.remove_writer(sock)
+
+    def _on_register_write(self, _client, _userdata, sock):
+        self.gen.loop.add_writer(sock, self.client.loop_write)
+
+    def _on_unregister_write(self, _client, _userdata, sock):
+        self.gen.loop.remove_writer(sock)
+
+    def _on_connect(self, _client, _userdata, _flags, rc):
+        if rc != 0:
+            log.warning(f"[LOADGEN] connessione {self.client_id} rifiutata rc={rc}")
+            return
+        self.connected = True
+        if self is self.gen.connections[0]:
+            # Annuncio retained dei lot, ripetuto a ogni connessione (il broker potrebbe averlo perso)
+            for lot_id in self.gen.lot_ids:
+                self.client.publish(lot_topic(lot_id), encode_lot(lot_id), qos=1, retain=True)
+        if self.sensor is not None:
+            # Birth del sensore: annulla la Last Will eventualmente pubblicata dal broker
+            self.sensor.online = True
+            self.gen.publish_state(self.sensor)
+
+    def _on_disconnect(self, _client, _userdata, rc):
+        self.connected = False
+        self.inflight.clear()
+        if rc != 0 and self.active:
+            self.gen.stats.disconnects += 1
+            self.gen.schedule_reconnect(self)
+
+    def _on_publish(self, _client, _userdata, mid):
+        start = self.inflight.pop(mid, None)
+        if start is not None:
+            self.gen.stats.ack((time.monotonic() - start) * 1000.0)
+
+
+class _Sensor:
+    __slots__ = ("lot_id", "space_id", "topic", "sensor_id", "occupied", "online", "conn")
+
+    def __init__(self, lot_id: str, space_id: str, sensor_id: str, payload_format: str):
+        self.lot_id = lot_id
+        self.space_id = space_id
+        self.topic = status_topic(lot_id, space_id, payload_format)
+        self.sensor_id = sensor_id
+        self.occupied = False
+        self.online = True
+        self.conn: Optional[_Connection] = None
+
+
+class LoadStats:
+    # Contatori di pubblicazione; la finestra corrente viene azzerata ad ogni report
+
+    def __init__(self):
+        self.sent = 0
+        self.bytes = 0            # byte di payload pubblicati
+        self.acked = 0
+        self.failed = 0
+        self.skipped = 0          # pubblicazioni saltate perche' la connessione non era attiva
+        self.disconnects = 0      # disconnessioni inattese
+        self.connect_errors = 0
+        self.latency = Histogram(LATENCY_BUCKETS_MS)
+        self._window: List[float] = []
+        self._window_sent = 0
+        self._window_start = time.monotonic()
+
+    def ack(self, latency_ms: float):
+        self.acked += 1
+        self.latency.observe(latency_ms)
+        self._window.append(latency_ms)
+
+    def window(self) -> dict:
+        now = time.monotonic()
+        elapsed = max(1e-9, now - self._window_start)
+        lat = self._window
+        snap = {"rate": (self.sent - self._window_sent) / elapsed, "acked": len(lat),
+                "p50": _exact_quantile(lat, 0.5), "p99": _exact_quantile(lat, 0.99), "max": max(lat, default=0.0)}
+        self._window = []
+        self._window_sent = self.sent
+        self._window_start = now
+        return snap
+
+
+class LoadGenerator:
+    # lots x spaces sensori virtuali; rate = messaggi/s complessivi (0 = uno ogni interval secondi per sensore)
+    # connections: connessioni condivise (ignorato con lwt=True, dove ogni sensore ha la propria connessione)
+    # payload_format: formato dei messaggi di stato, "json" oppure "binary" (vedi payload.py)
+
+    def __init__(self, host: str, port: int, lot_ids: List[str], spaces_per_lot: int, pattern: SteadyPattern,
+                 interval: float = 2.0, rate: float = 0.0, connections: int = 4, lwt: bool = False, qos: int = 1,
+                 retain: bool = True, tls: Optional[dict] = None, keepalive: int = 30, max_inflight: int = 1000,
+                 connect_rate: float = 200.0, report_interval: float = 10.0, client_prefix: str = "loadgen",
+                 seed: Optional[int] = None, on_report: Optional[Callable[[dict], None]] = None,
+                 on_sent: Optional[Callable[["_Sensor", float], None]] = None, payload_format: str = "json"):
+        self.host, self.port = host, port
+        self.pattern = pattern
+        self.lwt = lwt
+        self.qos = qos
+        self.retain = retain
+        self.payload_format = payload_format
+        self.tls = tls
+        self.keepalive = keepalive
+        self.max_inflight = max(1, max_inflight)
+        self.connection_count = max(1, connections)
+        self.connect_rate = max(1.0, connect_rate)
+        self.report_interval = report_interval
+        self.on_report = on_report
+        self.on_sent = on_sent  # chiamata dopo ogni pubblicazione accettata (sensore, istante monotonic)
+        self.rng = random.Random(seed)
+        self.lot_ids = list(lot_ids)
+        self.stats = LoadStats()
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self._prefix = f"{client_prefix}-{random.randint(1000, 9999)}"
+        self.sensors = [_Sensor(lot_id, f"{lot_id}-{i + 1}", f"{self._prefix}-{lot_id}-{i + 1}", payload_format)
+                        for lot_id in lot_ids for i in range(spaces_per_lot)]
+        n = len(self.sensors)
+        self.interval = n / rate if rate > 0 else max(0.001, interval)
+        self.connections: List[_Connection] = []
+        self._reconnects: List[_Connection] = []
+
+    # ---------- API ----------
+    def run(self, duration: float = 0.0) -> dict:
+        return asyncio.run(self.run_async(duration))
+
+    async def run_async(self, duration: float = 0.0) -> dict:
+        self.loop = asyncio.get_running_loop()
+        self._setup_connections()
+        start = time.monotonic()
+        tasks = [self.loop.create_task(self._connect_all()),
+                 self.loop.create_task(self._misc_loop()),
+                 self.loop.create_task(self._publish_loop())]
+        if isinstance(self.pattern, MassDisconnectPattern):
+            tasks.append(self.loop.create_task(self._disconnect_loop()))
+        if self.report_interval > 0:
+            tasks.append(self.loop.create_task(self._report_loop()))
+        try:
+            if duration > 0:
+                await asyncio.sleep(duration)
+            else:
+                await asyncio.Event().wait()
+        finally:
+            for t in tasks:
+                t.cancel()
+            await self._drain(2.0)
+            for conn in self.connections:
+                if conn.connected:
+                    conn.client.disconnect()
+        return self.summary(time.monotonic() - start)
+
+    def summary(self, elapsed: float) -> dict:
+        s = self.stats
+        return {
+            "pattern": self.pattern.name, "sensors": len(self.sensors), "connections": len(self.connections),
+            "lwt": self.lwt, "qos": self.qos, "payloadFormat": self.payload_format,
+            "targetRate": len(self.sensors) / self.interval,
+            "elapsed": elapsed, "sent": s.sent, "payloadBytes": s.bytes, "acked": s.acked, "failed": s.failed, "skipped": s.skipped,
+            "disconnects": s.disconnects, "connectErrors": s.connect_errors,
+            "publishRate": s.sent / elapsed if elapsed > 0 else 0.0,
+            "ackLatencyMs": s.latency.snapshot(),
+        }
+
+    def publish_state(self, sensor: _Sensor) -> bool:
+        conn = sensor.conn
+        if conn is None or not conn.connected:
+            self.stats.skipped += 1
+            return False
+        payload = encode_status(self.payload_format, sensor.occupied, sensor.online, int(time.time()),
+                                sensor.lot_id, sensor.space_id, sensor.sensor_id)
+        if conn.publish(sensor.topic, payload, self.qos, self.retain):
+            self.stats.sent += 1
+            self.stats.bytes += len(payload)
+            if self.on_sent is not None:
+                self.on_sent(sensor, time.monotonic())
+            return True
+        self.stats.failed += 1
+        return False
+
+    def schedule_reconnect(self, conn: _Connection):
+        if conn not in self._reconnects:
+            self._reconnects.append(conn)
+
+    # ---------- interni ----------
+    def _setup_connections(self):
+        if self.lwt:
+            for s in self.sensors:
+                conn = _Connection(self, s.sensor_id, s)
+                lwt = encode_status(self.payload_format, None, False, int(time.time()), s.lot_id, s.space_id, s.sensor_id)
+                conn.client.will_set(s.topic, payload=lwt, qos=1, retain=True)
+                s.conn = conn
+                self.connections.append(conn)
+        else:
+            count = max(1, min(len(self.sensors), self.connection_count))
+            self.connections = [_Connection(self, f"{self._prefix}-{i}") for i in range(count)]
+            for i, s in enumerate(self.sensors):
+                s.conn = self.connections[i % count]
+
+    async def _connect_all(self):
+        # Le connessioni vengono aperte a ritmo limitato per non generare a sua volta una tempesta sul broker
+        pause = 1.0 / self.connect_rate
+        for conn in self.connections:
+            conn.connect()
+            await asyncio.sleep(pause)
+        while True:
+            await asyncio.sleep(1.0)
+            pending, self._reconnects = self._reconnects, []
+            for conn in pending:
+                if conn.active and not conn.connected:
+                    conn.connect()
+                    await asyncio.sleep(pause)
+
+    async def _misc_loop(self):
+        # Keepalive e ritrasmissioni per tutti i client con un solo task
+        while True:
+            await asyncio.sleep(1.0)
+            for conn in self.connections:
+                if conn.client.socket() is not None:
+                    conn.client.loop_misc()
+
+    async def _publish_loop(self):
+        # Scheduler unico: heap di (prossima pubblicazione, indice sensore)
+        t0 = self.loop.time()
+        heap = [(t0 + self.rng.uniform(0, self.interval), i) for i in range(len(self.sensors))]
+        heapq.heapify(heap)
+        while True:
+            now = self.loop.time()
+            while heap and heap[0][0] <= now:
+                _, i = heapq.heappop(heap)
+                s = self.sensors[i]
+                t = now - t0
+                if s.online:
+                    s.occupied = self.pattern.next_occupied(s.occupied, t, self.rng)
+                    self.publish_state(s)
+                step = self.interval * self.pattern.interval_factor(t)
+                heapq.heappush(heap, (now + step * self.rng.uniform(0.9, 1.1), i))
+            await asyncio.sleep(max(0.0, heap[0][0] - self.loop.time()) if heap else 1.0)
+
+    async def _disconnect_loop(self):
+        p: MassDisconnectPattern = self.pattern
+        while True:
+            await asyncio.sleep(p.period)
+            victims = self.rng.sample(self.sensors, int(len(self.sensors) * p.fraction))
+            log.info(f"[LOADGEN] disconnessione di massa: {len(victims)} sensori offline per {p.duration:.0f}s")
+            for s in victims:
+                s.online = False
+                if self.lwt:
+                    s.conn.drop()
+                else:
+                    # Connessione condivisa: la Last Will del sensore viene emulata con un messaggio esplicito
+                    self.publish_state(s)
+            await asyncio.sleep(p.duration)
+            for s in victims:
+                if self.lwt:
+                    s.conn.connect()  # il birth viene pubblicato in on_connect
+                    await asyncio.sleep(1.0 / self.connect_rate)
+                else:
+                    s.online = True
+                    self.publish_state(s)
+
+    async def _report_loop(self):
+        while True:
+            await asyncio.sleep(self.report_interval)
+            w = self.stats.window()
+            connected = sum(1 for c in self.connections if c.connected)
+            inflight = sum(len(c.inflight) for c in self.connections)
+            online = sum(1 for s in self.sensors if s.online)
+            log.info(f"[LOADGEN] pattern={self.pattern.name} rate={w['rate']:.0f}/{len(self.sensors) / self.interval:.0f} msg/s "
+                     f"ack={w['acked']} in volo={inflight} latenza p50/p99/max={w['p50']:.1f}/{w['p99']:.1f}/{w['max']:.1f}ms "
+                     f"connessioni={connected}/{len(self.connections)} sensori online={online} "
+                     f"saltati={self.stats.skipped} errori={self.stats.failed}")
+            if self.on_report is not None:
+                self.on_report(w)
+
+    async def _drain(self, timeout: float):
+        # Attende gli ack delle pubblicazioni ancora in volo prima di chiudere
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline and any(c.inflight for c in self.connections if c.connected):
+            await asyncio.sleep(0.05)
@@ -3,9 +3,13 @@
 import os
 import time
 import json
+import logging
 import random
 import threading
 import paho.mqtt.client as mqtt
+from loadgen import LoadGenerator, make_pattern
+from payload import FORMATS, encode_lot, encode_status, lot_topic, status_topic
+from metrics import MQTT_MESSAGES, MQTT_PUBLISH_FAILURES, log_sampled, setup_logging, start_metrics_server, topic_class
 
 # --- Configurazione tramite variabili d'ambiente ---
 BROKER_HOST = os.getenv("BROKER_HOST", "mosquitto")  # Host del broker MQTT (default: mosquitto nel cluster)
@@ -18,31 +22,61 @@ LOT_ID = os.getenv("LOT_ID", "A")                    # ID parcheggio
 NUM_SPACES = int(os.getenv("NUM_SPACES", "10"))      # Numero stalli simulati
 PUBLISH_INTERVAL = float(os.getenv("PUBLISH_INTERVAL", "2.0")) # Intervallo pubblicazione
 FLAP_PROB = float(os.getenv("FLAP_PROB", "0.25"))   # Probabilità cambio stato
+PAYLOAD_FORMAT = os.getenv("PAYLOAD_FORMAT", "json") # "json" su .../status oppure "binary" (5 byte) su .../status/v1
+
+# --- Modalita' generatore di carico (SIM_MODE=loadgen) ---
+SIM_MODE = os.getenv("SIM_MODE", "sensors")                              # "sensors" (un client per stallo) oppure "loadgen"
+LOADGEN_LOTS = int(os.getenv("LOADGEN_LOTS", "1"))                       # Numero di lot (LOT_ID1..N; 1 = solo LOT_ID)
+LOADGEN_RATE = float(os.getenv("LOADGEN_RATE", "0"))                     # Messaggi/s complessivi (0 = NUM_SPACES/PUBLISH_INTERVAL per lot)
+LOADGEN_PATTERN = os.getenv("LOADGEN_PATTERN", "steady")                 # steady | rush | mass-disconnect
+LOADGEN_CONNECTIONS = int(os.getenv("LOADGEN_CONNECTIONS", "4"))         # Connessioni MQTT condivise dai sensori virtuali
+LOADGEN_LWT = os.getenv("LOADGEN_LWT", "0") == "1"                       # Una connessione con Last Will per ogni sensore
+LOADGEN_QOS = int(os.getenv("LOADGEN_QOS", "1"))                         # QoS delle pubblicazioni
+LOADGEN_MAX_INFLIGHT = int(os.getenv("LOADGEN_MAX_INFLIGHT", "1000"))    # Messaggi QoS>0 in volo per connessione
+LOADGEN_CONNECT_RATE = float(os.getenv("LOADGEN_CONNECT_RATE", "200"))   # Connessioni aperte al secondo
+LOADGEN_DURATION = float(os.getenv("LOADGEN_DURATION", "0"))             # Durata del test in secondi (0 = senza fine)
+LOADGEN_REPORT_INTERVAL = float(os.getenv("LOADGEN_REPORT_INTERVAL", "10")) # Secondi tra due report di rate e latenza
+RUSH_PERIOD = float(os.getenv("RUSH_PERIOD", "300"))                     # Secondi tra l'inizio di due raffiche (rush)
+RUSH_DURATION = float(os.getenv("RUSH_DURATION", "60"))                  # Durata di una raffica (rush)
+RUSH_FACTOR = float(os.getenv("RUSH_FACTOR", "5"))                       # Moltiplicatore della frequenza durante la raffica
+RUSH_FLAP_PROB = float(os.getenv("RUSH_FLAP_PROB", "0.5"))               # Probabilità di arrivo/partenza durante la raffica
+DISCONNECT_PERIOD = float(os.getenv("DISCONNECT_PERIOD", "120"))         # Secondi tra due disconnessioni di massa
+DISCONNECT_DURATION = float(os.getenv("DISCONNECT_DURATION", "30"))      # Secondi offline dei sensori disconnessi
+DISCONNECT_FRACTION = float(os.getenv("DISCONNECT_FRACTION", "0.3"))     # Frazione dei sensori disconnessi
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))                    # Porta di /metrics (0 = disabilitato)
+
+log = setup_logging("sensor-simulator")
+_mqtt_out_status = MQTT_MESSAGES.labels("out", topic_class(status_topic(LOT_ID, "-", PAYLOAD_FORMAT)))
 
 # Funzione per creare e avviare un sensore virtuale
 # Ogni sensore pubblica su un topic dedicato e gestisce LWT (Last Will)
-def make_sensor(space_id: str):
+# announce: il sensore annuncia anche il lot (retained) a ogni connessione
+def make_sensor(space_id: str, announce: bool = False):
     client_id = f"sensor-{LOT_ID}-{space_id}-{os.getpid()}-{random.randint(1000,9999)}"
-    topic = f"parking/{LOT_ID}/{space_id}/status"
+    topic = status_topic(LOT_ID, space_id, PAYLOAD_FORMAT)
     c = mqtt.Client(client_id=client_id, clean_session=True)
     c.reconnect_delay_set(min_delay=1, max_delay=5)
 
     # Imposta Last Will (LWT): messaggio inviato dal broker se il sensore si disconnette
-    lwt = {"occupied": None, "sensorOnline": False, "ts": int(time.time()),
-           "lotId": LOT_ID, "spaceId": space_id, "sensorId": client_id}
-    c.will_set(topic, payload=json.dumps(lwt), qos=1, retain=True)
+    lwt = encode_status(PAYLOAD_FORMAT, None, False, int(time.time()), LOT_ID, space_id, client_id)
+    c.will_set(topic, payload=lwt, qos=1, retain=True)
 
     # Callback su connessione
     def on_connect(client, _userdata, _flags, rc):
-        print(f"[{space_id}] connected rc={rc}")
-        birth = {"occupied": False, "sensorOnline": True, "ts": int(time.time()),
-                 "lotId": LOT_ID, "spaceId": space_id, "sensorId": client_id}
-        client.publish(topic, json.dumps(birth), qos=1, retain=True)
-        print(f"[{space_id}] birth sent")
+        log_sampled(log, logging.INFO, "sensor-connect", "[%s] connected rc=%s", space_id, rc)
+        if PAYLOAD_FORMAT != "json":
+            # Cancella l'eventuale stato retained nel formato JSON: all'avvio l'aggregatore non riceverebbe
+            # due stati dello stesso stallo in ordine indefinito
+            client.publish(status_topic(LOT_ID, space_id), b"", qos=1, retain=True)
+        if announce:
+            client.publish(lot_topic(LOT_ID), encode_lot(LOT_ID), qos=1, retain=True)
+        birth = encode_status(PAYLOAD_FORMAT, False, True, int(time.time()), LOT_ID, space_id, client_id)
+        client.publish(topic, birth, qos=1, retain=True)
+        _mqtt_out_status.inc()
 
     # Callback su disconnessione
     def on_disconnect(_client, _userdata, rc):
-        print(f"[{space_id}] disconnected rc={rc}")
+        log_sampled(log, logging.WARNING, "sensor-disconnect", "[%s] disconnected rc=%s", space_id, rc)
 
     c.on_connect = on_connect
     c.on_disconnect = on_disconnect
@@ -63,25 +97,50 @@ def make_sensor(space_id: str):
         while True:
             if random.random() < FLAP_PROB:
                 occupied = not occupied
-            payload = {
-                "occupied": occupied, "sensorOnline": True, "ts": int(time.time()),
-                "lotId": LOT_ID, "spaceId": space_id, "sensorId": client_id
-            }
-            r = c.publish(topic, payload=json.dumps(payload), qos=1, retain=True)
+            payload = encode_status(PAYLOAD_FORMAT, occupied, True, int(time.time()), LOT_ID, space_id, client_id)
+            r = c.publish(topic, payload=payload, qos=1, retain=True)
             if r.rc != mqtt.MQTT_ERR_SUCCESS:
-                print(f"[{space_id}] publish failed rc={r.rc}")
+                MQTT_PUBLISH_FAILURES.inc()
+                log_sampled(log, logging.WARNING, "publish-failed", "[%s] publish failed rc=%s", space_id, r.rc)
             else:
-                print(f"[{space_id}] sent occupied={occupied}")
+                _mqtt_out_status.inc()
+                log_sampled(log, logging.DEBUG, "publish-sent", "[%s] sent occupied=%s", space_id, occupied)
             time.sleep(PUBLISH_INTERVAL + random.uniform(0, 1.0))
 
     t = threading.Thread(target=loop, daemon=True, name=f"sensor-{space_id}")
     t.start()
     return t
 
+# Generatore di carico: tutti i sensori virtuali su un solo event loop asyncio
+def run_loadgen():
+    lot_ids = [LOT_ID] if LOADGEN_LOTS <= 1 else [f"{LOT_ID}{i + 1}" for i in range(LOADGEN_LOTS)]
+    pattern = make_pattern(LOADGEN_PATTERN, FLAP_PROB, RUSH_PERIOD, RUSH_DURATION, RUSH_FACTOR, RUSH_FLAP_PROB,
+                           DISCONNECT_PERIOD, DISCONNECT_DURATION, DISCONNECT_FRACTION)
+    tls = {"ca_certs": MQTT_CA, "certfile": MQTT_CERT, "keyfile": MQTT_KEY} if MQTT_TLS else None
+    gen = LoadGenerator(BROKER_HOST, BROKER_PORT, lot_ids, NUM_SPACES, pattern,
+                        interval=PUBLISH_INTERVAL, rate=LOADGEN_RATE, connections=LOADGEN_CONNECTIONS,
+                        lwt=LOADGEN_LWT, qos=LOADGEN_QOS, tls=tls, max_inflight=LOADGEN_MAX_INFLIGHT,
+                        connect_rate=LOADGEN_CONNECT_RATE, report_interval=LOADGEN_REPORT_INTERVAL,
+                        payload_format=PAYLOAD_FORMAT,
+                        on_sent=lambda _sensor, _now: _mqtt_out_status.inc())
+    log.info(f"[LOADGEN] {len(gen.sensors)} sensori su {len(lot_ids)} lot, pattern={pattern.name}, "
+             f"{'una connessione per sensore (LWT)' if LOADGEN_LWT else f'{LOADGEN_CONNECTIONS} connessioni condivise'}")
+    try:
+        summary = gen.run(LOADGEN_DURATION)
+    except KeyboardInterrupt:
+        return
+    log.info("[LOADGEN] riepilogo " + json.dumps(summary))
+
 # Funzione principale: avvia tutti i sensori e mantiene il processo attivo
 def main():
+    if PAYLOAD_FORMAT not in FORMATS:
+        raise SystemExit(f"PAYLOAD_FORMAT sconosciuto: {PAYLOAD_FORMAT} ({', '.join(FORMATS)})")
+    start_metrics_server(METRICS_PORT)
+    if SIM_MODE == "loadgen":
+        run_loadgen()
+        return
     spaces = [f"{LOT_ID}-{i+1}" for i in range(NUM_SPACES)]
-    threads = [make_sensor(s) for s in spaces]
+    threads = [make_sensor(s, i == 0) for i, s in enumerate(spaces)]
     try:
         while True:
             time.sleep(5)
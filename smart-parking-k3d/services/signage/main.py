@@ -1,109 +1,179 @@
 # Segnaletica parcheggi (UI) per Smart Parking
 # Espone una mini-app FastAPI che mostra lo stato dei parcheggi tramite le CRD ParkingLot
+import asyncio
 import os
+import json
+import threading
+import time
+from contextlib import asynccontextmanager
 from typing import List, Dict, Any
 
 from fastapi import FastAPI, Request
-from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse
+from fastapi.responses import HTMLResponse, PlainTextResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
+from starlette.concurrency import run_in_threadpool
 from kubernetes import client as k8s_client
 from kube import load_kube_config_safely
+from informer import Informer
+from stream import Broadcaster
+from counters import LotTotals, OccupancyCounters
+from respcache import CachedJSONResponse
+from metrics import RequestMetricsMiddleware, gauge, instrument_k8s, metrics_response, setup_logging
 
 # Configurazione CRD e namespace
 GROUP = "parking.smart"
 VERSION = "v1alpha1"
 NAMESPACE = os.getenv("NAMESPACE", "smart-parking")
+INFORMER_SYNC_TIMEOUT = float(os.getenv("INFORMER_SYNC_TIMEOUT", "10"))  # Attesa massima della prima LIST all'avvio (s)
+WATCH_TIMEOUT = int(os.getenv("WATCH_TIMEOUT", "300"))                  # Durata di una singola WATCH prima di riaprirla (s)
+API_REQUEST_TIMEOUT = float(os.getenv("API_REQUEST_TIMEOUT", "10"))      # Timeout di una chiamata all'API server (s)
+STREAM_KEEPALIVE = float(os.getenv("STREAM_KEEPALIVE", "15"))           # Secondi tra due keepalive sullo stream SSE
+COUNTERS_CHECK_INTERVAL = float(os.getenv("COUNTERS_CHECK_INTERVAL", "300"))  # Secondi tra due verifiche dei contatori (0 = disabilitato)
 
-app = FastAPI(title="Signage")
-templates = Jinja2Templates(directory="templates")
-app.mount("/static", StaticFiles(directory="static"), name="static")
+log = setup_logging("signage")
 
-# Inizializza client Kubernetes (in-cluster o kubeconfig)
+# Inizializza client Kubernetes (in-cluster o kubeconfig); le chiamate all'API server sono misurate
 load_kube_config_safely()
-crd = k8s_client.CustomObjectsApi()
+crd = k8s_client.CustomObjectsApi(instrument_k8s(k8s_client.ApiClient()))
+
+
+def normalize_lot(item: Dict[str, Any]) -> Dict[str, Any]:
+    """Normalizza un ParkingLot nei campi esposti dalla UI."""
+    meta = item.get("metadata", {})
+    spec = item.get("spec", {}) or {}
+    status = item.get("status", {}) or {}
+
+    name = meta.get("name", "")
+    lot_id = spec.get("lotId") or name.upper()
+    total = int(spec.get("totalSpaces", 0) or 0)
+    occupied = int(status.get("occupied", 0) or 0)
+    free = int(status.get("free", max(0, total - occupied)) or 0)
+    offline = int(status.get("offline", 0) or 0)
+    last_update = status.get("lastUpdate")
+
+    return {
+        "name": name,
+        "lotId": lot_id,
+        "totalSpaces": total,
+        "occupied": occupied,
+        "free": free,
+        "offline": offline,
+        "lastUpdate": last_update,
+    }
+
+
+def normalize_space(item: Dict[str, Any]) -> Dict[str, Any]:
+    """Normalizza un ParkingSpace nello stato dello stallo esposto dalla UI."""
+    meta = item.get("metadata", {})
+    spec = item.get("spec", {}) or {}
+    status = item.get("status", {}) or {}
+
+    name = meta.get("name", "")
+    lot_id = spec.get("lotId") or ""
+    space_id = spec.get("spaceId") or name.upper()
+    occupied = bool(status.get("occupied", False))
+    sensor_online = bool(status.get("sensorOnline", False))
+    last_seen = status.get("lastSeen")
+
+    return {
+        "name": name,
+        "lotId": lot_id,
+        "spaceId": space_id,
+        "occupied": occupied,
+        "sensorOnline": sensor_online,
+        "lastSeen": last_seen,
+    }
+
+
+# Cache locali delle CRD: LIST iniziale + WATCH, le richieste HTTP leggono solo dalla memoria
+lots_informer = Informer(crd, GROUP, VERSION, NAMESPACE, "parkinglots", normalize_lot, WATCH_TIMEOUT,
+                         API_REQUEST_TIMEOUT)
+spaces_informer = Informer(crd, GROUP, VERSION, NAMESPACE, "parkingspaces", normalize_space, WATCH_TIMEOUT,
+                           API_REQUEST_TIMEOUT)
+
+# Contatori incrementali per il riepilogo: aggiornati dagli informer, letti in O(1) dalle richieste
+space_counters = OccupancyCounters()
+lot_totals = LotTotals()
+
+
+def on_space_change(_event: str, name: str, obj, prev):
+    # Uno stallo eliminato o spostato su un altro lot esce dai contatori del lot precedente
+    if prev is not None and (obj is None or obj["lotId"] != prev["lotId"]):
+        space_counters.remove(prev["lotId"], name)
+    if obj is not None:
+        space_counters.update(obj["lotId"], name, obj["occupied"], obj["sensorOnline"])
+
+
+# I contatori vengono registrati prima del broadcaster, cosi' il riepilogo inviato nei delta e' gia' aggiornato
+lots_informer.add_listener(lambda _event, _name, obj, prev: lot_totals.apply(prev, obj))
+spaces_informer.add_listener(on_space_change)
+
+# Le variazioni viste dagli informer vengono inoltrate ai client collegati a /dashboard-stream
+broadcaster = Broadcaster()
+lots_informer.add_listener(lambda _event, name, obj, _prev: broadcaster.publish("lot", name, obj))
+spaces_informer.add_listener(lambda _event, name, obj, _prev: broadcaster.publish("space", name, obj))
+
+# Risposte di /lots e /dashboard-data serializzate una volta per versione dei dati (ETag/304, gzip/brotli);
+# l'invalidazione e' registrata dopo i contatori, cosi' il riepilogo ricostruito e' gia' aggiornato
+lots_response = CachedJSONResponse("/lots", lambda: list_lots_data())
+dashboard_response = CachedJSONResponse("/dashboard-data", lambda: dashboard_snapshot())
+lots_informer.add_listener(lambda *_args: (lots_response.invalidate(), dashboard_response.invalidate()))
+spaces_informer.add_listener(lambda *_args: dashboard_response.invalidate())
+
+gauge("smartparking_cache_lots", "ParkingLot nella cache locale", lambda: lot_totals.snapshot()["count"])
+gauge("smartparking_cache_spaces", "ParkingSpace nella cache locale", space_counters.size)
+gauge("smartparking_stream_clients", "Client collegati a /dashboard-stream", broadcaster.clients)
+
+
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    lots_informer.start()
+    spaces_informer.start()
+    # Attende (con timeout) la prima LIST, cosi' le prime richieste non vedono una cache vuota;
+    # le due LIST procedono in parallelo, ciascuna nel thread del proprio informer
+    await asyncio.gather(run_in_threadpool(lots_informer.wait_synced, INFORMER_SYNC_TIMEOUT),
+                         run_in_threadpool(spaces_informer.wait_synced, INFORMER_SYNC_TIMEOUT))
+    if COUNTERS_CHECK_INTERVAL > 0:
+        threading.Thread(target=counters_check_loop, daemon=True, name="counters-check").start()
+    yield
+
+
+app = FastAPI(title="Signage", lifespan=lifespan)
+app.add_middleware(RequestMetricsMiddleware)
+templates = Jinja2Templates(directory="templates")
+app.mount("/static", StaticFiles(directory="static"), name="static")
 
 
 def list_lots_data() -> List[Dict[str, Any]]:
-    """Legge i ParkingLot dal namespace, normalizza i campi e restituisce una lista semplice."""
-    items: List[Dict[str, Any]] = []
-    try:
-        resp = crd.list_namespaced_custom_object(GROUP, VERSION, NAMESPACE, "parkinglots")
-        for item in resp.get("items", []):
-            meta = item.get("metadata", {})
-            spec = item.get("spec", {}) or {}
-            status = item.get("status", {}) or {}
-
-            name = meta.get("name", "")
-            lot_id = spec.get("lotId") or name.upper()
-            total = int(spec.get("totalSpaces", 0) or 0)
-            occupied = int(status.get("occupied", 0) or 0)
-            free = int(status.get("free", max(0, total - occupied)) or 0)
-            last_update = status.get("lastUpdate")
-
-            items.append({
-                "name": name,
-                "lotId": lot_id,
-                "totalSpaces": total,
-                "occupied": occupied,
-                "free": free,
-                "lastUpdate": last_update,
-            })
-    except Exception:
-        # In caso di errori RBAC o temporanei restituisce lista vuota e un header diagnostico
-        return []
-    return items
+    """Restituisce i ParkingLot normalizzati dalla cache locale."""
+    return lots_informer.list()
 
 
 def list_spaces_data() -> List[Dict[str, Any]]:
-    """Legge i ParkingSpace dal namespace e restituisce lo stato di ogni stallo."""
-    items: List[Dict[str, Any]] = []
-    try:
-        resp = crd.list_namespaced_custom_object(GROUP, VERSION, NAMESPACE, "parkingspaces")
-        for item in resp.get("items", []):
-            meta = item.get("metadata", {})
-            spec = item.get("spec", {}) or {}
-            status = item.get("status", {}) or {}
-
-            name = meta.get("name", "")
-            lot_id = spec.get("lotId") or ""
-            space_id = spec.get("spaceId") or name.upper()
-            occupied = bool(status.get("occupied", False))
-            sensor_online = bool(status.get("sensorOnline", False))
-            last_seen = status.get("lastSeen")
-
-            items.append(
-                {
-                    "name": name,
-                    "lotId": lot_id,
-                    "spaceId": space_id,
-                    "occupied": occupied,
-                    "sensorOnline": sensor_online,
-                    "lastSeen": last_seen,
-                }
-            )
-    except Exception:
-        return []
-    return items
-
-
-def compute_summary(lots: List[Dict[str, Any]], spaces: List[Dict[str, Any]]) -> Dict[str, Any]:
-    total_lots = len(lots)
-    total_spaces = sum(l.get("totalSpaces", 0) or 0 for l in lots)
-    occupied_spaces = sum(l.get("occupied", 0) or 0 for l in lots)
-    free_spaces = sum(l.get("free", 0) or 0 for l in lots)
+    """Restituisce lo stato di ogni stallo dalla cache locale."""
+    return spaces_informer.list()
+
+
+def compute_summary() -> Dict[str, Any]:
+    """Riepilogo della dashboard dai contatori incrementali, senza scorrere lot e stalli."""
+    lots = lot_totals.snapshot()
+    spaces = space_counters.fleet()
+    total_spaces = lots["totalSpaces"]
+    occupied_spaces = lots["occupied"]
+    free_spaces = lots["free"]
 
     # Fallback: se non ci sono ParkingLot usa il conteggio diretto degli stalli
-    if total_spaces == 0 and spaces:
-        total_spaces = len(spaces)
-        occupied_spaces = sum(1 for s in spaces if s.get("occupied"))
-        free_spaces = max(0, total_spaces - occupied_spaces)
+    if total_spaces == 0 and spaces["total"]:
+        total_spaces = spaces["total"]
+        occupied_spaces = spaces["occupied"]
+        free_spaces = spaces["free"]
 
-    sensors_online = sum(1 for s in spaces if s.get("sensorOnline"))
-    sensors_offline = max(0, len(spaces) - sensors_online)
+    sensors_online = spaces["online"]
+    sensors_offline = spaces["offline"]
 
     return {
-        "totalLots": total_lots,
+        "totalLots": lots["count"],
         "totalSpaces": total_spaces,
         "occupiedSpaces": occupied_spaces,
         "freeSpaces": free_spaces,
@@ -112,22 +182,94 @@ def compute_summary(lots: List[Dict[str, Any]], spaces: List[Dict[str, Any]]) ->
     }
 
 
+def counters_check_loop():
+    """Verifica periodica dei contatori rispetto al contenuto delle cache; le derive vengono segnalate."""
+    while True:
+        time.sleep(COUNTERS_CHECK_INTERVAL)
+        for d in space_counters.self_check():
+            log.warning(f"[COUNTERS] deriva sugli stalli del lot {d['lot']}: atteso={d['expected']} incrementale={d['actual']}")
+        drift = lot_totals.check(list_lots_data())
+        if drift is not None:
+            log.warning(f"[COUNTERS] deriva sui totali dei lot: atteso={drift['expected']} incrementale={drift['actual']}")
+
+
+# Gli handler leggono solo la memoria: girano direttamente sull'event loop, senza occupare il threadpool
+
 @app.get("/health", response_class=PlainTextResponse)
-def health() -> str:
+async def health() -> str:
     return "ok"
 
 
+@app.get("/metrics")
+async def metrics():
+    body, content_type = metrics_response()
+    return Response(body, media_type=content_type)
+
+
 @app.get("/lots")
-def lots_json():
-    return JSONResponse(list_lots_data())
+async def lots_json(request: Request):
+    return await lots_response.respond(request)
 
 
-@app.get("/dashboard-data")
-def dashboard_data():
+def dashboard_snapshot() -> Dict[str, Any]:
     lots = list_lots_data()
     spaces = list_spaces_data()
-    summary = compute_summary(lots, spaces)
-    return JSONResponse({"lots": lots, "spaces": spaces, "summary": summary})
+    summary = compute_summary()
+    return {"lots": lots, "spaces": spaces, "summary": summary}
+
+
+@app.get("/dashboard-data")
+async def dashboard_data(request: Request):
+    return await dashboard_response.respond(request)
+
+
+def sse_event(event: str, data: Any) -> bytes:
+    return f"event: {event}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n".encode("utf-8")
+
+
+async def sse_snapshot() -> bytes:
+    # Lo snapshot e' il corpo gia' serializzato di /dashboard-data (JSON compatto, senza a capo): nessuna
+    # serializzazione sull'event loop a ogni (ri)connessione o risincronizzazione
+    return b"event: snapshot\ndata: " + await dashboard_response.body() + b"\n\n"
+
+
+@app.get("/dashboard-stream")
+async def dashboard_stream(request: Request):
+    """Stream SSE: uno snapshot iniziale e poi solo le variazioni di lot e stalli."""
+    # La sottoscrizione precede lo snapshot: una variazione concorrente viene al piu' riapplicata
+    sub = broadcaster.subscribe()
+
+    async def events():
+        try:
+            yield await sse_snapshot()
+            while not await request.is_disconnected():
+                batch = await sub.next_batch(STREAM_KEEPALIVE)
+                if batch is None:
+                    yield b": keepalive\n\n"
+                    continue
+                if sub.overflow:
+                    # Il client e' rimasto indietro: si riparte da uno snapshot completo
+                    sub.overflow = False
+                    while not sub.queue.empty():
+                        sub.queue.get_nowait()
+                    yield await sse_snapshot()
+                    continue
+                # Per ogni oggetto conta solo l'ultima variazione del batch
+                changed: Dict[str, Dict[str, Any]] = {"lot": {}, "space": {}}
+                for kind, name, obj in batch:
+                    changed[kind][name] = obj
+                yield sse_event("delta", {
+                    "lots": [o for o in changed["lot"].values() if o is not None],
+                    "deletedLots": [n for n, o in changed["lot"].items() if o is None],
+                    "spaces": [o for o in changed["space"].values() if o is not None],
+                    "deletedSpaces": [n for n, o in changed["space"].items() if o is None],
+                    "summary": compute_summary(),
+                })
+        finally:
+            broadcaster.unsubscribe(sub)
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 
 @app.get("/", response_class=HTMLResponse)
@@ -5,6 +5,14 @@ const metrics = Array.from(document.querySelectorAll('.card[data-metric]')).redu
 const lotsEl = document.getElementById('lots');
 const spacesEl = document.getElementById('spaces');
 const lastUpdateEl = document.getElementById('last-update');
+const modeEl = document.getElementById('update-mode');
+
+const POLL_INTERVAL = 3000;
+const STREAM_TIMEOUT = 5000;
+
+// Elementi DOM indicizzati per nome della CRD: gli aggiornamenti toccano solo le righe cambiate
+const lotCards = new Map();
+const spaceRows = new Map();
 
 function cls(free, total){
   if (total===0) return 'warn';
@@ -33,46 +41,112 @@ function renderSummary(summary){
   });
 }
 
-function renderLots(lots){
-  if(!lots || !lots.length){
-    lotsEl.innerHTML = '<div class="empty">Nessun parcheggio disponibile</div>';
-    return;
-  }
-  lotsEl.innerHTML = lots.map(l=>{
-    const c = cls(l.free, l.totalSpaces);
-    return `
-      <div class="lot-card">
+function lotHtml(l){
+  const c = cls(l.free, l.totalSpaces);
+  return `
         <div class="lot-id">PARCHEGGIO ${l.lotId}</div>
         <div class="lot-free ${c}">${l.free}</div>
         <div class="lot-meta">Liberi su ${l.totalSpaces}</div>
-        <div class="lot-meta">Ultimo aggiornamento: ${l.lastUpdate ? formatDate(l.lastUpdate) : '—'}</div>
-      </div>`;
-  }).join('');
+        <div class="lot-meta">Ultimo aggiornamento: ${l.lastUpdate ? formatDate(l.lastUpdate) : '—'}</div>`;
 }
 
-function renderSpaces(spaces){
-  if(!spaces || !spaces.length){
-    spacesEl.innerHTML = '<tr><td colspan="5" class="empty">Nessuno stallo rilevato</td></tr>';
-    return;
-  }
-  spacesEl.innerHTML = spaces.map(s=>{
-    const occCls = s.occupied ? 'bad' : 'ok';
-    const occLabel = s.occupied ? 'Occupato' : 'Libero';
-    const sensorCls = s.sensorOnline ? 'online' : 'offline';
-    const sensorLabel = s.sensorOnline ? 'Online' : 'Offline';
-    return `
-      <tr>
+function spaceHtml(s){
+  const occCls = s.occupied ? 'bad' : 'ok';
+  const occLabel = s.occupied ? 'Occupato' : 'Libero';
+  const sensorCls = s.sensorOnline ? 'online' : 'offline';
+  const sensorLabel = s.sensorOnline ? 'Online' : 'Offline';
+  return `
         <td>${s.lotId || '—'}</td>
         <td>${s.spaceId || '—'}</td>
         <td><span class="status-pill ${occCls}">${occLabel}</span></td>
         <td><span class="status-pill ${sensorCls}">${sensorLabel}</span></td>
-        <td>${formatDate(s.lastSeen)}</td>
-      </tr>`;
-  }).join('');
+        <td>${formatDate(s.lastSeen)}</td>`;
+}
+
+// Inserisce l'elemento mantenendo l'ordinamento per nome usato dal server
+function insertSorted(container, index, name, el){
+  let next = null;
+  for(const [other, otherEl] of index){
+    if(other > name && (next === null || other < next.name)){
+      next = {name: other, el: otherEl};
+    }
+  }
+  container.insertBefore(el, next ? next.el : null);
+}
+
+function upsertLot(l){
+  let card = lotCards.get(l.name);
+  const html = lotHtml(l);
+  if(card){
+    if(card.dataset.html !== html){ card.innerHTML = html; card.dataset.html = html; }
+    return;
+  }
+  if(!lotCards.size){ lotsEl.innerHTML = ''; }
+  card = document.createElement('div');
+  card.className = 'lot-card';
+  card.innerHTML = html;
+  card.dataset.html = html;
+  insertSorted(lotsEl, lotCards, l.name, card);
+  lotCards.set(l.name, card);
+}
+
+function removeLot(name){
+  const card = lotCards.get(name);
+  if(!card) return;
+  card.remove();
+  lotCards.delete(name);
+  if(!lotCards.size){
+    lotsEl.innerHTML = '<div class="empty">Nessun parcheggio disponibile</div>';
+  }
+}
+
+function upsertSpace(s){
+  let row = spaceRows.get(s.name);
+  const html = spaceHtml(s);
+  if(row){
+    if(row.dataset.html !== html){ row.innerHTML = html; row.dataset.html = html; }
+    return;
+  }
+  if(!spaceRows.size){ spacesEl.innerHTML = ''; }
+  row = document.createElement('tr');
+  row.innerHTML = html;
+  row.dataset.html = html;
+  insertSorted(spacesEl, spaceRows, s.name, row);
+  spaceRows.set(s.name, row);
+}
+
+function removeSpace(name){
+  const row = spaceRows.get(name);
+  if(!row) return;
+  row.remove();
+  spaceRows.delete(name);
+  if(!spaceRows.size){
+    spacesEl.innerHTML = '<tr><td colspan="5" class="empty">Nessuno stallo rilevato</td></tr>';
+  }
+}
+
+function renderLots(lots){
+  const seen = new Set();
+  (lots || []).forEach(l=>{ seen.add(l.name); upsertLot(l); });
+  Array.from(lotCards.keys()).filter(n=>!seen.has(n)).forEach(removeLot);
+  if(!lotCards.size){
+    lotsEl.innerHTML = '<div class="empty">Nessun parcheggio disponibile</div>';
+  }
+}
+
+function renderSpaces(spaces){
+  const seen = new Set();
+  (spaces || []).forEach(s=>{ seen.add(s.name); upsertSpace(s); });
+  Array.from(spaceRows.keys()).filter(n=>!seen.has(n)).forEach(removeSpace);
+  if(!spaceRows.size){
+    spacesEl.innerHTML = '<tr><td colspan="5" class="empty">Nessuno stallo rilevato</td></tr>';
+  }
 }
 
 function render(data){
   if(!data){
+    lotCards.clear();
+    spaceRows.clear();
     lotsEl.innerHTML = '<div class="empty">Errore nel caricamento…</div>';
     spacesEl.innerHTML = '<tr><td colspan="5" class="empty">Errore nel caricamento…</td></tr>';
     return;
@@ -83,9 +157,23 @@ function render(data){
   lastUpdateEl.textContent = new Date().toLocaleTimeString();
 }
 
+// Applica una variazione ricevuta dallo stream: solo le righe coinvolte vengono aggiornate
+function applyDelta(delta){
+  (delta.lots || []).forEach(upsertLot);
+  (delta.deletedLots || []).forEach(removeLot);
+  (delta.spaces || []).forEach(upsertSpace);
+  (delta.deletedSpaces || []).forEach(removeSpace);
+  if(delta.summary){ renderSummary(delta.summary); }
+  lastUpdateEl.textContent = new Date().toLocaleTimeString();
+}
+
+// ---------- Polling (fallback) ----------
+let pollTimer = null;
+
 async function tick(){
   try{
-    const r = await fetch('/dashboard-data', {cache:'no-store'});
+    // no-cache: il browser rivalida con If-None-Match e su 304 riusa la copia che ha gia'
+    const r = await fetch('/dashboard-data', {cache:'no-cache'});
     if(!r.ok){ throw new Error('HTTP '+r.status); }
     const data = await r.json();
     render(data);
@@ -94,5 +182,46 @@ async function tick(){
   }
 }
 
-tick();
-setInterval(tick, 3000);
\ No newline at end of file
+function startPolling(){
+  if(pollTimer !== null) return;
+  if(modeEl) modeEl.textContent = 'polling ogni 3s';
+  tick();
+  pollTimer = setInterval(tick, POLL_INTERVAL);
+}
+
+function stopPolling(){
+  if(pollTimer === null) return;
+  clearInterval(pollTimer);
+  pollTimer = null;
+}
+
+// ---------- Stream (Server-Sent Events) ----------
+function startStream(){
+  if(!window.EventSource){
+    startPolling();
+    return;
+  }
+  const es = new EventSource('/dashboard-stream');
+  // Se lo snapshot non arriva in tempo si passa al polling finche' lo stream non risponde
+  let fallback = setTimeout(startPolling, STREAM_TIMEOUT);
+
+  es.addEventListener('snapshot', ev=>{
+    clearTimeout(fallback);
+    stopPolling();
+    if(modeEl) modeEl.textContent = 'in tempo reale';
+    render(JSON.parse(ev.data));
+  });
+  es.addEventListener('delta', ev=>{
+    applyDelta(JSON.parse(ev.data));
+  });
+  es.onerror = ()=>{
+    // EventSource si riconnette da solo; nel frattempo i dati arrivano via polling
+    startPolling();
+    if(es.readyState === EventSource.CLOSED){
+      clearTimeout(fallback);
+      setTimeout(startStream, POLL_INTERVAL);
+    }
+  };
+}
+
+startStream();
@@ -0,0 +1,70 @@
+# Diffusione delle variazioni delle CRD ai client della dashboard (Server-Sent Events)
+# Gli eventi arrivano dai thread degli informer e vengono consegnati alle code asyncio dei client.
+
+import asyncio
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+# Evento: (tipo risorsa "lot"/"space", nome, oggetto normalizzato oppure None se eliminato)
+Change = Tuple[str, str, Optional[Dict[str, Any]]]
+
+
+class Subscription:
+    """Coda di variazioni di un singolo client connesso allo stream."""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, max_pending: int):
+        self.loop = loop
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_pending)
+        self.overflow = False  # True se il client e' rimasto indietro: va reinviato uno snapshot
+
+    def _put(self, change: Change):
+        try:
+            self.queue.put_nowait(change)
+        except asyncio.QueueFull:
+            self.overflow = True
+
+    async def next_batch(self, timeout: float) -> Optional[List[Change]]:
+        """Attende almeno una variazione (None allo scadere del timeout) e restituisce tutte quelle in coda."""
+        try:
+            first = await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+        batch = [first]
+        while not self.queue.empty():
+            batch.append(self.queue.get_nowait())
+        return batch
+
+
+class Broadcaster:
+    """Inoltra le variazioni degli informer a tutti i client sottoscritti."""
+
+    def __init__(self, max_pending: int = 10000):
+        self._lock = threading.Lock()
+        self._subs: List[Subscription] = []
+        self._max_pending = max_pending
+
+    def subscribe(self) -> Subscription:
+        sub = Subscription(asyncio.get_running_loop(), self._max_pending)
+        with self._lock:
+            self._subs.append(sub)
+        return sub
+
+    def unsubscribe(self, sub: Subscription):
+        with self._lock:
+            if sub in self._subs:
+                self._subs.remove(sub)
+
+    def clients(self) -> int:
+        with self._lock:
+            return len(self._subs)
+
+    def publish(self, kind: str, name: str, obj: Optional[Dict[str, Any]]):
+        """Chiamato dai thread degli informer: consegna la variazione nel loop asyncio di ogni client."""
+        with self._lock:
+            subs = list(self._subs)
+        for sub in subs:
+            try:
+                sub.loop.call_soon_threadsafe(sub._put, (kind, name, obj))
+            except RuntimeError:
+                # Loop chiuso: il client verra' rimosso dal suo generatore
+                pass